@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+# Time the preview, comparison and filespec tools on synthetic
+# MCD43/VNP43-like HDF-EOS5 files at tile, CMG and 30-arcsec scales,
+# and write machine-readable results for tracking regressions.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import sys
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import datetime
+
+import numpy as np
+import h5py
+
+import colorama
+colorama.init(autoreset=True)
+# define some color schemes for message output control
+colorWarnStr = lambda msg: colorama.Fore.YELLOW + str(msg) + colorama.Style.RESET_ALL
+colorErrorStr = lambda msg: colorama.Fore.RED + str(msg) + colorama.Style.RESET_ALL
+colorInfoStr = lambda msg: colorama.Fore.GREEN + str(msg) + colorama.Style.RESET_ALL
+colorDimStr = lambda msg: colorama.Style.DIM + str(msg) + colorama.Style.RESET_ALL
+colorLogStr = lambda msg: str(msg)
+colorResetStr = lambda msg: colorama.Style.RESET_ALL + str(msg)
+
+from gen_synthetic_mvp_h5 import GRID_SCALES, genSyntheticFile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+PREVIEW_SCRIPT = os.path.join(REPO_DIR, "common-utils", "plot_hdf5_preview.py")
+COMPARE_SCRIPT = os.path.join(REPO_DIR, "common-utils", "compare_mv_datasets.py")
+FILESPEC_SCRIPT = os.path.join(REPO_DIR, "viirs-utils", "gen_vnp43_filespec.py")
+FILESPEC_TEMPLATE = os.path.join(REPO_DIR, "viirs-utils", "vnp43_filespec_template_example.fs")
+
+# Layers written to the synthetic files at each scale. The 3D
+# parameter layer of a 30-arcsec grid alone is over 5 GB, so only
+# the 2D layers are written at that scale.
+SCALE_LAYERS = {"tile":["params", "bsa", "wsa", "qa"],
+                "cmg":["params", "bsa", "wsa", "qa"],
+                "30arcsec":["bsa", "qa"]}
+BENCH_DATASET = "Albedo_BSA_M1"
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Benchmark the MVP tools on synthetic MCD43/VNP43-like HDF-EOS5 files.")
+
+    p.add_argument("--scales", dest="scales", nargs="+", required=False, default=["tile", "cmg"], choices=sorted(GRID_SCALES.keys()), help="Grid scales to benchmark. Default: tile cmg. The 30arcsec scale writes about 4 GB of synthetic data per file.")
+    p.add_argument("--tools", dest="tools", nargs="+", required=False, default=["preview", "compare", "filespec"], choices=["preview", "compare", "filespec"], help="Tools to benchmark. Default: preview compare filespec.")
+    p.add_argument("--repeat", dest="repeat", type=int, required=False, default=3, help="Number of timed runs of each tool at each scale. Default: 3.")
+
+    p.add_argument("--workdir", dest="workdir", required=False, default=None, help="Directory to keep synthetic input files and tool outputs. Synthetic files already in this directory with the same generation options are reused. Default: a temporary directory removed afterwards.")
+    p.add_argument("--compression", dest="compression", required=False, default="gzip", choices=["gzip", "lzf", "none"], help="HDF5 compression filter of the synthetic files. Default: gzip.")
+    p.add_argument("--chunk", dest="chunk", nargs=2, type=int, required=False, default=None, metavar=("CHUNK_ROWS", "CHUNK_COLS"), help="HDF5 chunk size of the synthetic files. Default: the generator default.")
+    p.add_argument("--dtype", dest="dtype", required=False, default=None, help="Data type of the non-QA layers of the synthetic files. Default: the product data types.")
+
+    p.add_argument("--python", dest="python", required=False, default=sys.executable, help="Python interpreter to run the tools. Default: the interpreter running this benchmark.")
+    p.add_argument("--ojson", dest="ojson", required=False, default=None, help="Name of a JSON file to output the benchmark results. Default: output to stdout.")
+    p.add_argument("--baseline", dest="baseline", required=False, default=None, help="A JSON file of earlier benchmark results. Runs slower than the baseline by more than --threshold are reported as regressions and the program exits with status 1.")
+    p.add_argument("--threshold", dest="threshold", type=float, required=False, default=0.1, help="Relative slowdown of the median wall time against the baseline to flag a regression. Default: 0.1, i.e. 10%%.")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.repeat < 1:
+        raise RuntimeError(colorErrorStr("Number of repeated runs must be at least 1."))
+
+    return cmdargs
+
+def getGitRevision():
+    try:
+        return subprocess.check_output(["git", "-C", REPO_DIR, "rev-parse", "HEAD"], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "N/A"
+
+def prepareInputs(workdir, scale, gen_opts):
+    """
+    Generate a pair of synthetic files of a scale that differ only in
+    their random seeds. Files already generated with the same options
+    are reused.
+    """
+    nrows, ncols = GRID_SCALES[scale]
+    tag = "{0:s}_{1:s}_{2:s}_{3:s}".format(scale, gen_opts["compression"],
+                                          "x".join([str(c) for c in gen_opts["chunk"]]) if gen_opts["chunk"] is not None else "dchunk",
+                                          gen_opts["dtype"] if gen_opts["dtype"] is not None else "dtype")
+    infiles = []
+    for seed in [0, 1]:
+        fname = os.path.join(workdir, "VNP43SYN.{0:s}.seed{1:d}.h5".format(tag, seed))
+        if not os.path.isfile(fname):
+            print colorLogStr("Generate synthetic input ") + colorDimStr(fname)
+            genSyntheticFile(fname + ".tmp", nrows, ncols,
+                             layers=SCALE_LAYERS[scale], dtype=gen_opts["dtype"],
+                             chunk=gen_opts["chunk"], compression=gen_opts["compression"],
+                             seed=seed, scale=scale)
+            os.rename(fname + ".tmp", fname)
+        infiles.append(fname)
+    return infiles
+
+def buildCommand(tool, python, infiles, outdir):
+    if tool == "preview":
+        return [python, PREVIEW_SCRIPT, "--h5f", infiles[0], "--dataset", BENCH_DATASET,
+                "--of", os.path.join(outdir, "preview.png"), "--stats",
+                "--ocsv", os.path.join(outdir, "preview.csv")]
+    elif tool == "compare":
+        return [python, COMPARE_SCRIPT, "--files"] + infiles \
+            + ["--datasets", BENCH_DATASET, BENCH_DATASET, "--labels", "seed0", "seed1",
+               "--outdir", outdir, "--stats", "--ocsv", os.path.join(outdir, "compare.csv")]
+    elif tool == "filespec":
+        return [python, FILESPEC_SCRIPT, "-t", FILESPEC_TEMPLATE, "-f", infiles[0],
+                "-o", os.path.join(outdir, "filespec.txt")]
+    else:
+        raise RuntimeError(colorErrorStr("Unrecognized tool {0:s}".format(tool)))
+
+def timeCommand(cmd, logfile):
+    """
+    Run a command and return its wall time, the CPU time and the peak
+    resident memory of the child process, and its return code.
+    """
+    t0 = time.time()
+    with open(logfile, "w") as log_fobj:
+        proc = subprocess.Popen(cmd, stdout=log_fobj, stderr=subprocess.STDOUT)
+        # the rusage of this child only, unlike RUSAGE_CHILDREN whose
+        # ru_maxrss is the maximum over all the children so far.
+        _, status, ru = os.wait4(proc.pid, 0)
+    wall = time.time() - t0
+    retcode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    proc.returncode = retcode
+    # ru_maxrss is in kilobytes on Linux.
+    return wall, ru.ru_utime + ru.ru_stime, ru.ru_maxrss, retcode
+
+def tailFile(fname, nlines=5):
+    with open(fname, "r") as fobj:
+        lines = fobj.read().replace("\r", "\n").splitlines()
+    return "\n".join([l for l in lines if len(l.strip()) > 0][-nlines:])
+
+def findRegressions(results, baseline, threshold):
+    base_dict = dict([((r["tool"], r["scale"]), r) for r in baseline["results"]])
+    regressions = []
+    for r in results:
+        key = (r["tool"], r["scale"])
+        if key not in base_dict or r["status"] != "ok" or base_dict[key]["status"] != "ok":
+            continue
+        ratio = r["wall_median"] / base_dict[key]["wall_median"]
+        if ratio > 1 + threshold:
+            regressions.append((r["tool"], r["scale"], base_dict[key]["wall_median"], r["wall_median"], ratio))
+    return regressions
+
+def main(cmdargs):
+    scales = cmdargs.scales
+    tools = cmdargs.tools
+    nrepeat = cmdargs.repeat
+    python = cmdargs.python
+    outjson = cmdargs.ojson
+    gen_opts = dict(compression=cmdargs.compression,
+                    chunk=None if cmdargs.chunk is None else tuple(cmdargs.chunk),
+                    dtype=cmdargs.dtype)
+
+    rm_workdir = cmdargs.workdir is None
+    workdir = tempfile.mkdtemp(prefix="mvp_bench_") if rm_workdir else cmdargs.workdir
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    results = []
+    try:
+        for scale in scales:
+            infiles = prepareInputs(workdir, scale, gen_opts)
+            for tool in tools:
+                outdir = os.path.join(workdir, "out_{0:s}_{1:s}".format(tool, scale))
+                if not os.path.isdir(outdir):
+                    os.makedirs(outdir)
+                cmd = buildCommand(tool, python, infiles, outdir)
+                logfile = os.path.join(outdir, "run.log")
+
+                wall_list, cpu_list, maxrss, status, errmsg = [], [], 0, "ok", ""
+                for irun in range(nrepeat):
+                    sys.stdout.write("Benchmark {0:s} at {1:s} scale, run {2:d}/{3:d} ... ".format(tool, scale, irun+1, nrepeat))
+                    sys.stdout.flush()
+                    wall, cpu, rss, retcode = timeCommand(cmd, logfile)
+                    if retcode != 0:
+                        status, errmsg = "failed", tailFile(logfile)
+                        sys.stdout.write("\n")
+                        print colorWarnStr("{0:s} failed at {1:s} scale:\n{2:s}".format(tool, scale, errmsg))
+                        break
+                    wall_list.append(wall)
+                    cpu_list.append(cpu)
+                    maxrss = max(maxrss, rss)
+                    sys.stdout.write("{0:.3f} s\r".format(wall))
+                    sys.stdout.flush()
+                sys.stdout.write("\n")
+
+                with h5py.File(infiles[0], "r") as fobj:
+                    sds = fobj["HDFEOS/GRIDS/VIIRS_Grid_BRDF/Data Fields/{0:s}".format(BENCH_DATASET)]
+                    shape, chunks, dtype_name = list(sds.shape), sds.chunks, sds.dtype.name
+                    compression = sds.compression
+                results.append(dict(tool=tool, scale=scale, status=status, error=errmsg,
+                                    shape=shape, chunks=None if chunks is None else list(chunks),
+                                    dtype=dtype_name, compression=compression,
+                                    input_bytes=os.path.getsize(infiles[0]),
+                                    nruns=len(wall_list), wall=wall_list, cpu=cpu_list,
+                                    wall_median=float(np.median(wall_list)) if len(wall_list) else None,
+                                    wall_min=float(np.min(wall_list)) if len(wall_list) else None,
+                                    cpu_median=float(np.median(cpu_list)) if len(cpu_list) else None,
+                                    maxrss_kb=maxrss,
+                                    command=" ".join(cmd)))
+    finally:
+        if rm_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    out_dict = dict(created=datetime.datetime.now().isoformat(),
+                    git_revision=getGitRevision(),
+                    host=platform.node(), platform=platform.platform(),
+                    python=platform.python_version(),
+                    numpy=np.__version__, h5py=h5py.__version__,
+                    hdf5=h5py.version.hdf5_version,
+                    results=results)
+    out_str = json.dumps(out_dict, indent=2, sort_keys=True)
+    if outjson is not None:
+        print colorLogStr("Write benchmark results to ") + colorDimStr(outjson)
+        with open(outjson, "w") as fobj:
+            fobj.write(out_str + "\n")
+    else:
+        print colorInfoStr("Benchmark results: ")
+        sys.stdout.write(out_str + "\n")
+
+    exit_code = 0
+    if cmdargs.baseline is not None:
+        with open(cmdargs.baseline, "r") as fobj:
+            baseline = json.load(fobj)
+        regressions = findRegressions(results, baseline, cmdargs.threshold)
+        for tool, scale, t_base, t_now, ratio in regressions:
+            print colorErrorStr("Regression of {0:s} at {1:s} scale: {2:.3f} s -> {3:.3f} s ({4:.0%})".format(tool, scale, t_base, t_now, ratio-1))
+        if len(regressions) > 0:
+            exit_code = 1
+        else:
+            print colorInfoStr("No regression against the baseline ") + colorDimStr(cmdargs.baseline)
+
+    print colorResetStr("")
+    return exit_code
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    sys.exit(main(cmdargs))
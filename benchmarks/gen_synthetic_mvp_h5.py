@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+# Generate a synthetic HDF-EOS5 file that mirrors the layout of
+# MCD43/VNP43 products, for benchmarking the tools in this toolbox
+# without real NASA data.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import sys
+import argparse
+
+import h5py
+import numpy as np
+
+import colorama
+colorama.init(autoreset=True)
+# define some color schemes for message output control
+colorWarnStr = lambda msg: colorama.Fore.YELLOW + str(msg) + colorama.Style.RESET_ALL
+colorErrorStr = lambda msg: colorama.Fore.RED + str(msg) + colorama.Style.RESET_ALL
+colorInfoStr = lambda msg: colorama.Fore.GREEN + str(msg) + colorama.Style.RESET_ALL
+colorDimStr = lambda msg: colorama.Style.DIM + str(msg) + colorama.Style.RESET_ALL
+colorLogStr = lambda msg: str(msg)
+colorResetStr = lambda msg: colorama.Style.RESET_ALL + str(msg)
+
+# Grid sizes (rows, columns) of the product families.
+GRID_SCALES = {"tile":(2400, 2400),
+               "cmg":(3600, 7200),
+               "30arcsec":(21600, 43200)}
+
+# Size of a MODIS/VIIRS sinusoidal tile in meters.
+SIN_TILE_SIZE = 1111950.5197665
+SIN_ULX = -20015109.354
+SIN_ULY = 10007554.677
+
+# Layers to be written for each band, in the order of (dataset name
+# prefix, data type, fill value, scale factor, number of parameters
+# or None for a 2D layer, valid range, long name).
+LAYER_DEFS = {"params":("BRDF_Albedo_Parameters", "int16", 32767, 0.001, 3, (0, 32766), "BRDF_Albedo_Parameters"),
+              "bsa":("Albedo_BSA", "int16", 32767, 0.001, None, (0, 32766), "black_sky_albedo"),
+              "wsa":("Albedo_WSA", "int16", 32767, 0.001, None, (0, 32766), "white_sky_albedo"),
+              "qa":("BRDF_Albedo_Band_Mandatory_Quality", "uint8", 255, 1, None, (0, 254), "BRDF_Albedo_Band_Mandatory_Quality")}
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Generate a synthetic HDF-EOS5 file mirroring the layout of MCD43/VNP43 products.")
+
+    p.add_argument("--of", dest="outfile", required=True, default=None, help="File name of the output synthetic HDF-EOS5 file.")
+
+    p.add_argument("--scale", dest="scale", required=False, default="tile", choices=sorted(GRID_SCALES.keys()), help="Grid scale of the synthetic product, tile (2400x2400), cmg (7200x3600) or 30arcsec (43200x21600). Default: tile.")
+    p.add_argument("--size", dest="size", nargs=2, type=int, required=False, default=None, metavar=("NROWS", "NCOLS"), help="Custom grid size in rows and columns, overriding --scale.")
+    p.add_argument("--tile", dest="tile", required=False, default="h12v04", help="Sinusoidal tile ID written to the grid geometry when the scale is tile. Default: h12v04.")
+    p.add_argument("--grid_name", dest="grid_name", required=False, default="VIIRS_Grid_BRDF", help="Name of the grid under HDFEOS/GRIDS. Default: VIIRS_Grid_BRDF.")
+    p.add_argument("--bands", dest="bands", nargs="+", required=False, default=["M1"], help="Band names appended to each layer name. Default: M1.")
+    p.add_argument("--layers", dest="layers", nargs="+", required=False, default=["params", "bsa", "wsa", "qa"], choices=["params", "bsa", "wsa", "qa"], help="Layers to write for each band. Default: params bsa wsa qa.")
+
+    p.add_argument("--dtype", dest="dtype", required=False, default=None, help="Override the data type of all non-QA layers, e.g. int16, uint16, float32. Default: the product data type of each layer.")
+    p.add_argument("--chunk", dest="chunk", nargs=2, type=int, required=False, default=None, metavar=("CHUNK_ROWS", "CHUNK_COLS"), help="HDF5 chunk size in rows and columns. Default: 1/4 of the grid size capped at 1200x1200.")
+    p.add_argument("--compression", dest="compression", required=False, default="gzip", choices=["gzip", "lzf", "none"], help="HDF5 compression filter. Default: gzip.")
+    p.add_argument("--compression_opts", dest="compression_opts", type=int, required=False, default=4, help="Level of gzip compression. Default: 4.")
+
+    p.add_argument("--fill_fraction", dest="fill_fraction", type=float, required=False, default=0.3, help="Fraction of pixels set to fill values. Default: 0.3.")
+    p.add_argument("--seed", dest="seed", type=int, required=False, default=0, help="Seed of the random number generator. Default: 0.")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.fill_fraction < 0 or cmdargs.fill_fraction > 1:
+        raise RuntimeError(colorErrorStr("Fill fraction must be within [0, 1]."))
+
+    return cmdargs
+
+def genStructMetadata(grid_name, nrows, ncols, field_defs, scale="tile", tile="h12v04",
+                      compression="gzip", compression_opts=4):
+    """
+    Compose a StructMetadata.0 string for one grid in the ODL syntax
+    used by HDF-EOS5 products.
+
+    field_defs: list of (data field name, HDF5 native type name, list
+    of dimension names).
+    """
+    if scale == "tile":
+        h, v = int(tile[1:3]), int(tile[4:6])
+        ulx = SIN_ULX + h*SIN_TILE_SIZE
+        uly = SIN_ULY - v*SIN_TILE_SIZE
+        lrx, lry = ulx + SIN_TILE_SIZE, uly - SIN_TILE_SIZE
+        proj_str = "HE5_GCTP_SNSOID"
+        proj_params = "(6371007.181000,0,0,0,0,0,0,0,0,0,0,0,0)"
+        sphere_code = "-1"
+    else:
+        # Geographic grids pack degrees into DDDMMMSSS.SS
+        ulx, uly, lrx, lry = -180000000., 90000000., 180000000., -90000000.
+        proj_str = "HE5_GCTP_GEO"
+        proj_params = "(0,0,0,0,0,0,0,0,0,0,0,0,0)"
+        sphere_code = "0"
+
+    dim_sizes = [("XDim", ncols), ("YDim", nrows)]
+    for _, _, dims in field_defs:
+        for d in dims:
+            if d == "Num_Parameters" and d not in [ds[0] for ds in dim_sizes]:
+                dim_sizes.append((d, 3))
+
+    if compression == "gzip":
+        comp_str = "\t\t\t\tCompressionType=HE5_HDFE_COMP_DEFLATE\n\t\t\t\tDeflateLevel={0:d}\n".format(compression_opts)
+    else:
+        comp_str = ""
+
+    lines = ["GROUP=SwathStructure", "END_GROUP=SwathStructure",
+             "GROUP=GridStructure",
+             "\tGROUP=GRID_1",
+             "\t\tGridName=\"{0:s}\"".format(grid_name),
+             "\t\tXDim={0:d}".format(ncols),
+             "\t\tYDim={0:d}".format(nrows),
+             "\t\tUpperLeftPointMtrs=({0:f},{1:f})".format(ulx, uly),
+             "\t\tLowerRightMtrs=({0:f},{1:f})".format(lrx, lry),
+             "\t\tProjection={0:s}".format(proj_str),
+             "\t\tProjParams={0:s}".format(proj_params),
+             "\t\tSphereCode={0:s}".format(sphere_code),
+             "\t\tGridOrigin=HE5_HDFE_GD_UL",
+             "\t\tGROUP=Dimension"]
+    for i, (dname, dsize) in enumerate(dim_sizes):
+        lines += ["\t\t\tOBJECT=Dimension_{0:d}".format(i+1),
+                  "\t\t\t\tDimensionName=\"{0:s}\"".format(dname),
+                  "\t\t\t\tSize={0:d}".format(dsize),
+                  "\t\t\tEND_OBJECT=Dimension_{0:d}".format(i+1)]
+    lines += ["\t\tEND_GROUP=Dimension", "\t\tGROUP=DataField"]
+    for i, (fname, ftype, dims) in enumerate(field_defs):
+        dimlist_str = "(" + ",".join(["\"{0:s}\"".format(d) for d in dims]) + ")"
+        lines += ["\t\t\tOBJECT=DataField_{0:d}".format(i+1),
+                  "\t\t\t\tDataFieldName=\"{0:s}\"".format(fname),
+                  "\t\t\t\tDataType={0:s}".format(ftype),
+                  "\t\t\t\tDimList={0:s}".format(dimlist_str),
+                  "\t\t\t\tMaxdimList={0:s}".format(dimlist_str),
+                  comp_str.rstrip("\n"),
+                  "\t\t\tEND_OBJECT=DataField_{0:d}".format(i+1)]
+    lines += ["\t\tEND_GROUP=DataField",
+              "\t\tGROUP=MergedFields", "\t\tEND_GROUP=MergedFields",
+              "\tEND_GROUP=GRID_1",
+              "END_GROUP=GridStructure",
+              "GROUP=PointStructure", "END_GROUP=PointStructure",
+              "GROUP=ZaStructure", "END_GROUP=ZaStructure",
+              "END", ""]
+    return "\n".join([l for l in lines if len(l) > 0])
+
+def genGlobalAttributes(short_name, scale="tile"):
+    """
+    Global attributes named and typed as those of VNP43 products.
+    """
+    gattrs = [("AlgorithmType", "SCI"),
+              ("AlgorithmVersion", "NPP_PR43 1.0.0"),
+              ("DataCenter", "UMB"),
+              ("EastBoundingCoord", np.array([-92.3664], dtype=np.float64)),
+              ("WestBoundingCoord", np.array([-117.4867], dtype=np.float64)),
+              ("NorthBoundingCoord", np.array([50.0], dtype=np.float64)),
+              ("SouthBoundingCoord", np.array([40.0], dtype=np.float64)),
+              ("InputPointer", "VNP09GA.synthetic.h5,VNP09GA.synthetic.h5"),
+              ("LongName", "VIIRS/NPP BRDF/Albedo Synthetic Daily L3 Global 500m SIN Grid"),
+              ("PGEVersion", "1.0.0"),
+              ("PGE_Name", "PGE543"),
+              ("PlatformShortName", "Suomi-NPP"),
+              ("ProcessingCenter", "MODAPS-NASA"),
+              ("ProductionTime", "2017-11-05 17:13:33.000"),
+              ("RangeBeginningDate", "2017-06-29"),
+              ("RangeEndingDate", "2017-07-14"),
+              ("SatelliteInstrument", "NPP_OPS"),
+              ("SensorShortname", "VIIRS"),
+              ("ShortName", short_name),
+              ("identifier_product_doi_authority", "http://dx.doi.org")]
+    if scale != "tile":
+        gattrs = [(k, v) for k, v in gattrs if not k.endswith("BoundingCoord")]
+        gattrs += [("EastBoundingCoord", np.array([180.], dtype=np.float64)),
+                   ("WestBoundingCoord", np.array([-180.], dtype=np.float64)),
+                   ("NorthBoundingCoord", np.array([90.], dtype=np.float64)),
+                   ("SouthBoundingCoord", np.array([-90.], dtype=np.float64))]
+    return gattrs
+
+def writeSyntheticLayer(sds, fillv, valid_range, fill_fraction, rng):
+    """
+    Write a smooth field plus noise with a given fraction of fill
+    values to a dataset, one row block of the dataset chunks at a time
+    so that the memory use stays bounded at any grid scale.
+    """
+    nrows, ncols = sds.shape[0], sds.shape[1]
+    nblk = sds.chunks[0] if sds.chunks is not None else min(nrows, 512)
+    vmin, vmax = valid_range[0], min(valid_range[1], 1000)
+
+    xx = np.linspace(0, 4*np.pi, ncols)
+    for r0 in range(0, nrows, nblk):
+        r1 = min(r0+nblk, nrows)
+        yy = np.linspace(r0, r1-1, r1-r0)[:, np.newaxis] / float(nrows) * 4*np.pi
+        base = 0.5 * (np.sin(xx)[np.newaxis, :] * np.cos(yy) + 1)
+        if sds.ndim == 3:
+            base = np.dstack([base * (1. / (k+1)) for k in range(sds.shape[2])])
+        data = vmin + (vmax - vmin) * base + rng.normal(scale=0.02*(vmax - vmin), size=base.shape)
+        data = np.clip(data, vmin, vmax)
+        if np.issubdtype(sds.dtype, np.integer):
+            data = np.round(data)
+        fillflag = rng.uniform(size=(r1-r0, ncols)) < fill_fraction
+        data = data.astype(sds.dtype)
+        data[fillflag] = fillv
+        sds[r0:r1, ...] = data
+
+def genSyntheticFile(outfile, nrows, ncols, grid_name="VIIRS_Grid_BRDF",
+                     bands=("M1",), layers=("params", "bsa", "wsa", "qa"),
+                     dtype=None, chunk=None, compression="gzip", compression_opts=4,
+                     fill_fraction=0.3, seed=0, scale="tile", tile="h12v04"):
+    rng = np.random.RandomState(seed)
+
+    if chunk is None:
+        chunk = (min(max(nrows//4, 1), 1200), min(max(ncols//4, 1), 1200))
+    comp_kwargs = {}
+    if compression == "gzip":
+        comp_kwargs = dict(compression="gzip", compression_opts=compression_opts, shuffle=True)
+    elif compression == "lzf":
+        comp_kwargs = dict(compression="lzf", shuffle=True)
+
+    h5_native_types = {"int8":"H5T_NATIVE_SCHAR", "uint8":"H5T_NATIVE_UCHAR",
+                       "int16":"H5T_NATIVE_SHORT", "uint16":"H5T_NATIVE_USHORT",
+                       "int32":"H5T_NATIVE_INT", "uint32":"H5T_NATIVE_UINT",
+                       "float32":"H5T_NATIVE_FLOAT", "float64":"H5T_NATIVE_DOUBLE"}
+
+    field_defs = []
+    with h5py.File(outfile, "w") as fobj:
+        dfgrp = fobj.create_group("HDFEOS/GRIDS/{0:s}/Data Fields".format(grid_name))
+        fobj.create_group("HDFEOS/ADDITIONAL/FILE_ATTRIBUTES")
+
+        for band in bands:
+            for ly in layers:
+                prefix, ly_dtype, fillv, scale_factor, npar, valid_range, long_name = LAYER_DEFS[ly]
+                if dtype is not None and ly != "qa":
+                    ly_dtype = dtype
+                    if np.issubdtype(np.dtype(ly_dtype), np.integer):
+                        fillv = np.iinfo(np.dtype(ly_dtype)).max
+                    else:
+                        fillv = 32767.
+                dsname = "{0:s}_{1:s}".format(prefix, band)
+                if npar is None:
+                    shape, chunks, dims = (nrows, ncols), chunk, ["YDim", "XDim"]
+                else:
+                    shape, chunks, dims = (nrows, ncols, npar), chunk+(npar,), ["YDim", "XDim", "Num_Parameters"]
+                sds = dfgrp.create_dataset(dsname, shape=shape, dtype=ly_dtype, chunks=chunks,
+                                           fillvalue=fillv, **comp_kwargs)
+                sds.attrs["_FillValue"] = np.array([fillv], dtype=ly_dtype)
+                sds.attrs["scale_factor"] = np.array([scale_factor], dtype=np.float64)
+                sds.attrs["add_offset"] = np.array([0.], dtype=np.float64)
+                sds.attrs["valid_range"] = np.array(valid_range, dtype=ly_dtype)
+                sds.attrs["long_name"] = long_name
+                sds.attrs["units"] = "reflectance, no units" if ly != "qa" else "concatenated flags"
+                sds.attrs["Description"] = "Synthetic {0:s} of band {1:s}".format(long_name, band)
+
+                sys.stdout.write("Writing {0:s} ... ".format(dsname))
+                sys.stdout.flush()
+                if ly == "qa":
+                    writeSyntheticLayer(sds, fillv, (0, 1), fill_fraction, rng)
+                else:
+                    writeSyntheticLayer(sds, fillv, valid_range, fill_fraction, rng)
+                sys.stdout.write("\r")
+
+                field_defs.append((dsname, h5_native_types[np.dtype(ly_dtype).name], dims))
+
+        for k, v in genGlobalAttributes("VNP43SYN", scale=scale):
+            fobj.attrs[k] = v
+        fobj.attrs["HDFEOSVersion"] = "HDFEOS_5.1.15"
+
+        struct_meta_str = genStructMetadata(grid_name, nrows, ncols, field_defs,
+                                            scale=scale, tile=tile,
+                                            compression=compression, compression_opts=compression_opts)
+        fobj.create_dataset("HDFEOS INFORMATION/StructMetadata.0", data=np.string_(struct_meta_str))
+
+    return
+
+def main(cmdargs):
+    if cmdargs.size is None:
+        nrows, ncols = GRID_SCALES[cmdargs.scale]
+    else:
+        nrows, ncols = cmdargs.size
+    chunk = None if cmdargs.chunk is None else tuple(cmdargs.chunk)
+
+    print colorLogStr("Generate synthetic {0:d}x{1:d} grid to ".format(nrows, ncols)) + colorDimStr(cmdargs.outfile)
+    genSyntheticFile(cmdargs.outfile, nrows, ncols, grid_name=cmdargs.grid_name,
+                     bands=cmdargs.bands, layers=cmdargs.layers, dtype=cmdargs.dtype,
+                     chunk=chunk, compression=cmdargs.compression,
+                     compression_opts=cmdargs.compression_opts,
+                     fill_fraction=cmdargs.fill_fraction, seed=cmdargs.seed,
+                     scale=cmdargs.scale, tile=cmdargs.tile)
+    print colorResetStr("")
+
+    return
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
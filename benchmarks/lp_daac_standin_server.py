@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# A local HTTP stand-in of the LP DAAC data pool to run the downloader
+# offline: serves directory listings, range requests for resumed
+# downloads, optional basic authentication and injected failures. It
+# can also populate a directory tree of fake granules with .xml
+# metadata carrying CKSUM checksums as on LP DAAC.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import sys
+import argparse
+import base64
+import datetime
+import random
+import subprocess
+import urllib
+import BaseHTTPServer
+import SocketServer
+
+import colorama
+colorama.init(autoreset=True)
+# define some color schemes for message output control
+colorWarnStr = lambda msg: colorama.Fore.YELLOW + str(msg) + colorama.Style.RESET_ALL
+colorErrorStr = lambda msg: colorama.Fore.RED + str(msg) + colorama.Style.RESET_ALL
+colorInfoStr = lambda msg: colorama.Fore.GREEN + str(msg) + colorama.Style.RESET_ALL
+colorDimStr = lambda msg: colorama.Style.DIM + str(msg) + colorama.Style.RESET_ALL
+colorLogStr = lambda msg: str(msg)
+colorResetStr = lambda msg: colorama.Style.RESET_ALL + str(msg)
+
+GRANULE_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<GranuleMetaDataFile>
+  <GranuleURMetaData>
+    <DataFiles>
+      <DataFileContainer>
+        <DistributedFileName>{fname:s}</DistributedFileName>
+        <FileSize>{size:d}</FileSize>
+        <ChecksumType>CKSUM</ChecksumType>
+        <Checksum>{cksum:s}</Checksum>
+      </DataFileContainer>
+    </DataFiles>
+  </GranuleURMetaData>
+</GranuleMetaDataFile>
+"""
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Serve a directory tree as a local stand-in of the LP DAAC data pool.")
+
+    p.add_argument("--root", dest="root", required=True, default=None, help="Root directory to serve.")
+    p.add_argument("--port", dest="port", type=int, required=False, default=8000, help="Port to listen on. Default: 8000.")
+    p.add_argument("--user", dest="user", required=False, default=None, help="If given with --password, require basic authentication.")
+    p.add_argument("--password", dest="password", required=False, default=None, help="Password of basic authentication.")
+    p.add_argument("--fail_rate", dest="fail_rate", type=float, required=False, default=0., help="Fraction of requests to fail, half with an HTTP 503 and half by cutting a file transfer midway. Default: 0.")
+
+    p.add_argument("--populate", dest="populate", required=False, action="store_true", help="If set, populate the root directory with fake granules and exit, without serving.")
+    p.add_argument("--par", dest="par", required=False, default="MCD43A1", help="Product short name of fake granules. Default: MCD43A1.")
+    p.add_argument("--num", dest="num", type=int, required=False, default=6, help="Collection number of fake granules. Default: 6.")
+    p.add_argument("--year", dest="year", type=int, required=False, default=2018, help="Year of fake granules. Default: 2018.")
+    p.add_argument("--doys", dest="doys", nargs=2, type=int, required=False, default=(1, 10), metavar=("BEGIN", "END"), help="Range of days of year of fake granules. Default: 1 10.")
+    p.add_argument("--tiles", dest="tiles", nargs="+", required=False, default=["h12v04", "h12v05"], help="Tiles of fake granules. Default: h12v04 h12v05.")
+    p.add_argument("--fmt", dest="fmt", required=False, default="h5", help="Extension of fake granules. Default: h5.")
+    p.add_argument("--size", dest="size", type=float, required=False, default=4, help="Size of each fake granule in MB. Default: 4.")
+
+    cmdargs = p.parse_args()
+
+    if (cmdargs.user is None) != (cmdargs.password is None):
+        raise RuntimeError(colorErrorStr("--user and --password must be given together."))
+    return cmdargs
+
+def populate(root, par, num, year, doys, tiles, fmt, size_mb):
+    """
+    Create fake granules of random bytes and their .xml metadata under
+    <root>/<par>.<num>/<YYYY.MM.DD>/.
+    """
+    nbytes = int(size_mb * 1e6)
+    nfiles = 0
+    for doy in range(doys[0], doys[1]+1):
+        date = datetime.date(year, 1, 1) + datetime.timedelta(days=doy-1)
+        ddir = os.path.join(root, "{0:s}.{1:03d}".format(par, num), date.strftime("%Y.%m.%d"))
+        if not os.path.isdir(ddir):
+            os.makedirs(ddir)
+        for tile in tiles:
+            fname = "{0:s}.A{1:d}{2:03d}.{3:s}.{4:03d}.{1:d}{5:03d}000000.{6:s}".format(par, year, doy, tile, num, doy+9, fmt)
+            fpath = os.path.join(ddir, fname)
+            with open(fpath, "wb") as fobj:
+                fobj.write(os.urandom(nbytes))
+            cksum = subprocess.check_output(["cksum", fpath]).split()[0]
+            with open(fpath + ".xml", "w") as fobj:
+                fobj.write(GRANULE_XML.format(fname=fname, size=nbytes, cksum=cksum))
+            nfiles += 1
+    return nfiles
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    root = None
+    auth = None
+    fail_rate = 0.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.auth is not None and self.headers.get("Authorization", None) != self.auth:
+            self.send_response(401)
+            self.send_header("WWW-Authenticate", "Basic realm=\"standin\"")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        fail = random.random() < self.fail_rate
+        if fail and random.random() < 0.5:
+            self.send_error(503)
+            return
+
+        path = os.path.join(self.root, urllib.unquote(self.path.split("?")[0]).lstrip("/"))
+        if os.path.isdir(path):
+            self._sendListing(path)
+        elif os.path.isfile(path):
+            self._sendFile(path, cut=fail)
+        else:
+            self.send_error(404)
+
+    def _sendListing(self, path):
+        names = sorted(os.listdir(path))
+        body = "<html><body>\n" + "".join(["<a href=\"{0:s}{1:s}\">{0:s}{1:s}</a>\n".format(n, "/" if os.path.isdir(os.path.join(path, n)) else "") for n in names]) + "</body></html>\n"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _sendFile(self, path, cut=False):
+        size = os.path.getsize(path)
+        start = 0
+        rng = self.headers.get("Range", None)
+        if rng is not None and rng.startswith("bytes="):
+            start = int(rng[len("bytes="):].split("-")[0])
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{0:d}".format(size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0:d}-{1:d}/{2:d}".format(start, size-1, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size-start))
+        self.end_headers()
+
+        # send only part of the file and drop the connection to mimic
+        # an interrupted transfer.
+        nsend = (size-start)//2 if cut else size-start
+        with open(path, "rb") as fobj:
+            fobj.seek(start)
+            while nsend > 0:
+                blk = fobj.read(min(2**16, nsend))
+                if len(blk) == 0:
+                    break
+                self.wfile.write(blk)
+                nsend -= len(blk)
+        if cut:
+            self.close_connection = 1
+
+    def log_message(self, fmt, *args):
+        sys.stderr.write(colorDimStr("{0:s} - {1:s}\n".format(self.address_string(), fmt % args)))
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def main(cmdargs):
+    if cmdargs.populate:
+        nfiles = populate(cmdargs.root, cmdargs.par, cmdargs.num, cmdargs.year, cmdargs.doys,
+                          cmdargs.tiles, cmdargs.fmt, cmdargs.size)
+        print colorInfoStr("Populated {0:d} fake granules under ".format(nfiles)) + colorDimStr(cmdargs.root)
+        return
+
+    StandinHandler.root = os.path.abspath(cmdargs.root)
+    StandinHandler.fail_rate = cmdargs.fail_rate
+    if cmdargs.user is not None:
+        StandinHandler.auth = "Basic " + base64.b64encode("{0:s}:{1:s}".format(cmdargs.user, cmdargs.password))
+    server = ThreadingHTTPServer(("127.0.0.1", cmdargs.port), StandinHandler)
+    print colorInfoStr("Serve {0:s} at ".format(StandinHandler.root)) + colorDimStr("http://127.0.0.1:{0:d}/".format(cmdargs.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+# Calculate blue-sky albedo from the BRDF_Albedo_Parameters of a
+# MCD43/VNP43 HDF5 file, as the weighted sum of black-sky albedo (BSA)
+# and white-sky albedo (WSA) by the fraction of diffuse skylight (SKYL)
+# looked up from data/skyl_lut.dat, i.e. the same model as
+# actual-albedo-tool but vectorized and chunked over whole tiles and
+# CMGs.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import sys
+import argparse
+import hashlib
+import tempfile
+import warnings
+
+import h5py
+import numpy as np
+
+import colorama
+colorama.init(autoreset=True)
+# define some color schemes for message output control
+colorWarnStr = lambda msg: colorama.Fore.YELLOW + str(msg) + colorama.Style.RESET_ALL
+colorErrorStr = lambda msg: colorama.Fore.RED + str(msg) + colorama.Style.RESET_ALL
+colorInfoStr = lambda msg: colorama.Fore.GREEN + str(msg) + colorama.Style.RESET_ALL
+colorDimStr = lambda msg: colorama.Style.DIM + str(msg) + colorama.Style.RESET_ALL
+colorLogStr = lambda msg: str(msg)
+colorResetStr = lambda msg: colorama.Style.RESET_ALL + str(msg)
+
+from mvp_h5_utils import findDataset, getFillValue
+
+DEFAULT_LUT_FILE = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "skyl_lut.dat"))
+
+# Dimensions of the SKYL LUT: aerosol types, bands, solar zenith
+# angles (0-89 degrees, 1 degree step), optical depths (0-0.98, 0.02
+# step).
+SKYL_LUT_SHAPE = (2, 10, 90, 50)
+SKYL_OD_STEP = 0.02
+AEROSOL_TYPES = {"continental":0, "maritime":1}
+
+# Band order of the SKYL LUT:
+#     0: 0.620-0.670  (red)
+#     1: 0.841-0.876  (nir)
+#     2: 0.459-0.479
+#     3: 0.545-0.565
+#     4: 1.230-1.250
+#     5: 1.628-1.652
+#     6: 2.105-2.155
+# BB  7: 0.400-0.700  (vis)
+# BB  8: 0.700-4.000  (nir)
+# BB  9: 0.250-4.000  (sw)
+# VIIRS bands are mapped to the MODIS band of the closest wavelength,
+# the same pairs as in compare_mv_products.sh. M1 and M2 have no MODIS
+# counterpart in the LUT and use the closest one, 0.459-0.479.
+LUT_BAND_INDEX = {"Band1":0, "Band2":1, "Band3":2, "Band4":3, "Band5":4, "Band6":5, "Band7":6,
+                  "vis":7, "nir":8, "shortwave":9,
+                  "M1":2, "M2":2, "M3":2, "M4":3, "M5":0, "M7":1, "M8":4, "M10":5, "M11":6,
+                  "I1":0, "I2":1, "I3":5}
+
+# Polynomial coefficients of BSA, rows: G0, G1 for SZA^2, G2 for
+# SZA^3 (SZA in radians); columns: iso, vol, geo.
+BSA_POLY_COEF = np.array([[1.0, -0.007574, -1.284909],
+                          [0.0, -0.070987, -0.166314],
+                          [0.0, 0.307588, 0.041840]])
+# Weights of iso, vol and geo for WSA.
+WSA_WEIGHT = np.array([1.0, 0.189184, -1.377622])
+
+PAR_PREFIX = "BRDF_Albedo_Parameters_"
+OUT_PREFIX = {"blue":"Albedo_Blue_Sky_", "bsa":"Albedo_BSA_", "wsa":"Albedo_WSA_"}
+OUT_LONG_NAME = {"blue":"blue_sky_albedo", "bsa":"black_sky_albedo", "wsa":"white_sky_albedo"}
+OUT_FILLV = 32767
+OUT_SCALE = 0.001
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Calculate blue-sky albedo from the BRDF_Albedo_Parameters of an MCD43/VNP43 HDF5 file with the SKYL lookup table.")
+
+    p.add_argument("--h5f", dest="infile", required=True, default=None, help="Input HDF5 file of BRDF_Albedo_Parameters, e.g. MCD43A1 or VNP43MA1.")
+    p.add_argument("--bands", dest="bands", nargs="+", required=True, default=None, help="Band names as the suffixes of the BRDF_Albedo_Parameters datasets, e.g. Band1 vis shortwave, or M5 M7 I1.")
+    p.add_argument("--lut_bands", dest="lut_bands", nargs="+", type=int, required=False, default=None, help="Index to the SKYL LUT band, 0-9, for each input band. Default: the closest LUT band of each band name, see LUT_BAND_INDEX.")
+    p.add_argument("--of", dest="outfile", required=True, default=None, help="Output HDF5 file of blue-sky albedo.")
+
+    p.add_argument("--sza", dest="sza", type=float, required=False, default=None, help="Solar zenith angle in degrees, 0-89, for all pixels.")
+    p.add_argument("--sza_h5f", dest="sza_h5f", required=False, default=None, help="HDF5 file of a per-pixel solar zenith angle dataset on the same grid, overriding --sza.")
+    p.add_argument("--sza_dataset", dest="sza_dataset", required=False, default=None, help="Name of the per-pixel solar zenith angle dataset in --sza_h5f, in degrees after applying its scale_factor attribute if any.")
+    p.add_argument("--aod", dest="aod", type=float, required=False, default=None, help="Aerosol optical depth, 0-1, for all pixels.")
+    p.add_argument("--aod_h5f", dest="aod_h5f", required=False, default=None, help="HDF5 file of a per-pixel aerosol optical depth dataset on the same grid, overriding --aod.")
+    p.add_argument("--aod_dataset", dest="aod_dataset", required=False, default=None, help="Name of the per-pixel aerosol optical depth dataset in --aod_h5f, after applying its scale_factor attribute if any.")
+    p.add_argument("--aerosol", dest="aerosol", required=False, default="continental", choices=sorted(AEROSOL_TYPES.keys()), help="Aerosol type of the SKYL LUT. Default: continental.")
+
+    p.add_argument("--lut", dest="lut_file", required=False, default=DEFAULT_LUT_FILE, help="SKYL LUT file. Default: data/skyl_lut.dat of this toolbox.")
+    p.add_argument("--lut_cache_dir", dest="lut_cache_dir", required=False, default=tempfile.gettempdir(), help="Directory of the binary copy of the parsed SKYL LUT, reused as long as the LUT file is unchanged. Default: the system temporary directory.")
+
+    p.add_argument("--bsa_wsa", dest="bsa_wsa", required=False, action="store_true", help="If set, also output BSA and WSA at the given solar zenith angles.")
+    p.add_argument("--chunk", dest="chunk", nargs=2, type=int, required=False, default=None, metavar=("ROWS", "COLS"), help="Chunk shape of output datasets. Default: the chunk shape of the input, or 240 240 if the input is not chunked.")
+    p.add_argument("--compression", dest="compression", required=False, default="gzip", choices=["gzip", "lzf", "none"], help="Compression filter of output datasets. Default: gzip.")
+    p.add_argument("--compression_opts", dest="compression_opts", type=int, required=False, default=4, help="Compression level for gzip. Default: 4.")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.lut_bands is None:
+        unknown = [b for b in cmdargs.bands if b not in LUT_BAND_INDEX]
+        if len(unknown) > 0:
+            raise RuntimeError(colorErrorStr("No default SKYL LUT band for {0:s}, give --lut_bands.".format(", ".join(unknown))))
+        cmdargs.lut_bands = [LUT_BAND_INDEX[b] for b in cmdargs.bands]
+    if len(cmdargs.lut_bands) != len(cmdargs.bands):
+        raise RuntimeError(colorErrorStr("Numbers of bands and LUT band indexes must be equal and one to one."))
+    if np.any([(lb < 0) or (lb >= SKYL_LUT_SHAPE[1]) for lb in cmdargs.lut_bands]):
+        raise RuntimeError(colorErrorStr("SKYL LUT band indexes must be 0-{0:d}.".format(SKYL_LUT_SHAPE[1]-1)))
+
+    if (cmdargs.sza_h5f is None) != (cmdargs.sza_dataset is None):
+        raise RuntimeError(colorErrorStr("--sza_h5f and --sza_dataset must be given together."))
+    if (cmdargs.aod_h5f is None) != (cmdargs.aod_dataset is None):
+        raise RuntimeError(colorErrorStr("--aod_h5f and --aod_dataset must be given together."))
+    if cmdargs.sza is None and cmdargs.sza_h5f is None:
+        raise RuntimeError(colorErrorStr("Either --sza or --sza_h5f/--sza_dataset must be given."))
+    if cmdargs.aod is None and cmdargs.aod_h5f is None:
+        raise RuntimeError(colorErrorStr("Either --aod or --aod_h5f/--aod_dataset must be given."))
+
+    if cmdargs.compression == "none":
+        cmdargs.compression = None
+
+    return cmdargs
+
+def readSkylLut(lut_file):
+    """
+    Parse a SKYL LUT text file into a float32 array of [aerosol type,
+    band, solar zenith, optical depth], in the same token order as
+    read_skyl_table() of actual-albedo-tool.
+    """
+    with open(lut_file, "r") as fobj:
+        tokens = fobj.read().split()
+    naero, nband, nszn, nod = SKYL_LUT_SHAPE
+    # per aerosol type: a label of 2 tokens; per band: a label of 2
+    # tokens, a header row of 1+nod tokens and nszn rows of 1+nod
+    # tokens with the leading solar zenith.
+    ntokens = naero * (2 + nband * (2 + (1+nod) + nszn*(1+nod)))
+    if len(tokens) < ntokens:
+        raise RuntimeError(colorErrorStr("SKYL LUT file {0:s} is truncated, {1:d} values less than expected.".format(lut_file, ntokens-len(tokens))))
+
+    lut = np.zeros(SKYL_LUT_SHAPE, dtype=np.float32)
+    pos = 0
+    for aerosol in range(naero):
+        pos += 2
+        for band in range(nband):
+            pos += 2 + (1+nod)
+            blk = np.array(tokens[pos:pos+nszn*(1+nod)], dtype=np.float32).reshape(nszn, 1+nod)
+            lut[aerosol, band, :, :] = blk[:, 1:]
+            pos += nszn*(1+nod)
+    return lut
+
+def loadSkylLut(lut_file, cache_dir=None):
+    """
+    Load the SKYL LUT, from its binary copy in cache_dir if the text
+    file is unchanged since the copy was made, otherwise parse the text
+    file and save a new binary copy.
+    """
+    if cache_dir is None:
+        return readSkylLut(lut_file)
+
+    st = os.stat(lut_file)
+    lut_id = "{0:s}:{1:d}:{2:f}".format(os.path.realpath(lut_file), st.st_size, st.st_mtime)
+    cache_file = os.path.join(cache_dir, "skyl_lut_{0:s}.npy".format(hashlib.sha1(lut_id.encode("utf-8")).hexdigest()[0:16]))
+    if os.path.isfile(cache_file):
+        try:
+            lut = np.load(cache_file)
+            if lut.shape == SKYL_LUT_SHAPE:
+                return lut
+        except (IOError, ValueError):
+            pass
+
+    lut = readSkylLut(lut_file)
+    # Write to a temporary file and then rename it, so concurrent runs
+    # never load a partial copy.
+    try:
+        fd, tmpfile = tempfile.mkstemp(prefix=".tmp_skyl_lut_", suffix=".npy", dir=cache_dir)
+        with os.fdopen(fd, "wb") as fobj:
+            np.save(fobj, lut)
+        os.rename(tmpfile, cache_file)
+    except (IOError, OSError) as e:
+        warnings.warn(colorWarnStr("Failed to save a binary copy of the SKYL LUT to {0:s}: {1:s}".format(cache_dir, str(e))), RuntimeWarning)
+    return lut
+
+def getScaleOffset(sds, default_scale=1., default_offset=0.):
+    scale = sds.attrs["scale_factor"] if "scale_factor" in sds.attrs.keys() else default_scale
+    offset = sds.attrs["add_offset"] if "add_offset" in sds.attrs.keys() else default_offset
+    scale = scale if np.isscalar(scale) else scale[0]
+    offset = offset if np.isscalar(offset) else offset[0]
+    return float(scale), float(offset)
+
+def calcBsa(par, sza):
+    """
+    BSA from BRDF parameters of [..., iso/vol/geo] at solar zenith
+    angles in degrees, a scalar or an array of the shape of par[..., 0].
+    """
+    szn = np.deg2rad(np.asarray(sza, dtype=np.float64))[..., np.newaxis]
+    bsa_weight = BSA_POLY_COEF[0] + BSA_POLY_COEF[1]*szn**2 + BSA_POLY_COEF[2]*szn**3
+    return np.sum(par*bsa_weight, axis=-1)
+
+def calcWsa(par):
+    return np.dot(par, WSA_WEIGHT)
+
+def lookupSkyl(lut_band, sza, aod):
+    """
+    Look up SKYL of a LUT band, [solar zenith, optical depth], at
+    solar zenith angles in degrees and optical depths, rounded to the
+    nearest LUT nodes as get_skyl() of actual-albedo-tool.
+    """
+    szn_idx = np.clip((np.asarray(sza) + 0.5).astype(int), 0, lut_band.shape[0]-1)
+    od_idx = np.clip((np.asarray(aod)/SKYL_OD_STEP + 0.5).astype(int), 0, lut_band.shape[1]-1)
+    return lut_band[szn_idx, od_idx]
+
+def calcBlueSkyAlbedo(bsa, wsa, skyl):
+    return np.clip(wsa*skyl + bsa*(1.-skyl), 0., 1.)
+
+class AuxLayer(object):
+    """
+    A per-pixel input of solar zenith angle or optical depth, either a
+    constant or a dataset read in the same row blocks as the BRDF
+    parameters.
+    """
+    def __init__(self, label, const=None, h5f=None, dataset=None):
+        self.label = label
+        self.const = const
+        self.fobj = None
+        self.sds = None
+        if h5f is not None:
+            self.fobj = h5py.File(h5f, "r")
+            dsname = findDataset(self.fobj, dataset, exact=True)
+            if dsname is None:
+                raise RuntimeError(colorErrorStr("Dataset name {0:s} NOT found in {1:s}".format(dataset, h5f)))
+            self.sds = self.fobj[dsname]
+            self.fillv = getFillValue(self.sds)
+            self.scale, self.offset = getScaleOffset(self.sds)
+
+    def check(self, shape):
+        if self.sds is not None and tuple(self.sds.shape[0:2]) != tuple(shape[0:2]):
+            raise RuntimeError(colorErrorStr("The {0:s} dataset {1:s} does not have the same grid size as the BRDF parameters.".format(self.label, self.sds.name)))
+
+    def read(self, r0, r1):
+        """
+        Return the values and a mask of valid values in rows r0-r1, or
+        the constant and None.
+        """
+        if self.sds is None:
+            return self.const, None
+        data = self.sds[r0:r1, ...]
+        valid = np.ones(data.shape, dtype=np.bool_) if self.fillv is None else (data != self.fillv)
+        return (data.astype(np.float64) - self.offset)*self.scale, valid
+
+    def attrValue(self):
+        return self.const if self.sds is None else "{0:s}:{1:s}".format(self.sds.file.filename, self.sds.name)
+
+    def close(self):
+        if self.fobj is not None:
+            self.fobj.close()
+
+def main(cmdargs):
+    infile = cmdargs.infile
+    bands = cmdargs.bands
+    lut_bands = cmdargs.lut_bands
+    outfile = cmdargs.outfile
+    aerosol = AEROSOL_TYPES[cmdargs.aerosol]
+    out_layers = ["blue", "bsa", "wsa"] if cmdargs.bsa_wsa else ["blue"]
+    mem_size = 50e6 # in unit of byte, 50MB memory per band
+
+    print colorLogStr("Load SKYL LUT ") + colorDimStr(cmdargs.lut_file)
+    skyl_lut = loadSkylLut(cmdargs.lut_file, cmdargs.lut_cache_dir)
+
+    sza_layer = AuxLayer("solar zenith angle", cmdargs.sza, cmdargs.sza_h5f, cmdargs.sza_dataset)
+    aod_layer = AuxLayer("optical depth", cmdargs.aod, cmdargs.aod_h5f, cmdargs.aod_dataset)
+
+    fobj = h5py.File(infile, "r")
+    dsname_list = [findDataset(fobj, PAR_PREFIX+b, exact=True) for b in bands]
+    dsname_found = True
+    for b, dsname in zip(bands, dsname_list):
+        if dsname is None:
+            print colorErrorStr("Dataset name {0:s} NOT found in {1:s}".format(PAR_PREFIX+b, infile))
+            dsname_found = False
+    if not dsname_found:
+        raise RuntimeError(colorErrorStr("Incorrect band name!"))
+
+    sds_list = [fobj[dsname] for dsname in dsname_list]
+    for sds in sds_list:
+        if sds.ndim != 3 or sds.shape[2] != 3:
+            raise RuntimeError(colorErrorStr("{0:s} is not a dataset of 3 BRDF parameters per pixel!".format(sds.name)))
+        if sds.shape != sds_list[0].shape:
+            raise RuntimeError(colorErrorStr("Input datasets must have the same dimension!"))
+    nrows, ncols = sds_list[0].shape[0:2]
+    sza_layer.check(sds_list[0].shape)
+    aod_layer.check(sds_list[0].shape)
+
+    if cmdargs.chunk is not None:
+        out_chunk = (min(cmdargs.chunk[0], nrows), min(cmdargs.chunk[1], ncols))
+    elif sds_list[0].chunks is not None:
+        out_chunk = tuple(sds_list[0].chunks[0:2])
+    else:
+        out_chunk = (min(240, nrows), min(240, ncols))
+
+    # Row blocks of about mem_size of float64 temporaries, aligned to
+    # the input chunks so that each chunk is decompressed only once.
+    blk_nrows = max(1, int(mem_size / (ncols*3*np.dtype(np.float64).itemsize*4)))
+    in_chunk_nrows = sds_list[0].chunks[0] if sds_list[0].chunks is not None else 1
+    if blk_nrows > in_chunk_nrows:
+        blk_nrows = (blk_nrows // in_chunk_nrows) * in_chunk_nrows
+    nblks = int(np.ceil(nrows / float(blk_nrows)))
+
+    print colorLogStr("Write blue-sky albedo to ") + colorDimStr(outfile)
+    with h5py.File(outfile, "w") as ofobj:
+        ofobj.attrs["InputFile"] = os.path.basename(infile)
+        ofobj.attrs["SKYL_LUT"] = os.path.basename(cmdargs.lut_file)
+        ofobj.attrs["AerosolType"] = cmdargs.aerosol
+        ofobj.attrs["SolarZenith"] = sza_layer.attrValue()
+        ofobj.attrs["OpticalDepth"] = aod_layer.attrValue()
+
+        for ib, (b, lb, sds) in enumerate(zip(bands, lut_bands, sds_list)):
+            par_fillv = getFillValue(sds)
+            par_scale, par_offset = getScaleOffset(sds, default_scale=0.001)
+            lut_band = skyl_lut[aerosol, lb, :, :]
+
+            # keep the group path of the input, e.g. HDFEOS/GRIDS/<grid>/Data Fields
+            grp = ofobj.require_group(os.path.dirname(sds.name))
+            out_sds = {}
+            for ly in out_layers:
+                out_sds[ly] = grp.create_dataset(OUT_PREFIX[ly]+b, shape=(nrows, ncols), dtype=np.int16,
+                                                 chunks=out_chunk, compression=cmdargs.compression,
+                                                 compression_opts=cmdargs.compression_opts if cmdargs.compression == "gzip" else None,
+                                                 fillvalue=OUT_FILLV)
+                out_sds[ly].attrs["_FillValue"] = np.array([OUT_FILLV], dtype=np.int16)
+                out_sds[ly].attrs["scale_factor"] = np.array([OUT_SCALE], dtype=np.float64)
+                out_sds[ly].attrs["add_offset"] = np.array([0.], dtype=np.float64)
+                out_sds[ly].attrs["valid_range"] = np.array([0, int(1/OUT_SCALE)], dtype=np.int16)
+                out_sds[ly].attrs["long_name"] = OUT_LONG_NAME[ly]
+                out_sds[ly].attrs["units"] = "reflectance, no units"
+                out_sds[ly].attrs["SKYL_LUT_Band"] = lb
+
+            for iblk in range(nblks):
+                r0 = iblk*blk_nrows
+                r1 = min(r0+blk_nrows, nrows)
+                par_raw = sds[r0:r1, :, :]
+                valid = np.ones(par_raw.shape[0:2], dtype=np.bool_) if par_fillv is None else np.all(par_raw != par_fillv, axis=2)
+                par = (par_raw.astype(np.float64) - par_offset)*par_scale
+
+                sza, sza_valid = sza_layer.read(r0, r1)
+                aod, aod_valid = aod_layer.read(r0, r1)
+                if sza_valid is not None:
+                    valid = np.logical_and(valid, sza_valid)
+                if aod_valid is not None:
+                    valid = np.logical_and(valid, aod_valid)
+
+                out = {}
+                out["bsa"] = calcBsa(par, sza)
+                out["wsa"] = calcWsa(par)
+                out["blue"] = calcBlueSkyAlbedo(out["bsa"], out["wsa"], lookupSkyl(lut_band, sza, aod))
+                for ly in out_layers:
+                    # clip BSA and WSA as blue-sky albedo to the valid_range
+                    out_sds[ly][r0:r1, :] = np.where(valid, np.clip(np.round(out[ly]/OUT_SCALE), 0, int(1/OUT_SCALE)), OUT_FILLV).astype(np.int16)
+
+                sys.stdout.write("Band {0:s}: processed {1:d}/{2:d} row blocks\r".format(b, iblk+1, nblks))
+                sys.stdout.flush()
+            sys.stdout.write("\n")
+
+    fobj.close()
+    sza_layer.close()
+    aod_layer.close()
+    print colorInfoStr("Finished blue-sky albedo of {0:d} bands".format(len(bands)))
+    print colorResetStr("")
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+# Calculate per-pixel temporal statistics of a dataset over a
+# date-ordered stack of daily MCD43/VNP43 HDF5 granules of the same
+# tile: mean, standard deviation, min, max and number of valid
+# observations, and the same for the lag-1 differences between
+# consecutive valid observations. The stack is streamed window by
+# window and granule by granule so that only one time slice of a
+# window is held in memory at a time, regardless of the number of
+# granules.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import sys
+import argparse
+import re
+import warnings
+
+import h5py
+import numpy as np
+
+import colorama
+colorama.init(autoreset=True)
+# define some color schemes for message output control
+colorWarnStr = lambda msg: colorama.Fore.YELLOW + str(msg) + colorama.Style.RESET_ALL
+colorErrorStr = lambda msg: colorama.Fore.RED + str(msg) + colorama.Style.RESET_ALL
+colorInfoStr = lambda msg: colorama.Fore.GREEN + str(msg) + colorama.Style.RESET_ALL
+colorDimStr = lambda msg: colorama.Style.DIM + str(msg) + colorama.Style.RESET_ALL
+colorLogStr = lambda msg: str(msg)
+colorResetStr = lambda msg: colorama.Style.RESET_ALL + str(msg)
+
+from mvp_h5_utils import findDataset, getFillValues, windowSize, iterWindows, readWindow
+
+# acquisition date in granule names, e.g. VNP43MA3.A2018005.h12v04...
+DATE_RE = re.compile(r"\.A(\d{7})\.")
+
+OUT_FILLV = -999.
+# output statistics: (suffix, dtype, long name)
+OUT_STATS = [("Mean", np.float32, "temporal mean"),
+             ("Std", np.float32, "temporal standard deviation"),
+             ("Min", np.float32, "temporal minimum"),
+             ("Max", np.float32, "temporal maximum"),
+             ("Count", np.uint16, "number of valid observations"),
+             ("Diff_Mean", np.float32, "mean of lag-1 differences between consecutive valid observations"),
+             ("Diff_Std", np.float32, "standard deviation of lag-1 differences between consecutive valid observations"),
+             ("Diff_Abs_Mean", np.float32, "mean absolute lag-1 difference between consecutive valid observations"),
+             ("Diff_Count", np.uint16, "number of lag-1 differences between consecutive valid observations")]
+# bytes per pixel of the accumulators of a window and one time slice
+# in float64, for the window size from the memory limit.
+ACC_NBYTES = 12*np.dtype(np.float64).itemsize
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Calculate per-pixel temporal statistics of a dataset over a date-ordered stack of daily granules.")
+
+    p.add_argument("--h5f", dest="infiles", nargs="+", required=False, default=None, help="Input HDF5 files of the same tile in date order.")
+    p.add_argument("--file_list", dest="file_list", required=False, default=None, help="Text file of input HDF5 files, one per line in date order, instead of --h5f.")
+    p.add_argument("--dataset", dest="dataset", required=True, default=None, help="Name of the dataset to calculate statistics of.")
+    p.add_argument("--band", dest="band", type=int, required=False, default=1, help="Band index starting from 1 if the dataset is 3D. Default: 1.")
+    p.add_argument("--scale_factor", dest="scale_factor", type=float, required=False, default=1., help="Scale factor to apply to the data before calculating statistics. Default: 1.")
+    p.add_argument("--sort", dest="sort", required=False, action="store_true", help="If set, sort input files by the acquisition dates in their names, .AYYYYDDD., instead of taking them as given.")
+
+    p.add_argument("--of", dest="outfile", required=True, default=None, help="Output HDF5 file of temporal statistics.")
+    p.add_argument("--chunk", dest="chunk", nargs=2, type=int, required=False, default=None, metavar=("ROWS", "COLS"), help="Chunk shape of output datasets. Default: the chunk shape of the input, or 240 240 if the input is not chunked.")
+    p.add_argument("--compression", dest="compression", required=False, default="gzip", choices=["gzip", "lzf", "none"], help="Compression filter of output datasets. Default: gzip.")
+    p.add_argument("--compression_opts", dest="compression_opts", type=int, required=False, default=4, help="Compression level for gzip. Default: 4.")
+
+    cmdargs = p.parse_args()
+
+    if (cmdargs.infiles is None) == (cmdargs.file_list is None):
+        raise RuntimeError(colorErrorStr("Give either --h5f or --file_list."))
+    if cmdargs.file_list is not None:
+        with open(cmdargs.file_list, "r") as fobj:
+            cmdargs.infiles = [line.strip() for line in fobj if len(line.strip()) > 0]
+    if len(cmdargs.infiles) < 2:
+        raise RuntimeError(colorErrorStr("At least two input files are needed for temporal statistics."))
+    if cmdargs.band < 1:
+        raise RuntimeError(colorErrorStr("Band index starts from 1."))
+
+    if cmdargs.compression == "none":
+        cmdargs.compression = None
+
+    return cmdargs
+
+def granuleDate(fname):
+    """
+    Return the acquisition date YYYYDDD in a granule name as an
+    integer, or None if not found.
+    """
+    m = DATE_RE.search(os.path.basename(fname))
+    return int(m.group(1)) if m is not None else None
+
+def checkDateOrder(infiles, sort=False):
+    """
+    Return the input files in date order. Sort them by the dates in
+    their names if asked, otherwise warn about any date out of order.
+    """
+    dates = [granuleDate(fname) for fname in infiles]
+    if np.any([d is None for d in dates]):
+        warnings.warn(colorWarnStr("Some input file names have no date .AYYYYDDD., the order of files is taken as given."), RuntimeWarning)
+        return infiles
+    if sort:
+        return [fname for d, fname in sorted(zip(dates, infiles))]
+    for i in range(1, len(dates)):
+        if dates[i] <= dates[i-1]:
+            warnings.warn(colorWarnStr("Input files are not in ascending date order at {0:s}, lag-1 differences follow the order as given.".format(os.path.basename(infiles[i]))), RuntimeWarning)
+            break
+    return infiles
+
+class TemporalAccumulator(object):
+    """
+    Running per-pixel statistics of a window over time slices, by
+    Welford's algorithm for means and variances. Lag-1 differences are
+    taken between consecutive valid observations of each pixel, i.e.
+    skipping fill values in between.
+    """
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        self.prev = np.zeros(shape)
+        self.dcount = np.zeros(shape, dtype=np.int64)
+        self.dmean = np.zeros(shape)
+        self.dm2 = np.zeros(shape)
+        self.dabs = np.zeros(shape)
+
+    def add(self, data, valid):
+        x = data[valid]
+        has_prev = self.count[valid] > 0
+
+        n = self.count[valid] + 1
+        delta = x - self.mean[valid]
+        mean = self.mean[valid] + delta/n
+        self.m2[valid] += delta*(x - mean)
+        self.mean[valid] = mean
+        self.count[valid] = n
+        self.min[valid] = np.minimum(self.min[valid], x)
+        self.max[valid] = np.maximum(self.max[valid], x)
+
+        dvalid = valid.copy()
+        dvalid[valid] = has_prev
+        d = x[has_prev] - self.prev[dvalid]
+        n = self.dcount[dvalid] + 1
+        delta = d - self.dmean[dvalid]
+        dmean = self.dmean[dvalid] + delta/n
+        self.dm2[dvalid] += delta*(d - dmean)
+        self.dmean[dvalid] = dmean
+        self.dcount[dvalid] = n
+        self.dabs[dvalid] += np.abs(d)
+
+        self.prev[valid] = x
+
+    def results(self):
+        """
+        Return a dict of output statistics with fill values where there
+        is no valid observation or difference.
+        """
+        out = {}
+        valid = self.count > 0
+        dvalid = self.dcount > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            out["Mean"] = np.where(valid, self.mean, OUT_FILLV)
+            out["Std"] = np.where(valid, np.sqrt(self.m2/self.count), OUT_FILLV)
+            out["Min"] = np.where(valid, self.min, OUT_FILLV)
+            out["Max"] = np.where(valid, self.max, OUT_FILLV)
+            out["Diff_Mean"] = np.where(dvalid, self.dmean, OUT_FILLV)
+            out["Diff_Std"] = np.where(dvalid, np.sqrt(self.dm2/self.dcount), OUT_FILLV)
+            out["Diff_Abs_Mean"] = np.where(dvalid, self.dabs/self.dcount, OUT_FILLV)
+        out["Count"] = self.count
+        out["Diff_Count"] = self.dcount
+        return out
+
+def main(cmdargs):
+    infiles = checkDateOrder(cmdargs.infiles, cmdargs.sort)
+    inds = cmdargs.dataset
+    band = cmdargs.band
+    scale_factor = cmdargs.scale_factor
+    outfile = cmdargs.outfile
+    mem_size = 50e6 # in unit of byte, 50MB memory for accumulators
+
+    if len(infiles) > np.iinfo(np.uint16).max:
+        raise RuntimeError(colorErrorStr("Too many input files for the uint16 counts of observations!"))
+
+    # Check the granules one at a time and keep only their dataset
+    # names and fill values, rather than hundreds of open files. The
+    # granules are opened again for each window.
+    dsname_list = []
+    fillvalue_list = []
+    shape, ndim, chunks = None, None, None
+    dsname_found = True
+    for fname in infiles:
+        with h5py.File(fname, "r") as fobj:
+            dsname = findDataset(fobj, inds)
+            dsname_list.append(dsname)
+            if dsname is None:
+                print colorErrorStr("Dataset name {0:s} NOT found in {1:s}".format(inds, fname))
+                dsname_found = False
+                continue
+            sds = fobj[dsname]
+            if shape is None:
+                shape, ndim, chunks = sds.shape, sds.ndim, sds.chunks
+            if sds.shape != shape:
+                raise RuntimeError(colorErrorStr("Input datasets must have the same dimension!"))
+            if sds.ndim > 2 and band > sds.shape[2]:
+                raise RuntimeError(colorErrorStr("Input band index {2:d} is invalid for the dataset {0:s}, in the file {1:s}".format(sds.name, sds.file.filename, band)))
+            fillvalue_list.extend(getFillValues([sds], warn_func=colorWarnStr))
+    if not dsname_found:
+        raise RuntimeError(colorErrorStr("Incorrect dataset name!"))
+    nrows, ncols = shape[0:2]
+
+    in_chunk = chunks[0:2] if chunks is not None else None
+    if cmdargs.chunk is not None:
+        out_chunk = (min(cmdargs.chunk[0], nrows), min(cmdargs.chunk[1], ncols))
+    elif in_chunk is not None:
+        out_chunk = tuple(in_chunk)
+    else:
+        out_chunk = (min(240, nrows), min(240, ncols))
+
+    # Windows aligned to the input chunks so that each chunk of each
+    # granule is decompressed only once.
+    wy, wx = windowSize(ACC_NBYTES, mem_size, align=in_chunk)
+
+    print colorLogStr("Write temporal statistics of {0:d} granules to ".format(len(infiles))) + colorDimStr(outfile)
+    with h5py.File(outfile, "w") as ofobj:
+        ofobj.attrs["InputFiles"] = "\n".join([os.path.basename(fname) for fname in infiles])
+        ofobj.attrs["Dataset"] = dsname_list[0]
+        ofobj.attrs["Band"] = band
+        ofobj.attrs["ScaleFactor"] = scale_factor
+
+        # keep the group path of the input, e.g. HDFEOS/GRIDS/<grid>/Data Fields
+        grp = ofobj.require_group(os.path.dirname("/" + dsname_list[0]))
+        prefix = os.path.basename(dsname_list[0]) + ("_b{0:d}".format(band) if ndim > 2 else "") + "_Temporal_"
+        out_sds = {}
+        for st, dtype, long_name in OUT_STATS:
+            out_sds[st] = grp.create_dataset(prefix+st, shape=(nrows, ncols), dtype=dtype,
+                                             chunks=out_chunk, compression=cmdargs.compression,
+                                             compression_opts=cmdargs.compression_opts if cmdargs.compression == "gzip" else None,
+                                             fillvalue=0 if dtype == np.uint16 else OUT_FILLV)
+            if dtype != np.uint16:
+                out_sds[st].attrs["_FillValue"] = np.array([OUT_FILLV], dtype=dtype)
+            out_sds[st].attrs["long_name"] = long_name
+
+        for iy, ix, ncy, ncx, rows, cols in iterWindows((nrows, ncols), wy, wx):
+            sys.stdout.write("Processing chunk row, col: {0:d}/{1:d}, {2:d}/{3:d} ... ".format(iy+1, ncy, ix+1, ncx))
+            sys.stdout.flush()
+            acc = None
+            for fname, dsname, fv in zip(infiles, dsname_list, fillvalue_list):
+                with h5py.File(fname, "r") as fobj:
+                    tmpdata = readWindow(fobj[dsname], rows, cols, band)
+                if acc is None:
+                    acc = TemporalAccumulator(tmpdata.shape)
+                acc.add(tmpdata.astype(np.float64)*scale_factor, tmpdata != fv)
+            for st, arr in acc.results().items():
+                out_sds[st][rows, cols] = arr.astype(out_sds[st].dtype)
+            sys.stdout.write("\r")
+        sys.stdout.write("\n")
+
+    print colorInfoStr("Finished temporal statistics of {0:s}".format(inds))
+    print colorResetStr("")
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
@@ -10,7 +10,6 @@ import os
 import sys
 import argparse
 import itertools
-import warnings
 
 import h5py
 import numpy as np
@@ -34,10 +33,17 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 mpl.rc(("xtick", "ytick"), labelsize=8)
 
+from mvp_result_cache import ResultCache
+from mvp_results_store import appendStatsRows, granuleColumns, statsRow, rowsToJson, rowsFromJson
+from mvp_h5_utils import findDataset, getFillValue, getFillValues, windowSize, iterWindows, readWindow, prefetchWindows, BufferRing, sampleUnit, sampleWindows, sampleStats, MIN_SAMPLE_UNITS, checkRoi, WindowMask
+from mvp_grid import gridGeometry, bboxToRoi
+from mvp_mosaic import readTileList, tileIndex, tileExtent, TileMosaic
+
 def getCmdArgs():
     p = argparse.ArgumentParser(description="Compare two datasets from MODIS and/or VIIRS")
     
     p.add_argument("--files", dest="files", nargs="+", required=True, default=None, help="Input HDF5 files from which datasets to be compared are extracted.")
+    p.add_argument("--mosaic", dest="mosaic", required=False, action="store_true", help="If set, each of --files is a text file listing sinusoidal tile files of MCD43A/VNP43IA/VNP43MA granules, one per line, to compare as one mosaic grid of the block of tiles covering all the lists, e.g. over a continent, for one set of histograms and stats. Tiles are located and checked by the sinusoidal tile grid in their StructMetadata.0 and their tile IDs in the file names. Tiles missing from a list are taken as fill values.")
     p.add_argument("--datasets", dest="datasets", nargs="+", required=True, default=None, help="Names of datasets in the corresponding input HDF5 files to be compared.")
     p.add_argument("--band", dest="band", required=False, nargs="+", type=int, default=None, help="When a dataset is multiband, e.g. BRDF_Albedo_Parameters that is a three-dimensional matrix, this option provides the index to the band to read from each dataset, with the first band as 1. Default: all 1, i.e. the first band.")
     p.add_argument("--outdir", dest="outdir", required=True, default=None, help="Directory of output images of datasets and figures of comparisons.")
@@ -46,6 +52,21 @@ def getCmdArgs():
     p.add_argument("--stats", dest="stats", required=False, action="store_true", help="If given, generate the following statistics for pixel-by-pixel differences between every two input bands or datasets, mean, standard deviation, minimum, 5 percentile, 25 percentile, median, 75 percentile, 95 percentile, maximum. If given --ocsv, output the statistics to the CSV file; otherwise, output to stdout.")
     p.add_argument("--ocsv", dest="ocsv", required=False, default=None, help="Name of a CSV file to output the list of metadata attributes for each dataset, and if given --stats, the statistics.")
 
+    p.add_argument("--roi", dest="roi", nargs=4, type=int, required=False, default=None, metavar=("ROW0", "ROW1", "COL0", "COL1"), help="If given, compare only this region of interest of rows ROW0 to ROW1-1 and columns COL0 to COL1-1, starting from 0. Default: the whole grid.")
+    p.add_argument("--bbox", dest="bbox", nargs=4, type=float, required=False, default=None, metavar=("MIN_LAT", "MAX_LAT", "MIN_LON", "MAX_LON"), help="Same as --roi but giving a bounding box of latitudes and longitudes in degrees, mapped to rows and columns by the grid geometry in StructMetadata.0 of the first input file.")
+    p.add_argument("--mask_h5f", dest="mask_h5f", required=False, default=None, help="If given with --mask_dataset, HDF5 file of a mask dataset on the same grid, e.g. a land/water layer, to compare only the pixels it keeps. Masked-out pixels are taken as fill values.")
+    p.add_argument("--mask_dataset", dest="mask_dataset", required=False, default=None, help="Name of the mask dataset in --mask_h5f.")
+    p.add_argument("--mask_values", dest="mask_values", nargs="+", type=int, required=False, default=None, help="Values of the mask dataset for the pixels to keep. Default: nonzero values that are not fill values.")
+
+    p.add_argument("--qa_datasets", dest="qa_datasets", nargs="+", required=False, default=None, help="Names of QA datasets in the same input HDF5 files, one per input dataset or none to skip an input, e.g. BRDF_Albedo_Band_Mandatory_Quality_M1. QA windows are read along with the data windows, and pixels whose QA fails the predicate of --qa_keep are taken as fill values.")
+    p.add_argument("--qa_keep", dest="qa_keep", nargs="+", required=False, default=None, help="Predicate of the QA values of the pixels to keep, one per QA dataset: 'any' for any QA value but fill values, QA values separated by commas, e.g. 0,1, or bit-field tests bits:START-END:VALUES joined by &, e.g. bits:0-1:0&bits:4-7:1,2. Default: all 0, e.g. full inversions in BRDF_Albedo_Band_Mandatory_Quality.")
+    p.add_argument("--qa_split", dest="qa_split", required=False, action="store_true", help="If set with --stats and --qa_datasets, also output the difference stats of each pair of QA values of kept pixels, in rows after the row of all kept pixels, with the QA values in the columns qa_left and qa_right.")
+
+    p.add_argument("--sample_fraction", dest="sample_fraction", type=float, required=False, default=None, help="If given, read only this fraction, 0-1, of the native chunks of the datasets, or of their rows if not chunked, drawn at random stratified over the grid, for fast approximate stats with 95%% bootstrap confidence intervals in extra CSV columns. The figures show only the sampled chunks. Default: read all data.")
+    p.add_argument("--sample_size", dest="sample_size", type=int, required=False, default=None, help="Same as --sample_fraction but giving the number of pixels to sample, rounded up to whole chunks or rows. At least {0:d} chunks or rows are sampled for the confidence intervals.".format(MIN_SAMPLE_UNITS))
+    p.add_argument("--sample_seed", dest="sample_seed", type=int, required=False, default=0, help="Seed of the random sampling and the bootstrap. Default: 0.")
+    p.add_argument("--bootstrap", dest="bootstrap", type=int, required=False, default=200, help="Number of bootstrap replicates of the sampled chunks for the confidence intervals. Default: 200.")
+
     p.add_argument("--transform_func", dest="transfunc", required=False, default=None, choices=["popcount"], help="Name of a function to transform pixel values. Choices: ['popcount']. Default: no transformation.")
 
     p.add_argument("--scale_factor", dest="scale_factor", nargs="+", type=float, required=False, default=None, help="Pixel value * scale factor will be used in the comparison and plots. Default: all 1.")
@@ -53,8 +74,21 @@ def getCmdArgs():
     p.add_argument("--stretch_max", dest="stretch_max", nargs="+", type=float, required=False, default=None, help="Maximum pixel value AFTER applying scale factor for each dataset as the plot boundaries. Default: all 1000.")
     p.add_argument("--bin_size", dest="bin_size", nargs="+", type=float, required=False, default=None, help="Bin size (width) for pixel values AFTER applying scale factors to plot histograms. Default: all 1.")
 
+    p.add_argument("--auto_range", dest="auto_range", required=False, action="store_true", help="If set, ignore --stretch_min, --stretch_max and --bin_size, and choose them from a sampled pre-pass over a fraction of the native chunks of the datasets, after the ROI, mask, QA, transformation and scale factors. All inputs get one common range, the full sampled range if it fits the histogram memory at the native precision of the data, otherwise the percentiles of --auto_range_pct. Bins are as fine as the native precision allows within --hist_mem_size.")
+    p.add_argument("--auto_range_fraction", dest="auto_range_fraction", type=float, required=False, default=0.05, help="Fraction, 0-1, of the native chunks, or of the rows if not chunked, read by the pre-pass of --auto_range. Default: 0.05.")
+    p.add_argument("--auto_range_pct", dest="auto_range_pct", nargs=2, type=float, required=False, default=[0.1, 99.9], metavar=("LOW", "HIGH"), help="Percentiles of the sampled values as the robust range of --auto_range. Default: 0.1 99.9.")
+    p.add_argument("--hist_mem_size", dest="hist_mem_size", type=float, required=False, default=64, help="Memory limit of a 2-D histogram of --auto_range in MB, which limits the number of bins of each input to the square root of the number of histogram cells fitting the limit. Default: 64 MB.")
+
     p.add_argument("--fig_width", dest="fig_width", type=float, required=False, default=5, help="Width of output figures, in inches, the height of an output figure will be automatically adjusted. Default: 5 inches.")
 
+    p.add_argument("--prefetch", dest="prefetch", type=int, required=False, default=0, help="Number of windows to read ahead in a background thread while the current window is processed, so that reading and decompression overlap with the computation. The windows are shrunk so that the buffers of all the windows in flight stay within the memory limit of a window without read-ahead. Default: 0, no read-ahead.")
+
+    p.add_argument("--cache_dir", dest="cache_dir", required=False, default=None, help="Directory of a result cache. If given, the comparison figures and stats are reused from the cache when the input files and all the options affecting the outputs are unchanged since an earlier run, skipping the data scan. Default: no cache.")
+    p.add_argument("--cache_size", dest="cache_size", type=float, required=False, default=1024, help="Maximum size of the result cache in MB. The least recently used results are evicted beyond this size. Default: 1024 MB.")
+    p.add_argument("--cache_checksum", dest="cache_checksum", required=False, action="store_true", help="If set, also identify input files in the result cache by a checksum of their content, in addition to their sizes and modification times.")
+
+    p.add_argument("--results_store", dest="results_store", required=False, default=None, help="HDF5 file of a columnar store of stats across runs. If given, also append the output rows of stats to the table compare_mv_datasets of the store, with the bands, the product IDs, dates, tiles and collections parsed from the file names, the run time and the run options as extra columns. Created if not existing. Query it with mvp_results_store.py.")
+
     cmdargs = p.parse_args()
 
     if cmdargs.scale_factor is None:
@@ -85,9 +119,163 @@ def getCmdArgs():
 
     if (cmdargs.ocsv is not None) and (not cmdargs.stats):
         raise RuntimeError(colorErrorStr("Option stats is not turned on for writing to the given CSV file."))
+    if (cmdargs.results_store is not None) and (not cmdargs.stats):
+        raise RuntimeError(colorErrorStr("Option stats is not turned on for appending to the given results store."))
+
+    if (cmdargs.sample_fraction is not None) and (cmdargs.sample_size is not None):
+        raise RuntimeError(colorErrorStr("Only one of --sample_fraction and --sample_size can be given."))
+    if (cmdargs.sample_fraction is not None) and (cmdargs.sample_fraction <= 0 or cmdargs.sample_fraction > 1):
+        raise RuntimeError(colorErrorStr("Sample fraction must be in (0, 1]."))
+    if (cmdargs.sample_size is not None) and (cmdargs.sample_size <= 0):
+        raise RuntimeError(colorErrorStr("Sample size must be positive."))
+    if cmdargs.bootstrap < 1:
+        raise RuntimeError(colorErrorStr("Number of bootstrap replicates must be positive."))
+    if cmdargs.prefetch < 0:
+        raise RuntimeError(colorErrorStr("Number of windows to read ahead must not be negative."))
+
+    if (cmdargs.auto_range_fraction <= 0) or (cmdargs.auto_range_fraction > 1):
+        raise RuntimeError(colorErrorStr("Auto range fraction must be in (0, 1]."))
+    if (cmdargs.auto_range_pct[0] < 0) or (cmdargs.auto_range_pct[1] > 100) or (cmdargs.auto_range_pct[0] >= cmdargs.auto_range_pct[1]):
+        raise RuntimeError(colorErrorStr("Auto range percentiles must be two increasing values in [0, 100]."))
+    if cmdargs.hist_mem_size <= 0:
+        raise RuntimeError(colorErrorStr("Histogram memory size must be positive."))
+
+    if (cmdargs.roi is not None) and (cmdargs.bbox is not None):
+        raise RuntimeError(colorErrorStr("Only one of --roi and --bbox can be given."))
+
+    if cmdargs.qa_datasets is not None:
+        cmdargs.qa_datasets = [None if qd.lower() == "none" else qd for qd in cmdargs.qa_datasets]
+        if cmdargs.qa_keep is None:
+            cmdargs.qa_keep = ("0",)*len(cmdargs.files)
+        if len(cmdargs.files) != len(cmdargs.qa_datasets):
+            raise RuntimeError(colorErrorStr("Numbers of input files and QA datasets must be equal and one to one."))
+        if len(cmdargs.files) != len(cmdargs.qa_keep):
+            raise RuntimeError(colorErrorStr("Numbers of input files and QA predicates must be equal and one to one."))
+        # check the syntax of the predicates early.
+        _ = [parseQaPredicate(qk) for qk in cmdargs.qa_keep]
+    elif (cmdargs.qa_keep is not None) or cmdargs.qa_split:
+        raise RuntimeError(colorErrorStr("--qa_keep and --qa_split need --qa_datasets."))
+    if cmdargs.qa_split and not cmdargs.stats:
+        raise RuntimeError(colorErrorStr("--qa_split needs --stats."))
+    if (cmdargs.mask_h5f is None) != (cmdargs.mask_dataset is None):
+        raise RuntimeError(colorErrorStr("--mask_h5f and --mask_dataset must be given together."))
+    if cmdargs.mosaic and (cmdargs.mask_h5f is not None):
+        raise RuntimeError(colorErrorStr("--mask_h5f is not supported with --mosaic."))
 
     return cmdargs
 
+def parseQaPredicate(expr):
+    """
+    Parse a predicate of QA values into a list of tests (start bit, end
+    bit, kept values). The bits are None to test whole QA values, and
+    the kept values are None to keep any value. See --qa_keep.
+    """
+    if expr.strip().lower() == "any":
+        return [(None, None, None)]
+    tests = []
+    try:
+        for term in expr.split("&"):
+            term = term.strip()
+            if term.startswith("bits:"):
+                _, bit_str, val_str = term.split(":")
+                b0, b1 = [int(b) for b in bit_str.split("-")] if "-" in bit_str else (int(bit_str), int(bit_str))
+                if b0 < 0 or b1 < b0:
+                    raise ValueError(term)
+                tests.append((b0, b1, [int(v) for v in val_str.split(",")]))
+            else:
+                tests.append((None, None, [int(v) for v in term.split(",")]))
+    except ValueError:
+        raise RuntimeError(colorErrorStr("Invalid QA predicate {0:s}".format(expr)))
+    return tests
+
+def qaKeep(qa, tests, fillv):
+    """
+    Boolean array of the pixels whose QA values pass all the tests of a
+    predicate. QA fill values are only kept if they pass the tests, and
+    never by 'any'.
+    """
+    keep = np.ones(qa.shape, dtype=np.bool_)
+    for b0, b1, values in tests:
+        if values is None:
+            if fillv is not None:
+                keep = np.logical_and(keep, qa != fillv)
+            continue
+        field = qa if b0 is None else (qa.astype(np.int64) >> b0) & ((1 << (b1-b0+1)) - 1)
+        keep = np.logical_and(keep, np.in1d(field, values).reshape(qa.shape))
+    return keep
+
+def autoRange(values_list, quantum_list, nmax, pct):
+    """
+    Choose a common range of stretch and the bin sizes of datasets from
+    sampled valid values, with at most nmax bins per dataset. The range
+    is the full sampled range if it fits nmax bins of every quantum,
+    i.e. the scaled precision of integer data, otherwise the given
+    percentiles of all the values. Bin sizes are the smallest multiples
+    of the quanta fitting nmax bins, or for float data with no quantum,
+    the range split into nmax bins. Return the lists of stretch
+    minimums, maximums and bin sizes.
+    """
+    values = np.concatenate(values_list)
+    # two bins are kept for the rounding of the range to whole bins.
+    nmax = max(nmax-2, 1)
+    lo, hi = np.min(values), np.max(values)
+    if np.any([q is None or (hi-lo)/q+1 > nmax for q in quantum_list]):
+        lo, hi = np.percentile(values, pct)
+    stretch_min, stretch_max, bin_size = [], [], []
+    for q in quantum_list:
+        if q is None:
+            bw = (hi-lo)/float(nmax) if hi > lo else max(abs(lo), 1.)*1e-3
+        else:
+            bw = q*max(int(np.ceil((hi-lo)/q/float(nmax))), 1)
+        stretch_min.append(np.floor(lo/bw)*bw)
+        stretch_max.append(np.ceil(hi/bw)*bw)
+        bin_size.append(bw)
+    return stretch_min, stretch_max, bin_size
+
+class DiffAccumulator(object):
+    """
+    Running count, sum and sum of squares of differences and their
+    histogram of unit bins, growing as new differences come, for the
+    difference stats.
+    """
+    def __init__(self):
+        self.cnt, self.sum, self.sum2 = 0, 0, 0
+        self.hist = np.zeros(2, dtype=np.int)
+        self.binrange = np.array([0, 1], dtype=np.int)
+
+    def add(self, tmpdiff):
+        self.cnt = self.cnt + tmpdiff.size
+        self.sum = self.sum + np.sum(tmpdiff)
+        self.sum2 = self.sum2 + np.sum(tmpdiff * tmpdiff)
+
+        tmpmax = np.max(tmpdiff)
+        tmpmin = np.min(tmpdiff)
+        if tmpmax > self.binrange[1]:
+            self.hist = np.append(self.hist, np.zeros(int(tmpmax-self.binrange[1])))
+            self.binrange[1] = tmpmax
+        if tmpmin < self.binrange[0]:
+            self.hist = np.append(np.zeros(int(self.binrange[0]-tmpmin)), self.hist)
+            self.binrange[0] = tmpmin
+        tmphist1d, _ = np.histogram(tmpdiff, bins=self.binEdges())
+        self.hist = self.hist + tmphist1d
+
+    def binEdges(self):
+        return np.arange(self.binrange[0]-0.5, self.binrange[1]+1.5)
+
+    def stats(self, pct_list):
+        """
+        Return mean, std, rms and the percentiles of the differences.
+        """
+        diff_stats = np.zeros(3+len(pct_list))
+        diff_stats[0] = self.sum / self.cnt
+        diff_stats[1] = np.sqrt(self.sum2/self.cnt - diff_stats[0]*diff_stats[0])
+        diff_stats[2] = np.sqrt(self.sum2/self.cnt)
+        tmpcs = np.cumsum(self.hist) / float(np.sum(self.hist)) * 100
+        tmpidx = np.searchsorted(tmpcs, pct_list)
+        tmpidx[0], tmpidx[-1] = 0, -1
+        diff_stats[3:] = np.arange(self.binrange[0], self.binrange[1]+1)[tmpidx]
+        return diff_stats
+
 def main(cmdargs):
     infiles = cmdargs.files
     inds = cmdargs.datasets
@@ -106,10 +294,72 @@ def main(cmdargs):
 
     do_stats = cmdargs.stats
     outcsvfile = cmdargs.ocsv
-
-    fobj_list = [h5py.File(fname, "r") for fname in infiles]
-
-    dsname_list = [fobj['/'].visit(lambda name: name if ids in name else None) for fobj, ids in itertools.izip(fobj_list, inds)]
+    do_sample = (cmdargs.sample_fraction is not None) or (cmdargs.sample_size is not None)
+    do_mask = cmdargs.mask_h5f is not None
+    do_roi = (cmdargs.roi is not None) or (cmdargs.bbox is not None)
+    do_qa = cmdargs.qa_datasets is not None
+    qa_split = cmdargs.qa_split
+    do_mosaic = cmdargs.mosaic
+    if do_mosaic:
+        tile_files_list = [readTileList(fname) for fname in infiles]
+
+    cache = None
+    if cmdargs.cache_dir is not None:
+        cache = ResultCache(cmdargs.cache_dir, max_bytes=cmdargs.cache_size*1e6, checksum=cmdargs.cache_checksum)
+        cache_opts = dict(datasets=inds, band=inband, labels=inlabels, scale_factor=scale_factor, 
+                          stretch_min=stretch_min, stretch_max=stretch_max, bin_size=bin_size, 
+                          fig_width=fig_width, cmap_name=cmap_name, dpi=dpi, 
+                          transform_func=transfunc, stats=do_stats)
+        if do_sample:
+            cache_opts.update(sample_fraction=cmdargs.sample_fraction, sample_size=cmdargs.sample_size, 
+                              sample_seed=cmdargs.sample_seed, bootstrap=cmdargs.bootstrap)
+        if do_roi or do_mask:
+            cache_opts.update(roi=cmdargs.roi, bbox=cmdargs.bbox, mask_dataset=cmdargs.mask_dataset, mask_values=cmdargs.mask_values)
+        if cmdargs.auto_range:
+            cache_opts.update(auto_range=True, auto_range_fraction=cmdargs.auto_range_fraction, 
+                              auto_range_pct=cmdargs.auto_range_pct, hist_mem_size=cmdargs.hist_mem_size, 
+                              sample_seed=cmdargs.sample_seed)
+        if do_qa:
+            cache_opts.update(qa_datasets=cmdargs.qa_datasets, qa_keep=cmdargs.qa_keep, qa_split=qa_split)
+        cache_infiles = infiles + ([cmdargs.mask_h5f] if do_mask else [])
+        if do_mosaic:
+            cache_opts.update(mosaic=True)
+            cache_infiles = cache_infiles + [fname for tile_files in tile_files_list for fname in tile_files]
+        cache_key = cache.makeKey("compare_mv_datasets", cache_infiles, cache_opts)
+        cache_entry = cache.get(cache_key)
+        if cache_entry is not None:
+            print colorInfoStr("Found results in the cache ") + colorDimStr("{0:s}".format(cmdargs.cache_dir))
+            for name in sorted(cache_entry["files"].keys()):
+                print "Output figure {0:s}".format(name)
+                cache.restoreFile(cache_entry, name, os.path.join(outdir, name))
+            if do_stats:
+                writeStatsStr(cache_entry["texts"]["outstats"], outcsvfile)
+                if cmdargs.results_store is not None:
+                    storeStatsRows(rowsFromJson(cache_entry["texts"]["outstats_rows"]), cmdargs)
+            print colorResetStr("")
+            return
+        cache_files = {}
+
+    if do_mosaic:
+        # Index the tiles of each input, on the block of tiles covering
+        # all the inputs, with the dataset and the QA dataset if any
+        # checked in every tile. The metadata are from the first tile
+        # file of each input.
+        tiles_list, tile_info_list = [], []
+        for i, (tile_files, ids) in enumerate(itertools.izip(tile_files_list, inds)):
+            qd = cmdargs.qa_datasets[i] if do_qa else None
+            tiles, info_list = tileIndex(tile_files, [ids] + ([] if qd is None else [qd]))
+            tiles_list.append(tiles)
+            tile_info_list.append(info_list)
+        extent = tileExtent(tiles_list)
+        for fname, tiles in itertools.izip(infiles, tiles_list):
+            print colorInfoStr("Mosaic of {0:d} tiles from {1:s}, h{2:02d}-h{3:02d}, v{4:02d}-v{5:02d}, {6:d} missing tiles as fill".format(
+                len(tiles), fname, extent[0], extent[1], extent[2], extent[3], (extent[1]-extent[0]+1)*(extent[3]-extent[2]+1)-len(tiles)))
+        fobj_list = [h5py.File(tiles.values()[0], "r") for tiles in tiles_list]
+    else:
+        fobj_list = [h5py.File(fname, "r") for fname in infiles]
+
+    dsname_list = [findDataset(fobj, ids) for fobj, ids in itertools.izip(fobj_list, inds)]
     dsname_found = True
     for i, dsname in enumerate(dsname_list):
         if dsname is None:
@@ -118,24 +368,12 @@ def main(cmdargs):
     if not dsname_found:
         raise RuntimeError(colorErrorStr("Incorrect dataset name!"))
 
-    sds_list = [fobj[dsname] for fobj, dsname in itertools.izip(fobj_list, dsname_list)]
+    if do_mosaic:
+        sds_list = [TileMosaic(tiles, info_list[0], extent, fname) for tiles, info_list, fname in itertools.izip(tiles_list, tile_info_list, infiles)]
+    else:
+        sds_list = [fobj[dsname] for fobj, dsname in itertools.izip(fobj_list, dsname_list)]
     # find fill value
-    fillvalue_list = []
-    for i, (fobj, dsname) in enumerate(itertools.izip(fobj_list, dsname_list)):
-        fill_found = False
-        for tmp in fobj[dsname].attrs.keys():
-            if 'FILL' in tmp.upper():
-                fillvalue_list.append(fobj[dsname].attrs[tmp])
-                fill_found = True
-                break
-        if not fill_found:
-            fillvalue_list.append(None)
-            print colorWarnStr("{0:s}:{1:s}, no fill value!".format(os.path.basename(infiles[i]), dsname))
-    fillvalue_list = [fv if (np.isscalar(fv) or fv is None) else fv[0] for fv in fillvalue_list]
-    if np.sum([fv is None for fv in fillvalue_list]) > 0:
-        fillvalue_list = [np.iinfo(sds.dtype).max if fv is None else fv for sds, fv in itertools.izip(sds_list, fillvalue_list)]
-        warnings.warn(colorDimStr("Some input datasets miss fill value. Use the maximum values of their data types."), RuntimeWarning)
-        print fillvalue_list
+    fillvalue_list = getFillValues(sds_list, warn_func=colorWarnStr)
 
     # List metadata of the dataset
     print colorInfoStr("-"*70)
@@ -161,149 +399,265 @@ def main(cmdargs):
         if sds.ndim > 2 and ib > sds.ndim:
             raise RuntimeError(colorErrorStr("Input band index {2:d} is valid for the dataset {0:s}, in the file {1:s}".format(sds.name, sds.file.filename, ib)))
 
+    # Region of interest and mask to limit the reading of data.
+    roi = None
+    if cmdargs.roi is not None:
+        roi = checkRoi(cmdargs.roi, sds_list[0].shape)
+    elif cmdargs.bbox is not None:
+        geom = sds_list[0].geometry() if do_mosaic else gridGeometry(fobj_list[0], dsname_list[0])
+        roi = bboxToRoi(geom, sds_list[0].shape, cmdargs.bbox)
+    if roi is not None:
+        print colorInfoStr("Compare rows {0:d}-{1:d}, columns {2:d}-{3:d}".format(roi[0], roi[1]-1, roi[2], roi[3]-1))
+    mask = None
+    if do_mask:
+        mask_fobj = h5py.File(cmdargs.mask_h5f, "r")
+        mask_dsname = findDataset(mask_fobj, cmdargs.mask_dataset)
+        if mask_dsname is None:
+            raise RuntimeError(colorErrorStr("Dataset name {0:s} NOT found in {1:s}".format(cmdargs.mask_dataset, cmdargs.mask_h5f)))
+        if mask_fobj[mask_dsname].shape[0:2] != sds_list[0].shape[0:2]:
+            raise RuntimeError(colorErrorStr("Mask dataset must have the same grid as the input datasets!"))
+        mask = WindowMask(mask_fobj[mask_dsname], cmdargs.mask_values)
+    ext = checkRoi(roi, sds_list[0].shape)
+
+    # QA datasets in the same files as the data, read window by window
+    # along with the data.
+    qa_sds_list = [None for sds in sds_list]
+    if do_qa:
+        for i, (fobj, qd) in enumerate(itertools.izip(fobj_list, cmdargs.qa_datasets)):
+            if qd is None:
+                continue
+            qa_dsname = findDataset(fobj, qd)
+            if qa_dsname is None:
+                raise RuntimeError(colorErrorStr("QA dataset name {0:s} NOT found in {1:s}".format(qd, infiles[i])))
+            qa_sds_list[i] = TileMosaic(tiles_list[i], tile_info_list[i][1], extent, infiles[i]) if do_mosaic else fobj[qa_dsname]
+            if qa_sds_list[i].shape[0:2] != sds_list[i].shape[0:2]:
+                raise RuntimeError(colorErrorStr("QA dataset {0:s} must have the same grid as the dataset {1:s}!".format(qa_dsname, dsname_list[i])))
+        qa_fillvalue_list = [None if qa_sds is None else getFillValue(qa_sds) for qa_sds in qa_sds_list]
+        qa_tests_list = [parseQaPredicate(qk) for qk in cmdargs.qa_keep]
+
+    # data types of the scaled data, as of data * scale factor
+    scaled_dtype_list = [np.result_type(sds.dtype, sf) for sds, sf in itertools.izip(sds_list, scale_factor)]
+
+    def readData(i, rows, cols, keep=None, out=None, qa_out=None, scaled_out=None):
+        """
+        Read a window of the i-th dataset as a flat array, with the
+        pixels not kept by the mask or failing the QA predicate as fill
+        values, transformed and scaled. Return the data and the QA
+        values, None without QA dataset. The windows are read into out
+        and qa_out, and scaled into the flat scaled_out of the type in
+        scaled_dtype_list, if given.
+        """
+        fv = fillvalue_list[i]
+        data = readWindow(sds_list[i], rows, cols, inband[i], out=out).ravel()
+        if keep is not None:
+            data[np.logical_not(keep)] = fv
+        qa = None
+        if qa_sds_list[i] is not None:
+            qa = readWindow(qa_sds_list[i], rows, cols, out=qa_out).ravel()
+            data[np.logical_not(qaKeep(qa, qa_tests_list[i], qa_fillvalue_list[i]))] = fv
+        if transfunc == "popcount":
+            data = popcount_func(data, fv)
+        # apply scale factor
+        if scaled_out is None:
+            scaled_out = np.empty(data.size, dtype=scaled_dtype_list[i])
+        np.multiply(data, scale_factor[i], out=scaled_out)
+        scaled_out[data==fv] = fv
+        return scaled_out, qa
+
+    if cmdargs.auto_range:
+        # Sampled pre-pass over the native chunks of each dataset to
+        # choose the range and bins of the histograms within the memory
+        # limit before the full pass.
+        values_list = []
+        for i, sds in enumerate(sds_list):
+            windows, nunits = sampleWindows(sds.shape, sampleUnit(sds), fraction=cmdargs.auto_range_fraction, 
+                                            seed=cmdargs.sample_seed, roi=roi)
+            print colorInfoStr("Auto range from {0:d} of {1:d} {2:s} of {3:s}".format(len(windows), nunits, "rows" if sds.chunks is None else "chunks", inlabels[i]))
+            for _, _, _, _, rows, cols in windows:
+                keep = None
+                if mask is not None:
+                    tmpmask = mask.window(rows, cols)
+                    if tmpmask is None:
+                        continue
+                    rows, cols, keep = tmpmask
+                    keep = keep.flatten()
+                data, _ = readData(i, rows, cols, keep)
+                values_list.append(data[data!=fillvalue_list[i]].astype(np.double))
+        if np.sum([v.size for v in values_list]) == 0:
+            print colorWarnStr("No valid values in the sampled chunks, use the given stretch and bin sizes.")
+        else:
+            quantum_list = [None if sds.dtype.kind == "f" else float(sf) for sds, sf in itertools.izip(sds_list, scale_factor)]
+            nmax = int(np.sqrt(cmdargs.hist_mem_size*1e6/8.))
+            stretch_min, stretch_max, bin_size = autoRange(values_list, quantum_list, nmax, cmdargs.auto_range_pct)
+            for i in range(len(sds_list)):
+                print colorInfoStr("Auto range of {0:s}: stretch {1:g} to {2:g}, bin size {3:g}".format(inlabels[i], stretch_min[i], stretch_max[i], bin_size[i]))
+
     # Large amount of pixels to compare for generating scatter density
     # plot. First build a scatter density array by going through the
     # data chunk by chunk. The chunk size is determined by the
     # prescribed memory size limit.
-    chunk_xsize_list = [int(np.sqrt(mem_size/sds.dtype.itemsize)) for sds in sds_list]
-    chunk_ysize_list = chunk_xsize_list
-    nchunk_x_list = [np.ceil(sds.shape[1]/cx).astype(int) for sds, cx in itertools.izip(sds_list, chunk_xsize_list)]
-    nchunk_y_list = [np.ceil(sds.shape[0]/cy).astype(int) for sds, cy in itertools.izip(sds_list, chunk_ysize_list)]
-    nchunk_x_list = [ncx if ncx>0 else 1 for ncx in nchunk_x_list]
-    nchunk_y_list = [ncy if ncy>0 else 1 for ncy in nchunk_y_list]
+    # With read-ahead, the windows in flight share the memory limit.
+    nslots = cmdargs.prefetch+2 if cmdargs.prefetch > 0 else 1
+    chunk_size_list = [windowSize(sds.dtype.itemsize*nslots, mem_size) for sds in sds_list]
 
     bins_list = [np.arange(smin-bw*0.5, smax+bw*1.5, bw) for smin, smax, bw in itertools.izip(stretch_min, stretch_max, bin_size)]
 
     if do_stats:
-        tmplen = len(sds_list) * (len(sds_list)-1) / 2
-        tmp_x_cnt = np.zeros(tmplen)
-        tmp_x_sum = np.zeros(tmplen)
-        tmp_x2_sum = np.zeros(tmplen)
-        hist_list = [np.zeros(2, dtype=np.int) for i in range(tmplen)]
-        binrange_list = [np.array([0,1], dtype=np.int) for i in range(tmplen)]
         fmtstr = ",".join(["{{{0:d}:s}}".format(i) for i in range(4)])
         fmtstr = fmtstr + "," + ",".join(["{{4[{0:d}]:.3g}}".format(i) for i in range(10)])
         fmtstr = fmtstr + "\n"
         outstats_str = "file_left,dataset_left,file_right,dataset_right,mean,std,rms,min,5pct,25pct,median,75pct,95pct,max\n"
+        if do_sample:
+            # confidence bounds go after all the columns of a full run
+            # so that readers by column position are not affected.
+            tmpnames = outstats_str.strip().split(",")[4:]
+            fmtstr = fmtstr.rstrip("\n") + "," + ",".join(["{{5[{0:d}]:.3g}}".format(i) for i in range(2*len(tmpnames))]) \
+                     + ",{{5[{0:d}]:.0f}},{{5[{1:d}]:.4g}}\n".format(2*len(tmpnames), 2*len(tmpnames)+1)
+            outstats_str = outstats_str.rstrip("\n") + "," + ",".join([n+"_ci95_low" for n in tmpnames]) \
+                           + "," + ",".join([n+"_ci95_high" for n in tmpnames]) + ",sampled_valid_pixels,sample_fraction\n"
+        if qa_split:
+            fmtstr = fmtstr.rstrip("\n") + ",{6:s},{7:s}\n"
+            outstats_str = outstats_str.rstrip("\n") + ",qa_left,qa_right\n"
+        # the same rows with the values as computed, for the results store
+        outstats_header = outstats_str.strip().split(",")
+        outstats_rows = []
 
     for idx1, idx2 in itertools.combinations(range(len(sds_list)), 2):
         sds1, sds2 = sds_list[idx1], sds_list[idx2]
         fv1, fv2 = fillvalue_list[idx1], fillvalue_list[idx2]
         bins1, bins2 = bins_list[idx1], bins_list[idx2]
 
-        cx1, cx2 = chunk_xsize_list[idx1], chunk_xsize_list[idx2]
-        ncx1, ncx2 = nchunk_x_list[idx1], nchunk_x_list[idx1]
-        cy1, cy2 = chunk_ysize_list[idx1], chunk_ysize_list[idx2]
-        ncy1, ncy2 = nchunk_y_list[idx1], nchunk_y_list[idx1]
-
-        ncx, cx, ncy, cy = ncx1, cx1, ncy1, cy1
+        cy, cx = chunk_size_list[idx1]
+        if do_sample:
+            # sample the native chunks of the left dataset of the pair.
+            windows, nunits = sampleWindows(sds1.shape, sampleUnit(sds1), fraction=cmdargs.sample_fraction, 
+                                            size=cmdargs.sample_size, seed=cmdargs.sample_seed, roi=roi)
+            print colorInfoStr("Sample {0:d} of {1:d} {2:s} of the datasets".format(len(windows), nunits, "rows" if sds1.chunks is None else "chunks"))
+            sample_values = []
+        else:
+            windows = list(iterWindows(sds1.shape, cy, cx, roi=roi))
+        ring = None
+        if cmdargs.prefetch > 0:
+            npix = np.max([(rows.stop-rows.start)*(cols.stop-cols.start) for _, _, _, _, rows, cols in windows])
+            ring = BufferRing(nslots, [npix*(0 if sds is None else sds.dtype.itemsize) 
+                                       for sds in (sds1, sds2, qa_sds_list[idx1], qa_sds_list[idx2])] 
+                                      + [npix*scaled_dtype_list[idx].itemsize for idx in (idx1, idx2)])
+
+        def fetchWindow(window, slot):
+            iy, ix, ncy, ncx, rows, cols = window
+            keep = None
+            if mask is not None:
+                tmpmask = mask.window(rows, cols)
+                if tmpmask is None:
+                    return None
+                rows, cols, keep = tmpmask
+                keep = keep.flatten()
+            outs = [None]*6
+            if ring is not None:
+                shape = (rows.stop-rows.start, cols.stop-cols.start)
+                outs = [None if sds is None else ring.view(slot, k, shape, sds.dtype) 
+                        for k, sds in enumerate((sds1, sds2, qa_sds_list[idx1], qa_sds_list[idx2]))] \
+                       + [ring.view(slot, 4+k, shape[0]*shape[1], scaled_dtype_list[idx]) for k, idx in enumerate((idx1, idx2))]
+            return readData(idx1, rows, cols, keep, outs[0], outs[2], outs[4]) + readData(idx2, rows, cols, keep, outs[1], outs[3], outs[5])
         final_hist2d_arr = np.zeros((len(bins1)-1, len(bins2)-1))
         final_hist1d_arr1 = np.zeros(len(bins1)-1)
         final_hist1d_arr2 = np.zeros(len(bins2)-1)
         final_cmhist1d_arr1 = np.zeros(len(bins1)-1)
         final_cmhist1d_arr2 = np.zeros(len(bins2)-1)
+        nvalid1, nvalid2 = 0, 0
 
         if do_stats:
-            tmp_x_cnt, tmp_x_sum, tmp_x2_sum = 0, 0, 0
-            diff_hist = np.zeros(2, dtype=np.int)
-            diff_binrange = np.array([0, 1], dtype=np.int)
+            diff_acc = DiffAccumulator()
+            # accumulators and sampled differences by pairs of QA values
+            class_acc, class_values = {}, {}
             diff_scale_factor_inv = 1./np.min([scale_factor[idx1], scale_factor[idx2]])
 
-        for ix in range(ncx):
-            for iy in range(ncy):
-                sys.stdout.write("Reading chunk row, col: {0:d}/{1:d}, {2:d}/{3:d} ... ".format(iy+1, ncy, ix+1, ncx))
+        for (iy, ix, ncy, ncx, rows, cols), fetched in prefetchWindows(windows, fetchWindow, cmdargs.prefetch):
+            sys.stdout.write("Reading chunk row, col: {0:d}/{1:d}, {2:d}/{3:d} ... ".format(iy+1, ncy, ix+1, ncx))
+            sys.stdout.flush()
+            if fetched is None:
+                sys.stdout.write("\r")
+                continue
+            tmpdata1, tmpqa1, tmpdata2, tmpqa2 = fetched
+
+            tmpflag = reduce(np.logical_and, [tmpdata1!=fv1, tmpdata2!=fv2])
+            hist2d_arr, hist2d_xed, hist2d_yed = np.histogram2d(tmpdata1[tmpflag], tmpdata2[tmpflag], bins=[bins1, bins2])
+            final_hist2d_arr = final_hist2d_arr + hist2d_arr
+            
+            hist1d_arr, hist1d_bed1 = np.histogram(tmpdata1[tmpdata1!=fv1], bins=bins1)
+            final_hist1d_arr1 = final_hist1d_arr1 + hist1d_arr
+            hist1d_arr, hist1d_bed2 = np.histogram(tmpdata2[tmpdata2!=fv2], bins=bins2)
+            final_hist1d_arr2 = final_hist1d_arr2 + hist1d_arr
+            nvalid1 = nvalid1 + np.sum(tmpdata1!=fv1)
+            nvalid2 = nvalid2 + np.sum(tmpdata2!=fv2)
+
+            hist1d_arr, hist1d_bed1 = np.histogram(tmpdata1[tmpflag], bins=bins1)
+            final_cmhist1d_arr1 = final_cmhist1d_arr1 + hist1d_arr
+            hist1d_arr, hist1d_bed2 = np.histogram(tmpdata2[tmpflag], bins=bins2)
+            final_cmhist1d_arr2 = final_cmhist1d_arr2 + hist1d_arr
+
+            if do_stats:
+                sys.stdout.write("Digesting data to estimate difference stats ... ")
                 sys.stdout.flush()
-                tmpxidx1 = sds1.shape[1] if ix==ncx-1 else (ix+1)*cx
-                tmpxidx2 = sds2.shape[1] if ix==ncx-1 else (ix+1)*cx
-                tmpyidx1 = sds1.shape[0] if iy==ncy-1 else (iy+1)*cy
-                tmpyidx2 = sds2.shape[0] if iy==ncy-1 else (iy+1)*cy
-
-                tmpdata1 = sds1[iy*cy:tmpyidx1, ix*cx:tmpxidx1].flatten()
-                tmpdata2 = sds2[iy*cy:tmpyidx2, ix*cx:tmpxidx2].flatten()
-                if sds1.ndim == 2:
-                    tmpdata1 = sds1[iy*cy:tmpyidx1, ix*cx:tmpxidx1].flatten()
-                elif sds1.ndim == 3:
-                    tmpdata1 = sds1[iy*cy:tmpyidx1, ix*cx:tmpxidx1, inband[idx1]-1].flatten()
-                else:
-                    raise RuntimeError(colorErrorStr("Unexpected number of dimensions of input dataset!"))
-                if sds2.ndim == 2:
-                    tmpdata2 = sds2[iy*cy:tmpyidx2, ix*cx:tmpxidx2].flatten()
-                elif sds2.ndim == 3:
-                    tmpdata2 = sds2[iy*cy:tmpyidx2, ix*cx:tmpxidx2, inband[idx2]-1].flatten()
-                else:
-                    raise RuntimeError(colorErrorStr("Unexpected number of dimensions of input dataset!"))
-
-                if transfunc == "popcount":
-                    sys.stdout.write("Transforming the data ... ")
-                    sys.stdout.flush()
-                    tmpdata1 = popcount_func(tmpdata1, fv1)
-                    tmpdata2 = popcount_func(tmpdata2, fv2)
-                
-                # apply scale factor
-                tmpflag = tmpdata1==fv1
-                tmpdata1 = tmpdata1 * scale_factor[idx1]
-                tmpdata1[tmpflag] = fv1
-                tmpflag = tmpdata2==fv2
-                tmpdata2 = tmpdata2 * scale_factor[idx2]
-                tmpdata2[tmpflag] = fv2
-
-                tmpflag = reduce(np.logical_and, [tmpdata1!=fv1, tmpdata2!=fv2])
-                hist2d_arr, hist2d_xed, hist2d_yed = np.histogram2d(tmpdata1[tmpflag], tmpdata2[tmpflag], bins=[bins1, bins2])
-                final_hist2d_arr = final_hist2d_arr + hist2d_arr
-                
-                hist1d_arr, hist1d_bed1 = np.histogram(tmpdata1[tmpdata1!=fv1], bins=bins1)
-                final_hist1d_arr1 = final_hist1d_arr1 + hist1d_arr
-                hist1d_arr, hist1d_bed2 = np.histogram(tmpdata2[tmpdata2!=fv2], bins=bins2)
-                final_hist1d_arr2 = final_hist1d_arr2 + hist1d_arr
-
-                hist1d_arr, hist1d_bed1 = np.histogram(tmpdata1[tmpflag], bins=bins1)
-                final_cmhist1d_arr1 = final_cmhist1d_arr1 + hist1d_arr
-                hist1d_arr, hist1d_bed2 = np.histogram(tmpdata2[tmpflag], bins=bins2)
-                final_cmhist1d_arr2 = final_cmhist1d_arr2 + hist1d_arr
-
-                if do_stats:
-                    sys.stdout.write("Digesting data to estimate difference stats ... ")
-                    sys.stdout.flush()
-
-                    tmpdiff = (tmpdata1.astype(np.double) - tmpdata2.astype(np.double)) * diff_scale_factor_inv
-                    tmpdiff = tmpdiff[tmpflag]
-                    if tmpdiff.size == 0:
-                        sys.stdout.write("\r")
-                        continue
-                    tmp_x_cnt = tmp_x_cnt + tmpdiff.size
-                    tmp_x_sum = tmp_x_sum + np.sum(tmpdiff)
-                    tmp_x2_sum = tmp_x2_sum + np.sum(tmpdiff * tmpdiff)
-                    
-                    tmpmax = np.max(tmpdiff)
-                    tmpmin = np.min(tmpdiff)
-                    if tmpmax > diff_binrange[1]:
-                        diff_hist = np.append(diff_hist, np.zeros(int(tmpmax-diff_binrange[1])))
-                        diff_binrange[1] = tmpmax
-                    if tmpmin < diff_binrange[0]:
-                        diff_hist = np.append(np.zeros(int(diff_binrange[0]-tmpmin)), diff_hist)
-                        diff_binrange[0] = tmpmin
-                    tmpbins = np.arange(diff_binrange[0]-0.5, diff_binrange[1]+1.5)
-                    tmphist1d, diffhist_bed = np.histogram(tmpdiff, bins=tmpbins)
-                    diff_hist = diff_hist + tmphist1d
 
-                sys.stdout.write("\r")
+                tmpdiff = (tmpdata1.astype(np.double) - tmpdata2.astype(np.double)) * diff_scale_factor_inv
+                tmpdiff = tmpdiff[tmpflag]
+                if tmpdiff.size == 0:
+                    sys.stdout.write("\r")
+                    continue
+                if do_sample:
+                    sample_values.append(tmpdiff)
+                diff_acc.add(tmpdiff)
+
+                if qa_split:
+                    # classes of pixels by the pairs of their QA values,
+                    # N/A for an input without QA dataset.
+                    tmpclass = np.stack([np.zeros(tmpdiff.size, dtype=np.int64) if tmpqa is None else tmpqa[tmpflag].astype(np.int64) 
+                                         for tmpqa in (tmpqa1, tmpqa2)], axis=1)
+                    tmpkeys, tmpinv = np.unique(tmpclass, axis=0, return_inverse=True)
+                    for k, key in enumerate(tmpkeys):
+                        key = tuple(["N/A" if tmpqa is None else str(kv) for tmpqa, kv in itertools.izip((tmpqa1, tmpqa2), key)])
+                        if key not in class_acc:
+                            class_acc[key], class_values[key] = DiffAccumulator(), []
+                        class_acc[key].add(tmpdiff[tmpinv==k])
+                        if do_sample:
+                            class_values[key].append(tmpdiff[tmpinv==k])
+
+            sys.stdout.write("\r")
+
+        for label, nvalid, hist1d in ((inlabels[idx1], nvalid1, final_hist1d_arr1), (inlabels[idx2], nvalid2, final_hist1d_arr2)):
+            if nvalid > np.sum(hist1d):
+                print colorWarnStr("{0:d} of {1:d} valid pixels of {2:s} are outside the histogram range.".format(int(nvalid-np.sum(hist1d)), int(nvalid), label))
 
         if do_stats:
-            # mean, std, rms, min, 5%, 25%, median, 75%, 95%, max
-            diff_stats = np.zeros(10)
+            # mean, std, rms, min, 5%, 25%, median, 75%, 95%, max, of all
+            # pixels and then of each class of QA values if asked.
             pct_list = [0, 5, 25, 50, 75, 95, 100]
-            diff_stats[0] = tmp_x_sum / tmp_x_cnt
-            diff_stats[1] = np.sqrt(tmp_x2_sum/tmp_x_cnt - diff_stats[0]*diff_stats[0])
-            diff_stats[2] = np.sqrt(tmp_x2_sum/tmp_x_cnt)
-            tmpcs = np.cumsum(diff_hist) / float(np.sum(diff_hist)) * 100
-            tmpidx = np.searchsorted(tmpcs, pct_list)
-            tmpidx[0], tmpidx[-1] = 0, -1
-            diff_stats[3:] = np.arange(diff_binrange[0], diff_binrange[1]+1)[tmpidx]
-            diff_stats = diff_stats / diff_scale_factor_inv
+            diff_hist, diff_binrange, diffhist_bed = diff_acc.hist, diff_acc.binrange, diff_acc.binEdges()
+            if do_sample:
+                nsampled = np.sum([(rows.stop-rows.start)*(cols.stop-cols.start) for _, _, _, _, rows, cols in windows])
+            tmprows = [(("all", "all"), diff_acc, sample_values if do_sample else None)]
+            if qa_split:
+                tmprows = tmprows + [(key, class_acc[key], class_values[key]) for key in sorted(class_acc.keys())]
+            pair_stats = []
+            for key, acc, values in tmprows:
+                diff_stats = acc.stats(pct_list)
+                if do_sample:
+                    diff_stats, diff_lo, diff_hi = sampleStats(values, pct_list, nboot=cmdargs.bootstrap, 
+                                                               seed=cmdargs.sample_seed, exact=len(windows)==nunits)
+                    diff_ci = np.concatenate([diff_lo / diff_scale_factor_inv, diff_hi / diff_scale_factor_inv, 
+                                              [np.sum([v.size for v in values]), nsampled/float((ext[1]-ext[0])*(ext[3]-ext[2]))]])
+                diff_stats = diff_stats / diff_scale_factor_inv
+                pair_stats.append((diff_stats, diff_ci if do_sample else None))
+                outstats_str = outstats_str \
+                               + fmtstr.format(infiles[idx1], dsname_list[idx1], 
+                                               infiles[idx2], dsname_list[idx2], diff_stats, 
+                                               diff_ci if do_sample else None, key[0], key[1])
+                outstats_rows.append(statsRow(outstats_header, 
+                                              [infiles[idx1], dsname_list[idx1], infiles[idx2], dsname_list[idx2]] + list(diff_stats) 
+                                              + ((list(diff_ci[:-2]) + [int(diff_ci[-2]), diff_ci[-1]]) if do_sample else []) 
+                                              + (list(key) if qa_split else [])))
             diffhist_bed = diffhist_bed / diff_scale_factor_inv
-            outstats_str = outstats_str \
-                           + fmtstr.format(infiles[idx1], dsname_list[idx1], 
-                                           infiles[idx2], dsname_list[idx2], diff_stats)
         # save the figure
         #
         # split the input label strings into multiple lines for better
@@ -362,8 +716,9 @@ def main(cmdargs):
             ax_diff.set_ylabel("Frequency")
 
         plt.tight_layout(h_pad=0.0, w_pad=0.0)
-        plt.savefig("{0:s}/scatter_density_{1:s}_vs_{2:s}.png".format(outdir, inlabels[idx1].replace(" ", "_"), inlabels[idx2].replace(" ", "_")), 
-                    dpi=dpi, bbox_inches="tight", pad_inches=0)
+        pair_label = "{0:s}_vs_{1:s}".format(inlabels[idx1].replace(" ", "_"), inlabels[idx2].replace(" ", "_"))
+        scatter_fig = "{0:s}/scatter_density_{1:s}.png".format(outdir, pair_label)
+        plt.savefig(scatter_fig, dpi=dpi, bbox_inches="tight", pad_inches=0)
 
         print "Output figure of histogram comparison"
         fig, ((ax, cm_ax), (ax_pdf, cm_ax_pdf)) = plt.subplots(2, 2, figsize=(fig_width, fig_width), sharex=True, sharey="row")
@@ -414,27 +769,53 @@ def main(cmdargs):
 
         ax_pdf.legend(loc="upper center", bbox_to_anchor=(1.0, -0.2), frameon=False, ncol=1, fontsize=fontsize)
         plt.tight_layout()
-        plt.savefig("{0:s}/hist_comparison_{1:s}_vs_{2:s}.png".format(outdir, inlabels[idx1].replace(" ", "_"), inlabels[idx2].replace(" ", "_")), 
-                    dpi=dpi, bbox_inches="tight", pad_inches=0)
+        hist_fig = "{0:s}/hist_comparison_{1:s}.png".format(outdir, pair_label)
+        plt.savefig(hist_fig, dpi=dpi, bbox_inches="tight", pad_inches=0)
+
+        if cache is not None:
+            cache_files[os.path.basename(scatter_fig)] = scatter_fig
+            cache_files[os.path.basename(hist_fig)] = hist_fig
 
     _ = [fobj.close() for fobj in fobj_list]
+    if do_mosaic:
+        _ = [sds.close() for sds in sds_list + qa_sds_list if sds is not None]
 
     if do_stats:
-        if outcsvfile is not None:
-            output_obj = open(outcsvfile, "w")
-            print colorLogStr("Output statistics of differnce to ") + colorDimStr("{0:s}".format(outcsvfile))
-        else:
-            output_obj = sys.stdout
-            print colorInfoStr("Difference stats: ")
-
-        output_obj.write(outstats_str)
+        writeStatsStr(outstats_str, outcsvfile)
+        if cmdargs.results_store is not None:
+            storeStatsRows(outstats_rows, cmdargs)
 
-        if outcsvfile is not None:
-            output_obj.close()
+    if cache is not None:
+        cache.put(cache_key, files=cache_files, 
+                  texts=dict(outstats=outstats_str, outstats_rows=rowsToJson(outstats_rows)) if do_stats else dict())
 
     print colorResetStr("")
     return
 
+def writeStatsStr(outstats_str, outcsvfile):
+    if outcsvfile is not None:
+        print colorLogStr("Output statistics of differnce to ") + colorDimStr("{0:s}".format(outcsvfile))
+        with open(outcsvfile, "w") as output_obj:
+            output_obj.write(outstats_str)
+    else:
+        print colorInfoStr("Difference stats: ")
+        sys.stdout.write(outstats_str)
+
+def storeStatsRows(outstats_rows, cmdargs):
+    # rows of the pairs of inputs in order, and with --qa_split, each
+    # pair starts with the row of all its QA classes.
+    pairs = list(itertools.combinations(range(len(cmdargs.files)), 2))
+    row_cols_list = []
+    k = -1
+    for row in outstats_rows:
+        if (not cmdargs.qa_split) or (row["qa_left"], row["qa_right"]) == ("all", "all"):
+            k = k + 1
+        row_cols = []
+        for idx, side in zip(pairs[k], ("_left", "_right")):
+            row_cols = row_cols + [("band"+side, cmdargs.band[idx])] + granuleColumns(cmdargs.files[idx], side).items()
+        row_cols_list.append(row_cols)
+    appendStatsRows(cmdargs.results_store, "compare_mv_datasets", outstats_rows, row_cols_list, vars(cmdargs))
+
 def popcount_func(data, fillv):
     tmpflag = data!=fillv
     data[tmpflag] = [bin(x).count("1") for x in data[tmpflag]]
@@ -21,6 +21,10 @@ Options
   --outid, required
     A string label to attach to all the output figure files for identification.
 
+  --auto_range, optional
+    Choose the stretch and bin sizes of the comparison plots from a
+    sampled pre-pass over the data instead of the presets per data field.
+
 EOF
 
 function echoErrorStr () 
@@ -36,7 +40,9 @@ function echoInfoStr ()
     echo -e '\033[32m'${1}'\033[0m'
 }
 
-OPTS=`getopt -o D --long pid1:,pid2:,outdir:,outid: -n 'compare_mv_products.sh' -- "$@"`
+AUTORANGE=""
+
+OPTS=`getopt -o D --long pid1:,pid2:,outdir:,outid:,auto_range -n 'compare_mv_products.sh' -- "$@"`
 if [[ $? != 0 ]]; then echo "Failed parsing options." >&2 ; echo "${USAGE}" ; exit 1 ; fi
 eval set -- "${OPTS}"
 while true;
@@ -62,6 +68,8 @@ do
                 "") shift 2 ;;
                 *) OUTID=${2} ; shift 2 ;;
             esac ;;
+        --auto_range )
+            AUTORANGE="--auto_range" ; shift ;;
         -- ) shift ; break ;;
         * ) break ;;
     esac
@@ -430,8 +438,8 @@ function compareMcdVnp ()
             # get customized options to run the compare python script.
             customCmpOpts "${PID1}" "${mdsname}" "${PID2}" "${vdsname}"
 
-            echo ${CMP_CMD} --stats --ocsv ${tmpcsv} --files ${mfname} ${vfname} --datasets "${mdsname}" "${vdsname}" --outdir ${OUTDIR} --labels "${mlabel}" "${vlabel}" ${MYCMPOPTS}
-            ${CMP_CMD} --stats --ocsv ${tmpcsv} --files ${mfname} ${vfname} --datasets "${mdsname}" "${vdsname}" --outdir ${OUTDIR} --labels "${mlabel}" "${vlabel}" ${MYCMPOPTS}
+            echo ${CMP_CMD} --stats --ocsv ${tmpcsv} --files ${mfname} ${vfname} --datasets "${mdsname}" "${vdsname}" --outdir ${OUTDIR} --labels "${mlabel}" "${vlabel}" ${MYCMPOPTS} ${AUTORANGE}
+            ${CMP_CMD} --stats --ocsv ${tmpcsv} --files ${mfname} ${vfname} --datasets "${mdsname}" "${vdsname}" --outdir ${OUTDIR} --labels "${mlabel}" "${vlabel}" ${MYCMPOPTS} ${AUTORANGE}
             copyCsv ${tmpcsv}
         else
             # failed to find the MODIS dataset
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+# Crawl the metadata of MCD43/VNP43 HDF5 files in directory trees into
+# an SQLite index, without reading any pixel data, and query the index.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import sys
+import csv
+import argparse
+import fnmatch
+import multiprocessing
+import sqlite3
+import time
+from StringIO import StringIO
+
+import h5py
+import numpy as np
+
+import colorama
+colorama.init(autoreset=True)
+# define some color schemes for message output control
+colorWarnStr = lambda msg: colorama.Fore.YELLOW + str(msg) + colorama.Style.RESET_ALL
+colorErrorStr = lambda msg: colorama.Fore.RED + str(msg) + colorama.Style.RESET_ALL
+colorInfoStr = lambda msg: colorama.Fore.GREEN + str(msg) + colorama.Style.RESET_ALL
+colorDimStr = lambda msg: colorama.Style.DIM + str(msg) + colorama.Style.RESET_ALL
+colorLogStr = lambda msg: str(msg)
+colorResetStr = lambda msg: colorama.Style.RESET_ALL + str(msg)
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    crawled REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS global_attrs (
+    path TEXT,
+    name TEXT,
+    type TEXT,
+    num_val INTEGER,
+    value TEXT,
+    PRIMARY KEY (path, name)
+);
+CREATE TABLE IF NOT EXISTS datasets (
+    path TEXT,
+    dataset TEXT,
+    dtype TEXT,
+    shape TEXT,
+    chunks TEXT,
+    compression TEXT,
+    fill_value TEXT,
+    PRIMARY KEY (path, dataset)
+);
+CREATE TABLE IF NOT EXISTS dataset_attrs (
+    path TEXT,
+    dataset TEXT,
+    name TEXT,
+    type TEXT,
+    num_val INTEGER,
+    value TEXT,
+    PRIMARY KEY (path, dataset, name)
+);
+CREATE INDEX IF NOT EXISTS global_attrs_name_value ON global_attrs (name, value);
+CREATE INDEX IF NOT EXISTS dataset_attrs_name_value ON dataset_attrs (name, value);
+CREATE INDEX IF NOT EXISTS datasets_dataset ON datasets (dataset);
+"""
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Crawl the metadata of MCD43/VNP43 HDF5 files into an SQLite index without reading pixel data, and query the index.")
+    sp = p.add_subparsers(dest="command")
+
+    p_crawl = sp.add_parser("crawl", help="Walk directory trees and upsert the global and dataset attributes of the found files into the index. Files unchanged in size and modification time since the last crawl are skipped.")
+    p_crawl.add_argument("--db", dest="db", required=True, default=None, help="SQLite file of the metadata index. Created if not existing.")
+    p_crawl.add_argument("--dirs", dest="dirs", nargs="+", required=True, default=None, help="Root directories to walk for product files.")
+    p_crawl.add_argument("--pattern", dest="pattern", nargs="+", required=False, default=["*.h5"], help="File name patterns of product files. Default: *.h5.")
+    p_crawl.add_argument("--nproc", dest="nproc", type=int, required=False, default=multiprocessing.cpu_count(), help="Number of worker processes to read metadata. Default: number of CPUs.")
+    p_crawl.add_argument("--prune", dest="prune", required=False, action="store_true", help="If set, remove from the index the files under the given directories that no longer exist.")
+    p_crawl.add_argument("--force", dest="force", required=False, action="store_true", help="If set, recrawl all found files even if they are unchanged.")
+
+    p_query = sp.add_parser("query", help="Query the index.")
+    p_query.add_argument("--db", dest="db", required=True, default=None, help="SQLite file of the metadata index.")
+    p_query.add_argument("--attr", dest="attr", required=False, default=None, help="Name of an attribute to list its distinct values with the number of files of each value, and an example file.")
+    p_query.add_argument("--dataset", dest="dataset", required=False, default=None, help="Pattern of dataset names with wildcards, e.g. 'BRDF_Albedo_Parameters_*'. If given, --attr is searched in the attributes of these datasets; otherwise in the global attributes.")
+    p_query.add_argument("--sql", dest="sql", required=False, default=None, help="A raw SQL query to run on the index, overriding --attr.")
+    p_query.add_argument("--ocsv", dest="ocsv", required=False, default=None, help="Name of a CSV file to output the query results. Default: output to stdout.")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.command == "crawl" and cmdargs.nproc < 1:
+        raise RuntimeError(colorErrorStr("Number of worker processes must be at least 1."))
+    if cmdargs.command == "query" and cmdargs.attr is None and cmdargs.sql is None:
+        raise RuntimeError(colorErrorStr("Either --attr or --sql must be given to query the index."))
+
+    return cmdargs
+
+def textValue(val):
+    """
+    Unicode text of a string attribute value, from UTF-8 if in bytes,
+    e.g. values with non-ASCII characters such as units in degrees.
+    """
+    if isinstance(val, unicode):
+        return val
+    if isinstance(val, str):
+        return val.decode("utf-8", "replace")
+    return unicode(val)
+
+def fmtAttrValue(val):
+    """
+    Return the type name, number of values and a string of the value of
+    an HDF5 attribute.
+    """
+    if isinstance(val, (str, unicode, np.string_, np.unicode_)):
+        return "STRING", 1, textValue(val)
+    val = np.atleast_1d(val)
+    if val.dtype.kind in ("S", "U", "O"):
+        return "STRING", val.size, u",".join([textValue(v) for v in val.flat])
+    type_str = val.dtype.name.upper()
+    if val.dtype.kind == "f":
+        val_str = ",".join(["{0:g}".format(v) for v in val.flat])
+    else:
+        val_str = ",".join([str(v) for v in val.flat])
+    return type_str, val.size, val_str
+
+def readFileMetadata(fname):
+    """
+    Read the global attributes, the list of datasets and the dataset
+    attributes of an HDF5 file. Only metadata is read, no pixel data.
+    """
+    st = os.stat(fname)
+    out = dict(path=fname, size=st.st_size, mtime=st.st_mtime, error=None,
+               global_attrs=[], datasets=[], dataset_attrs=[])
+    try:
+        with h5py.File(fname, "r") as fobj:
+            for k, v in fobj.attrs.items():
+                out["global_attrs"].append((k,) + fmtAttrValue(v))
+
+            def visitor(name, obj):
+                if not isinstance(obj, h5py.Dataset):
+                    return None
+                fill_str = None
+                for k, v in obj.attrs.items():
+                    tattr = fmtAttrValue(v)
+                    out["dataset_attrs"].append((name, k) + tattr)
+                    if fill_str is None and "FILL" in k.upper():
+                        fill_str = tattr[2]
+                out["datasets"].append((name, obj.dtype.name,
+                                        "x".join([str(d) for d in obj.shape]),
+                                        None if obj.chunks is None else "x".join([str(d) for d in obj.chunks]),
+                                        obj.compression, fill_str))
+                return None
+            fobj.visititems(visitor)
+    except Exception as e:
+        out["error"] = "{0:s}: {1:s}".format(type(e).__name__, str(e))
+    return out
+
+def findFiles(dirs, patterns):
+    for d in dirs:
+        for root, subdirs, files in os.walk(d):
+            subdirs.sort()
+            for f in sorted(files):
+                if any([fnmatch.fnmatch(f, pat) for pat in patterns]):
+                    yield os.path.abspath(os.path.join(root, f))
+
+def openIndex(dbfile):
+    conn = sqlite3.connect(dbfile, timeout=60)
+    conn.executescript(DB_SCHEMA)
+    return conn
+
+def upsertFileMetadata(conn, md):
+    path = md["path"]
+    for tbl in ["global_attrs", "datasets", "dataset_attrs"]:
+        conn.execute("DELETE FROM {0:s} WHERE path=?".format(tbl), (path,))
+    conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                 (path, md["size"], md["mtime"], time.time(), md["error"]))
+    conn.executemany("INSERT OR REPLACE INTO global_attrs VALUES (?, ?, ?, ?, ?)",
+                     [(path,) + row for row in md["global_attrs"]])
+    conn.executemany("INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     [(path,) + row for row in md["datasets"]])
+    conn.executemany("INSERT OR REPLACE INTO dataset_attrs VALUES (?, ?, ?, ?, ?, ?)",
+                     [(path,) + row for row in md["dataset_attrs"]])
+
+def crawl(cmdargs):
+    conn = openIndex(cmdargs.db)
+
+    indexed = dict([(row[0], (row[1], row[2])) for row in conn.execute("SELECT path, size, mtime FROM files")])
+    found = list(findFiles(cmdargs.dirs, cmdargs.pattern))
+    todo = []
+    for fname in found:
+        st = os.stat(fname)
+        if cmdargs.force or indexed.get(fname, None) != (st.st_size, st.st_mtime):
+            todo.append(fname)
+    print colorLogStr("Found {0:d} files, {1:d} new or changed since the last crawl".format(len(found), len(todo)))
+
+    if cmdargs.prune:
+        found_set = set(found)
+        roots = [os.path.join(os.path.abspath(d), "") for d in cmdargs.dirs]
+        gone = [path for path in indexed.keys()
+                if (path not in found_set) and any([path.startswith(r) for r in roots])]
+        for path in gone:
+            for tbl in ["files", "global_attrs", "datasets", "dataset_attrs"]:
+                conn.execute("DELETE FROM {0:s} WHERE path=?".format(tbl), (path,))
+        conn.commit()
+        print colorLogStr("Removed {0:d} files no longer existing from the index".format(len(gone)))
+
+    nerr = 0
+    if len(todo) > 0:
+        pool = multiprocessing.Pool(min(cmdargs.nproc, len(todo)))
+        try:
+            for i, md in enumerate(pool.imap_unordered(readFileMetadata, todo, chunksize=8)):
+                upsertFileMetadata(conn, md)
+                if md["error"] is not None:
+                    nerr += 1
+                    sys.stdout.write("\n")
+                    print colorWarnStr("{0:s}: {1:s}".format(md["path"], md["error"]))
+                if (i+1) % 100 == 0:
+                    conn.commit()
+                sys.stdout.write("Crawled {0:d}/{1:d} files\r".format(i+1, len(todo)))
+                sys.stdout.flush()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        conn.commit()
+        sys.stdout.write("\n")
+
+    conn.close()
+    print colorInfoStr("Indexed {0:d} files, {1:d} with errors, into ".format(len(todo), nerr)) + colorDimStr(cmdargs.db)
+
+def query(cmdargs):
+    conn = openIndex(cmdargs.db)
+
+    if cmdargs.sql is not None:
+        cur = conn.execute(cmdargs.sql)
+    elif cmdargs.dataset is None:
+        cur = conn.execute("SELECT name, type, value, COUNT(*) AS num_files, MIN(path) AS example_file "
+                           + "FROM global_attrs WHERE name=? GROUP BY name, type, value ORDER BY num_files DESC",
+                           (cmdargs.attr,))
+    else:
+        # translate the shell-style wildcards of dataset names to SQL LIKE patterns.
+        ds_pat = cmdargs.dataset.replace("*", "%").replace("?", "_")
+        cur = conn.execute("SELECT dataset, name, type, value, COUNT(*) AS num_files, MIN(path) AS example_file "
+                           + "FROM dataset_attrs WHERE name=? AND (dataset LIKE ? OR dataset LIKE ?) "
+                           + "GROUP BY dataset, name, type, value ORDER BY dataset, num_files DESC",
+                           (cmdargs.attr, ds_pat, "%/" + ds_pat))
+    header = [d[0] for d in cur.description]
+    rows = cur.fetchall()
+    conn.close()
+
+    # sqlite returns text as unicode, written as UTF-8, and quotes in
+    # attribute values are escaped by the csv module.
+    out_buf = StringIO()
+    writer = csv.writer(out_buf, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow([v.encode("utf-8") if isinstance(v, unicode) else v for v in row])
+    out_str = out_buf.getvalue()
+
+    if cmdargs.ocsv is not None:
+        print colorLogStr("Write query results to ") + colorDimStr("{0:s}".format(cmdargs.ocsv))
+        with open(cmdargs.ocsv, "w") as fobj:
+            fobj.write(out_str)
+    else:
+        sys.stdout.write(out_str)
+
+def main(cmdargs):
+    if cmdargs.command == "crawl":
+        crawl(cmdargs)
+    elif cmdargs.command == "query":
+        query(cmdargs)
+    print colorResetStr("")
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
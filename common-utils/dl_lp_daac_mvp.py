@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+
+# Download MODIS/VIIRS products from LP DAAC with concurrent,
+# resumable and verified transfers, replacing the day-by-day wget
+# loop of dl_lp_daac_mvp.sh.
+#
+# Directory listings are cached on disk, partial downloads are resumed
+# with HTTP range requests, downloaded files are verified against the
+# checksums in the .xml metadata of granules when available, and a
+# manifest of completed granules lets reruns skip them.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import sys
+import re
+import json
+import time
+import random
+import fnmatch
+import hashlib
+import argparse
+import datetime
+import threading
+import subprocess
+import urlparse
+import xml.etree.ElementTree as ET
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+import colorama
+colorama.init(autoreset=True)
+# define some color schemes for message output control
+colorWarnStr = lambda msg: colorama.Fore.YELLOW + str(msg) + colorama.Style.RESET_ALL
+colorErrorStr = lambda msg: colorama.Fore.RED + str(msg) + colorama.Style.RESET_ALL
+colorInfoStr = lambda msg: colorama.Fore.GREEN + str(msg) + colorama.Style.RESET_ALL
+colorDimStr = lambda msg: colorama.Style.DIM + str(msg) + colorama.Style.RESET_ALL
+colorLogStr = lambda msg: str(msg)
+colorResetStr = lambda msg: colorama.Style.RESET_ALL + str(msg)
+
+URL_BASE = "https://e4ftl01.cr.usgs.gov/MOTA/"
+# Earthdata Login host that LP DAAC redirects to for authentication.
+AUTH_HOST = "urs.earthdata.nasa.gov"
+# the first day of MODIS data
+MODIS_BEGIN_DATE = datetime.date(2000, 2, 24)
+BLOCK_SIZE = 2**20
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Download MODIS/VIIRS products from LP DAAC concurrently with resume, checksum verification and a manifest of completed granules.")
+
+    p.add_argument("--user", dest="user", required=False, default=None, help="Earthdata Login user name. Default: from ~/.netrc.")
+    p.add_argument("--password", dest="password", required=False, default=None, help="Earthdata Login password. Default: from ~/.netrc.")
+    p.add_argument("-f", "--format", dest="fmt", required=False, default="h5", help="File format, the extension of product files, 'h5' or 'hdf'. Default: h5.")
+    p.add_argument("-t", "--tile", dest="tile", nargs="+", required=False, default=["all"], help="Tiles to download, e.g. h12v04 h12v05, or 'all'. Default: all.")
+    p.add_argument("-y", "--year", dest="year", type=int, required=True, default=None, help="Year of the products.")
+    p.add_argument("-p", "--par", dest="par", required=True, default=None, help="Product short name, e.g. MCD43A1.")
+    p.add_argument("-n", "--num", dest="num", type=int, required=True, default=None, help="Collection number, e.g. 6.")
+    p.add_argument("-o", "--output", dest="outdir", required=False, default="./", help="Output directory, under which a subdirectory of the year is created. Default: ./")
+    p.add_argument("-b", "--begin", dest="begin_doy", type=int, required=False, default=None, help="Beginning day of year. Default: 1.")
+    p.add_argument("-e", "--end", dest="end_doy", type=int, required=False, default=None, help="Ending day of year. Default: the last day of the year.")
+
+    p.add_argument("--url_base", dest="url_base", required=False, default=URL_BASE, help="Base URL of the product directories, e.g. a local HTTP server for testing. Default: {0:s}".format(URL_BASE))
+    p.add_argument("--nthreads", dest="nthreads", type=int, required=False, default=4, help="Number of concurrent connections. Default: 4.")
+    p.add_argument("--retry", dest="retry", type=int, required=False, default=10, help="Number of retries of a failed request. Default: 10.")
+    p.add_argument("--timeout", dest="timeout", type=float, required=False, default=60, help="Timeout of a connection in seconds. Default: 60.")
+    p.add_argument("--listing_ttl", dest="listing_ttl", type=float, required=False, default=24, help="Hours to reuse a cached directory listing. Default: 24.")
+    p.add_argument("--no_checksum", dest="no_checksum", required=False, action="store_true", help="If set, do not download the .xml metadata of granules to verify checksums, only the file sizes.")
+    p.add_argument("--keep_xml", dest="keep_xml", required=False, action="store_true", help="If set, keep the .xml metadata of granules next to the downloaded files.")
+
+    cmdargs = p.parse_args()
+
+    if (cmdargs.user is None) != (cmdargs.password is None):
+        raise RuntimeError(colorErrorStr("--user and --password must be given together."))
+    if cmdargs.nthreads < 1:
+        raise RuntimeError(colorErrorStr("Number of concurrent connections must be at least 1."))
+    cmdargs.tile = [t for t in cmdargs.tile if t not in ("all", "*")]
+    for tile in cmdargs.tile:
+        m = re.match(r"^h(\d{2})v(\d{2})$", tile)
+        if m is None or int(m.group(1)) > 35 or int(m.group(2)) > 17:
+            raise RuntimeError(colorErrorStr("Illegal tile numbers in {0:s}".format(tile)))
+    if not cmdargs.url_base.endswith("/"):
+        cmdargs.url_base = cmdargs.url_base + "/"
+
+    return cmdargs
+
+class EarthdataSession(requests.Session):
+    """
+    A session that keeps the authorization header when redirected to
+    and back from Earthdata Login, which requests drops by default on
+    redirects across hosts.
+    """
+    def rebuild_auth(self, prepared_request, response):
+        if "Authorization" in prepared_request.headers:
+            redirect_host = urlparse.urlparse(prepared_request.url).hostname
+            original_host = urlparse.urlparse(response.request.url).hostname
+            if (redirect_host != original_host) and (redirect_host != AUTH_HOST) and (original_host != AUTH_HOST):
+                del prepared_request.headers["Authorization"]
+        return
+
+def openSession(user=None, password=None, nconn=4):
+    session = EarthdataSession()
+    if user is not None:
+        session.auth = (user, password)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=nconn, pool_maxsize=nconn)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def retryCall(func, retry, desc):
+    """
+    Call func until it returns without an exception, up to retry more
+    times with a random and growing wait in between.
+    """
+    for i in range(retry+1):
+        try:
+            return func()
+        except (requests.exceptions.RequestException, IOError) as e:
+            if i == retry:
+                raise
+            wait = random.uniform(1, 3) * (i+1)
+            print colorWarnStr("{0:s}: {1:s}, retry in {2:.1f} s".format(desc, str(e), wait))
+            time.sleep(wait)
+
+class ListingCache(object):
+    """
+    On-disk cache of the file names in the HTML listings of remote
+    directories.
+    """
+    def __init__(self, cache_dir, ttl_hours=24):
+        self.cache_dir = cache_dir
+        self.ttl = ttl_hours * 3600.
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+    def _cacheFile(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, session, url, timeout=60, retry=10):
+        """
+        Return the list of hrefs in the listing of a directory URL, or
+        an empty list if the directory does not exist.
+        """
+        cache_file = self._cacheFile(url)
+        if os.path.isfile(cache_file) and time.time() - os.path.getmtime(cache_file) < self.ttl:
+            try:
+                with open(cache_file, "r") as fobj:
+                    return json.load(fobj)["hrefs"]
+            except (IOError, ValueError):
+                pass
+
+        def fetch():
+            r = session.get(url, timeout=timeout)
+            if r.status_code == 404:
+                return None
+            r.raise_for_status()
+            return r.text
+        html = retryCall(fetch, retry, url)
+        if html is None:
+            hrefs = []
+        else:
+            hrefs = sorted(set([h.split("/")[-1] for h in re.findall(r'href="([^"?#]+)"', html)]))
+        tmpfile = "{0:s}.{1:d}.{2:d}.tmp".format(cache_file, os.getpid(), threading.current_thread().ident)
+        with open(tmpfile, "w") as fobj:
+            json.dump(dict(url=url, hrefs=hrefs, fetched=time.time()), fobj)
+        os.rename(tmpfile, cache_file)
+        return hrefs
+
+class Manifest(object):
+    """
+    Append-only JSON-lines file of the granules downloaded and
+    verified. The last record of a file name wins.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.records = {}
+        if os.path.isfile(fname):
+            with open(fname, "r") as fobj:
+                for line in fobj:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # a line cut by an interrupted run
+                        continue
+                    self.records[rec["file"]] = rec
+
+    def isDone(self, fname, outdir):
+        rec = self.records.get(fname, None)
+        if rec is None or rec["status"] != "done":
+            return False
+        path = os.path.join(outdir, fname)
+        return os.path.isfile(path) and os.path.getsize(path) == rec["size"]
+
+    def add(self, rec):
+        with self.lock:
+            self.records[rec["file"]] = rec
+            with open(self.fname, "a") as fobj:
+                fobj.write(json.dumps(rec, sort_keys=True) + "\n")
+                fobj.flush()
+                os.fsync(fobj.fileno())
+
+def parseGranuleXml(xml_str, fname):
+    """
+    Return the size, checksum type and checksum of a data file from
+    the .xml metadata of a granule, any of which may be None.
+    """
+    root = ET.fromstring(xml_str)
+    for dfc in root.iter("DataFileContainer"):
+        if dfc.findtext("DistributedFileName", "").strip() != fname:
+            continue
+        size = dfc.findtext("FileSize", None)
+        return (int(size) if size is not None else None,
+                dfc.findtext("ChecksumType", None),
+                dfc.findtext("Checksum", None))
+    return None, None, None
+
+def calcChecksum(fname, cksum_type):
+    cksum_type = cksum_type.strip().upper()
+    if cksum_type == "CKSUM":
+        # POSIX cksum is not in the standard library; the cksum
+        # program of coreutils is fast and always there on Linux.
+        out = subprocess.check_output(["cksum", fname])
+        return out.split()[0]
+    h = hashlib.new(cksum_type.replace("-", "").lower())
+    with open(fname, "rb") as fobj:
+        for blk in iter(lambda: fobj.read(BLOCK_SIZE), b""):
+            h.update(blk)
+    return h.hexdigest()
+
+def expectedSize(r, offset=0):
+    """
+    Total size of a remote file from the headers of a response to a
+    request from offset.
+    """
+    crange = r.headers.get("Content-Range", None)
+    if crange is not None and "/" in crange and not crange.endswith("/*"):
+        return int(crange.split("/")[-1])
+    clen = r.headers.get("Content-Length", None)
+    if clen is not None and r.headers.get("Content-Encoding", None) is None:
+        return offset + int(clen)
+    return None
+
+def downloadFile(session, url, outfile, timeout=60, retry=10):
+    """
+    Download a URL to outfile through outfile.part, resuming from the
+    size of an existing .part file by a range request.
+    """
+    partfile = outfile + ".part"
+
+    def fetch():
+        offset = os.path.getsize(partfile) if os.path.isfile(partfile) else 0
+        headers = {"Range":"bytes={0:d}-".format(offset)} if offset > 0 else {}
+        r = session.get(url, headers=headers, stream=True, timeout=timeout)
+        try:
+            if r.status_code == 416:
+                # the .part file is already complete or larger than the
+                # remote file, start over.
+                os.remove(partfile)
+                raise IOError("range not satisfiable")
+            r.raise_for_status()
+            # the server ignores the range and sends the whole file.
+            mode = "ab" if (offset > 0 and r.status_code == 206) else "wb"
+            with open(partfile, mode) as fobj:
+                for blk in r.iter_content(chunk_size=BLOCK_SIZE):
+                    fobj.write(blk)
+            # a dropped connection ends the content without an error,
+            # check the size and resume from where it stops.
+            expected = expectedSize(r, offset if mode == "ab" else 0)
+            received = os.path.getsize(partfile)
+            if expected is not None and received < expected:
+                raise IOError("incomplete transfer, {0:d} of {1:d} bytes".format(received, expected))
+        finally:
+            r.close()
+
+    retryCall(fetch, retry, url)
+    os.rename(partfile, outfile)
+    return os.path.getsize(outfile)
+
+def findGranules(session, listing_cache, url_base, par, num, year, doy, tiles, fmt, timeout=60, retry=10):
+    """
+    Return the list of (file name, URL of the directory) of the
+    granules of a day.
+    """
+    date = datetime.date(year, 1, 1) + datetime.timedelta(days=doy-1)
+    rdir = "{0:s}.{1:03d}/{2:s}/".format(par, num, date.strftime("%Y.%m.%d"))
+    dir_url = urlparse.urljoin(url_base, rdir)
+    if len(tiles) == 0:
+        fpats = ["{0:s}.A{1:d}{2:03d}.{3:03d}.*.{4:s}".format(par, year, doy, num, fmt),
+                 "{0:s}.A{1:d}{2:03d}.h??v??.{3:03d}.*.{4:s}".format(par, year, doy, num, fmt)]
+    else:
+        fpats = ["{0:s}.A{1:d}{2:03d}.{3:s}.{4:03d}.*.{5:s}".format(par, year, doy, tile, num, fmt) for tile in tiles]
+    hrefs = listing_cache.get(session, dir_url, timeout=timeout, retry=retry)
+    return [(h, dir_url) for h in hrefs if any([fnmatch.fnmatch(h, fp) for fp in fpats])]
+
+class Downloader(object):
+    def __init__(self, session, manifest, outdir, verify=True, keep_xml=False, timeout=60, retry=10):
+        self.session = session
+        self.manifest = manifest
+        self.outdir = outdir
+        self.verify = verify
+        self.keep_xml = keep_xml
+        self.timeout = timeout
+        self.retry = retry
+
+    def __call__(self, granule):
+        fname, dir_url = granule
+        rec = dict(file=fname, url=dir_url+fname, status="failed", size=None,
+                   checksum_type=None, checksum=None, error=None)
+        try:
+            size, cksum_type, cksum = None, None, None
+            if self.verify:
+                xml_str = self._fetchXml(dir_url+fname+".xml")
+                if xml_str is not None:
+                    size, cksum_type, cksum = parseGranuleXml(xml_str, fname)
+                    if self.keep_xml:
+                        with open(os.path.join(self.outdir, fname+".xml"), "wb") as fobj:
+                            fobj.write(xml_str)
+
+            outfile = os.path.join(self.outdir, fname)
+            rec["size"] = downloadFile(self.session, rec["url"], outfile, timeout=self.timeout, retry=self.retry)
+            if size is not None and size != rec["size"]:
+                os.remove(outfile)
+                raise IOError("size {0:d} differs from {1:d} in the metadata".format(rec["size"], size))
+            if cksum_type is not None and cksum is not None:
+                rec["checksum_type"] = cksum_type
+                rec["checksum"] = calcChecksum(outfile, cksum_type)
+                if rec["checksum"].strip().lower() != cksum.strip().lower():
+                    os.remove(outfile)
+                    raise IOError("{0:s} {1:s} differs from {2:s} in the metadata".format(cksum_type, rec["checksum"], cksum))
+            rec["status"] = "done"
+        except Exception as e:
+            rec["error"] = "{0:s}: {1:s}".format(type(e).__name__, str(e))
+        rec["time"] = time.time()
+        self.manifest.add(rec)
+        return rec
+
+    def _fetchXml(self, url):
+        def fetch():
+            r = self.session.get(url, timeout=self.timeout)
+            if r.status_code == 404:
+                return None
+            r.raise_for_status()
+            expected = expectedSize(r)
+            if expected is not None and len(r.content) < expected:
+                raise IOError("incomplete transfer, {0:d} of {1:d} bytes".format(len(r.content), expected))
+            return r.content
+        return retryCall(fetch, self.retry, url)
+
+def main(cmdargs):
+    year = cmdargs.year
+    begin_doy = cmdargs.begin_doy
+    end_doy = cmdargs.end_doy
+    if begin_doy is None:
+        begin_doy = 1
+    if end_doy is None:
+        end_doy = (datetime.date(year+1, 1, 1) - datetime.date(year, 1, 1)).days
+
+    doys = [doy for doy in range(begin_doy, end_doy+1)
+            if datetime.date(year, 1, 1) + datetime.timedelta(days=doy-1) >= MODIS_BEGIN_DATE]
+
+    if not os.path.isdir(cmdargs.outdir):
+        raise RuntimeError(colorErrorStr("{0:s} not exists.".format(cmdargs.outdir)))
+    outdir = os.path.join(cmdargs.outdir, str(year))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    tilestr = "all" if len(cmdargs.tile) == 0 else "_".join(cmdargs.tile)
+    manifest_file = os.path.join(outdir, "dl_lp_daac_{0:s}_{1:03d}_manifest.jsonl".format(cmdargs.par, cmdargs.num))
+    manifest = Manifest(manifest_file)
+    listing_cache = ListingCache(os.path.join(cmdargs.outdir, ".listing_cache"), cmdargs.listing_ttl)
+    session = openSession(cmdargs.user, cmdargs.password, nconn=cmdargs.nthreads)
+
+    pool = ThreadPool(cmdargs.nthreads)
+    try:
+        print colorLogStr("List {0:d} days of {1:s} {2:s} {3:d}".format(len(doys), cmdargs.par, tilestr, year))
+        list_func = lambda doy: findGranules(session, listing_cache, cmdargs.url_base, cmdargs.par, cmdargs.num,
+                                             year, doy, cmdargs.tile, cmdargs.fmt,
+                                             timeout=cmdargs.timeout, retry=cmdargs.retry)
+        granules = []
+        for g in pool.imap(list_func, doys):
+            granules.extend(g)
+        todo = [g for g in granules if not manifest.isDone(g[0], outdir)]
+        print colorLogStr("Found {0:d} granules, {1:d} not downloaded yet".format(len(granules), len(todo)))
+
+        downloader = Downloader(session, manifest, outdir, verify=not cmdargs.no_checksum,
+                                keep_xml=cmdargs.keep_xml, timeout=cmdargs.timeout, retry=cmdargs.retry)
+        nerr = 0
+        for i, rec in enumerate(pool.imap_unordered(downloader, todo)):
+            if rec["status"] == "done":
+                print colorLogStr("[{0:d}/{1:d}] Downloading {2:s}, SUCCESS".format(i+1, len(todo), rec["file"]))
+            else:
+                nerr += 1
+                print colorErrorStr("[{0:d}/{1:d}] Downloading {2:s}, FAILED, {3:s}".format(i+1, len(todo), rec["file"], rec["error"]))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        session.close()
+
+    print colorInfoStr("Finished downloading {0:s} of {1:s} of {2:d} from {3:d} to {4:d}, {5:d} failed. Manifest: ".format(cmdargs.par, tilestr, year, begin_doy, end_doy, nerr)) + colorDimStr(manifest_file)
+    print colorResetStr("")
+    if nerr > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
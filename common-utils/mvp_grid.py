@@ -0,0 +1,144 @@
+# Geometry of the grids of MCD43/VNP43 HDF-EOS5 files from their
+# StructMetadata.0, to map latitude/longitude bounding boxes to the
+# rows and columns of datasets. Supports the sinusoidal grids of tiles
+# and the geographic grids of CMGs, and the MODIS/VIIRS sinusoidal tile
+# scheme of ext/modis-tilemap3.
+#
+# StructMetadata.0 is parsed by the ODL parser of
+# viirs-utils/gen_vnp43_filespec.py.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "viirs-utils"))
+from gen_vnp43_filespec import parseODL
+
+# Radius of the sphere of the MODIS/VIIRS sinusoidal projection, used
+# when ProjParams does not give one.
+SIN_RADIUS = 6371007.181
+
+# Upper left corner of the global sinusoidal grid and the size of its
+# 36 x 18 tiles in meters, i.e. 1200 pixels of 926.62543305 m, the same
+# as the SIN projection of ext/modis-tilemap3/tilemap3.c.
+SIN_ULX = -20015109.354
+SIN_ULY = 10007554.677
+SIN_TILE_SIZE = 1111950.5197665
+SIN_NTILE_H = 36
+SIN_NTILE_V = 18
+
+def gridAttrs(odl_tree):
+    """
+    Attributes of the grids in the ODL tree of StructMetadata.0, e.g.
+    XDim, UpperLeftPointMtrs and Projection, by grid names.
+    """
+    grids = OrderedDict()
+    for gnode in odl_tree.get("GridStructure", {}).values():
+        if not isinstance(gnode, dict):
+            continue
+        grids[gnode["GridName"]] = OrderedDict([(k, v) for k, v in gnode.items() if not isinstance(v, dict)])
+    return grids
+
+def packedDmsToDeg(val):
+    """
+    Convert an angle packed as DDDMMMSSS.SS by HDF-EOS to degrees.
+    """
+    sign = -1. if val < 0 else 1.
+    val = abs(val)
+    deg = np.floor(val/1e6)
+    mnt = np.floor((val - deg*1e6)/1e3)
+    sec = val - deg*1e6 - mnt*1e3
+    return sign*(deg + mnt/60. + sec/3600.)
+
+def gridGeometry(fobj, dsname):
+    """
+    Projection and extent of the grid of a dataset in an HDF-EOS5
+    file, by the grid name in the dataset path HDFEOS/GRIDS/<grid>/...
+    Return a dict of "projection", "radius" for the sinusoidal
+    projection, and "ulx", "uly", "lrx", "lry" as the outer edges of
+    the grid, in meters for the sinusoidal projection or degrees for
+    geographic grids.
+    """
+    grids = gridAttrs(parseODL(str(fobj['HDFEOS INFORMATION']['StructMetadata.0'][()])))
+    parts = dsname.strip("/").split("/")
+    grid_name = parts[parts.index("GRIDS")+1] if "GRIDS" in parts[:-1] else None
+    if grid_name not in grids:
+        if len(grids) != 1:
+            raise RuntimeError("Grid of the dataset {0:s} not found in the StructMetadata.0".format(dsname))
+        grid_name = grids.keys()[0]
+    attrs = grids[grid_name]
+
+    geom = dict(projection=attrs["Projection"])
+    (ulx, uly), (lrx, lry) = attrs["UpperLeftPointMtrs"], attrs["LowerRightMtrs"]
+    if attrs["Projection"] == "HE5_GCTP_SNSOID":
+        radius = attrs.get("ProjParams", [0])[0]
+        geom["radius"] = float(radius) if radius > 0 else SIN_RADIUS
+    elif attrs["Projection"] == "HE5_GCTP_GEO":
+        ulx, uly, lrx, lry = [packedDmsToDeg(v) for v in (ulx, uly, lrx, lry)]
+    else:
+        raise RuntimeError("Projection {0:s} of the grid {1:s} is not supported.".format(attrs["Projection"], grid_name))
+    geom.update(ulx=float(ulx), uly=float(uly), lrx=float(lrx), lry=float(lry))
+    return geom
+
+def latLonToXY(geom, lat, lon):
+    """
+    Project latitudes and longitudes in degrees to the map coordinates
+    of a grid.
+    """
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    if geom["projection"] == "HE5_GCTP_SNSOID":
+        return geom["radius"]*np.radians(lon)*np.cos(np.radians(lat)), geom["radius"]*np.radians(lat)
+    return lon, lat
+
+def bboxToRoi(geom, shape, bbox):
+    """
+    Map a bounding box (min lat, max lat, min lon, max lon) in degrees
+    to the smallest region of interest (row0, row1, col0, col1), end
+    exclusive, of a grid of the given shape covering the box. In the
+    sinusoidal projection the box is not a rectangle, and its extent in
+    x is reached at its corners or where it crosses the equator.
+    """
+    lat0, lat1, lon0, lon1 = bbox
+    lats = [lat0, lat1, lat0, lat1]
+    lons = [lon0, lon0, lon1, lon1]
+    if lat0 < 0 < lat1:
+        lats, lons = lats + [0, 0], lons + [lon0, lon1]
+    x, y = latLonToXY(geom, lats, lons)
+    xres = (geom["lrx"]-geom["ulx"])/float(shape[1])
+    yres = (geom["uly"]-geom["lry"])/float(shape[0])
+    cols = (x-geom["ulx"])/xres
+    rows = (geom["uly"]-y)/yres
+    roi = (max(int(np.floor(np.min(rows))), 0), min(int(np.ceil(np.max(rows))), shape[0]),
+           max(int(np.floor(np.min(cols))), 0), min(int(np.ceil(np.max(cols))), shape[1]))
+    if roi[0] >= roi[1] or roi[2] >= roi[3]:
+        raise RuntimeError("Bounding box lat {0:g} to {1:g}, lon {2:g} to {3:g} does not overlap the grid.".format(lat0, lat1, lon0, lon1))
+    return roi
+
+def sinTileOf(geom, tol=1.0):
+    """
+    Horizontal and vertical indexes (h, v) of the sinusoidal tile of a
+    grid geometry from gridGeometry. Raise an error if the grid is not
+    exactly one tile of the global sinusoidal grid, within tol meters.
+    """
+    if geom["projection"] != "HE5_GCTP_SNSOID":
+        raise RuntimeError("Projection {0:s} is not the sinusoidal projection of tiles.".format(geom["projection"]))
+    h = int(np.round((geom["ulx"]-SIN_ULX)/SIN_TILE_SIZE))
+    v = int(np.round((SIN_ULY-geom["uly"])/SIN_TILE_SIZE))
+    if h < 0 or h >= SIN_NTILE_H or v < 0 or v >= SIN_NTILE_V \
+       or abs(geom["ulx"]-(SIN_ULX+h*SIN_TILE_SIZE)) > tol or abs(geom["uly"]-(SIN_ULY-v*SIN_TILE_SIZE)) > tol \
+       or abs(geom["lrx"]-geom["ulx"]-SIN_TILE_SIZE) > tol or abs(geom["uly"]-geom["lry"]-SIN_TILE_SIZE) > tol:
+        raise RuntimeError("Grid of upper left ({0:f}, {1:f}) and lower right ({2:f}, {3:f}) is not a sinusoidal tile.".format(geom["ulx"], geom["uly"], geom["lrx"], geom["lry"]))
+    return h, v
+
+def sinTilesGeometry(h0, h1, v0, v1, radius=SIN_RADIUS):
+    """
+    Grid geometry, as from gridGeometry, of the block of sinusoidal
+    tiles h0 to h1 and v0 to v1, inclusive.
+    """
+    return dict(projection="HE5_GCTP_SNSOID", radius=radius,
+                ulx=SIN_ULX+h0*SIN_TILE_SIZE, uly=SIN_ULY-v0*SIN_TILE_SIZE,
+                lrx=SIN_ULX+(h1+1)*SIN_TILE_SIZE, lry=SIN_ULY-(v1+1)*SIN_TILE_SIZE)
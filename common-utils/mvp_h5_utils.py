@@ -0,0 +1,377 @@
+# Helpers shared by the tools that scan datasets of MCD43/VNP43 HDF5
+# files window by window: dataset lookup, fill value detection and the
+# iteration over spatial windows sized by a memory limit, or over a
+# random sample of windows for approximate statistics with confidence
+# intervals, and the reading of windows ahead in a background thread.
+# Also the parsing of the names of MCD43/VNP43 granule files.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import re
+import sys
+import Queue
+import threading
+import warnings
+
+import h5py
+import numpy as np
+
+# e.g. MCD43A1.A2018001.h12v04.006.2018010031520.hdf or
+# VNP43C1.A2018001.001.2018012000000.h5
+GRANULE_RE = re.compile(r"^(?P<pid>[A-Za-z0-9]+)\.A(?P<date>\d{7})\.(?:(?P<tile>h\d{2}v\d{2})\.)?(?P<num>\d{3})\.(?P<prod>\d+)\.(?P<ext>hdf|h5)$")
+
+def parseGranuleName(fname):
+    """
+    Return a dict of the product ID, date as YYYYDDD, tile (None for
+    CMGs), collection, production time and extension parsed from the
+    name of a granule file, or None if the name does not follow the
+    naming of MCD43/VNP43 granules.
+    """
+    m = GRANULE_RE.match(os.path.basename(fname))
+    if m is None:
+        return None
+    return m.groupdict()
+
+def findDataset(fobj, dsname, exact=False):
+    """
+    Return the full path of the first dataset in an HDF5 file whose
+    path contains dsname, or None if not found. With exact, the dataset
+    name must be dsname, e.g. BRDF_Albedo_Parameters_M1 but not
+    BRDF_Albedo_Parameters_M10.
+    """
+    if exact:
+        return fobj['/'].visit(lambda name: name if (name.split("/")[-1] == dsname and isinstance(fobj[name], h5py.Dataset)) else None)
+    return fobj['/'].visit(lambda name: name if dsname in name else None)
+
+def getFillValue(sds):
+    """
+    Return the value of the first attribute of a dataset with 'FILL'
+    in its name, or None if there is no such attribute.
+    """
+    for tmp in sds.attrs.keys():
+        if 'FILL' in tmp.upper():
+            fv = sds.attrs[tmp]
+            return fv if np.isscalar(fv) else fv[0]
+    return None
+
+def maxValue(dtype):
+    """
+    Maximum value of a data type, integer or floating point, the fill
+    value of datasets without one.
+    """
+    dtype = np.dtype(dtype)
+    return np.finfo(dtype).max if dtype.kind == "f" else np.iinfo(dtype).max
+
+def getFillValues(sds_list, warn_func=str):
+    """
+    Return the fill values of a list of datasets. The datasets missing
+    a fill value use the maximum value of their data types.
+    """
+    fillvalue_list = []
+    for sds in sds_list:
+        fv = getFillValue(sds)
+        if fv is None:
+            print warn_func("{0:s}:{1:s}, no fill value!".format(os.path.basename(sds.file.filename), sds.name.lstrip("/")))
+        fillvalue_list.append(fv)
+    if np.sum([fv is None for fv in fillvalue_list]) > 0:
+        fillvalue_list = [maxValue(sds.dtype) if fv is None else fv for sds, fv in zip(sds_list, fillvalue_list)]
+        warnings.warn(warn_func("Some input datasets miss fill value. Use the maximum values of their data types."), RuntimeWarning)
+        print fillvalue_list
+    return fillvalue_list
+
+def windowSize(nbytes_per_pixel, mem_size, multiple=1, align=None):
+    """
+    Side length of square windows of about mem_size bytes, rounded down
+    to a multiple of the given number of pixels. If align is given as
+    the chunk shape of a dataset, the window is further rounded down to
+    whole chunks when it spans more than one chunk, so that no chunk is
+    decompressed twice. Return (ysize, xsize).
+    """
+    size = multiple*int(np.sqrt(mem_size/float(nbytes_per_pixel))/multiple)
+    size = max(size, multiple)
+    ysize, xsize = size, size
+    if align is not None:
+        ysize = (ysize//align[0])*align[0] if ysize > align[0] else ysize
+        xsize = (xsize//align[1])*align[1] if xsize > align[1] else xsize
+    return ysize, xsize
+
+def checkRoi(roi, shape):
+    """
+    Check a region of interest (row0, row1, col0, col1), end exclusive,
+    against a grid shape and return it as a tuple of ints. None means
+    the whole grid.
+    """
+    if roi is None:
+        return (0, shape[0], 0, shape[1])
+    roi = tuple([int(v) for v in roi])
+    if roi[0] < 0 or roi[2] < 0 or roi[1] > shape[0] or roi[3] > shape[1] or roi[0] >= roi[1] or roi[2] >= roi[3]:
+        raise RuntimeError("ROI rows {0:d}-{1:d}, columns {2:d}-{3:d} is empty or outside the grid of {4:d} rows and {5:d} columns.".format(roi[0], roi[1], roi[2], roi[3], shape[0], shape[1]))
+    return roi
+
+def iterWindows(shape, ysize, xsize, roi=None):
+    """
+    Iterate over the windows of a 2D grid of the given shape, column
+    of windows by column of windows. Yield (iy, ix, ncy, ncx, row
+    slice, column slice). The last row and column of windows extend to
+    the edges of the grid and can be up to twice as large.
+
+    If a region of interest (row0, row1, col0, col1) is given, windows
+    outside it are skipped and the others are clipped to it, keeping
+    the layout of windows of the whole grid.
+    """
+    ncx = max(shape[1]//xsize, 1)
+    ncy = max(shape[0]//ysize, 1)
+    for ix in range(ncx):
+        for iy in range(ncy):
+            xbeg, xend = ix*xsize, shape[1] if ix==ncx-1 else (ix+1)*xsize
+            ybeg, yend = iy*ysize, shape[0] if iy==ncy-1 else (iy+1)*ysize
+            if roi is not None:
+                ybeg, yend = max(ybeg, roi[0]), min(yend, roi[1])
+                xbeg, xend = max(xbeg, roi[2]), min(xend, roi[3])
+                if ybeg >= yend or xbeg >= xend:
+                    continue
+            yield iy, ix, ncy, ncx, slice(ybeg, yend), slice(xbeg, xend)
+
+def readWindow(sds, rows, cols, band=1, out=None):
+    """
+    Read a window of a 2D dataset, or of one band of a 3D dataset with
+    the band index starting from 1. If out is given as an array of the
+    shape of the window, e.g. from a BufferRing, read into it instead of
+    a new array.
+    """
+    if sds.ndim == 2:
+        sel = np.s_[rows, cols]
+    elif sds.ndim == 3:
+        sel = np.s_[rows, cols, band-1]
+    else:
+        raise RuntimeError("Unexpected number of dimensions of input dataset!")
+    if out is None:
+        return sds[sel]
+    sds.read_direct(out, source_sel=sel)
+    return out
+
+class BufferRing(object):
+    """
+    Ring of reusable buffers for windows read ahead, a slot per window
+    in flight and in each slot a buffer per stream of windows, e.g. the
+    data and QA of each input, of the given sizes in bytes.
+    """
+    def __init__(self, nslots, nbytes_list):
+        self.bufs = [[np.empty(int(nbytes), dtype=np.uint8) for nbytes in nbytes_list] for k in range(nslots)]
+
+    def view(self, slot, stream, shape, dtype):
+        """
+        Array of the given shape and data type over the buffer of a
+        stream in a slot.
+        """
+        dtype = np.dtype(dtype)
+        return self.bufs[slot][stream][0:int(np.prod(shape))*dtype.itemsize].view(dtype).reshape(shape)
+
+def prefetchWindows(windows, read_func, depth=2):
+    """
+    Iterate over windows and yield (window, read_func(window, slot)),
+    with the next depth windows read ahead in a background thread while
+    the current one is processed. A window read into slot k % (depth+2)
+    of a BufferRing of depth+2 slots never overwrites a window still in
+    use: depth windows wait in the queue and the consumer holds one.
+    With depth 0, the windows are read in the calling thread into slot
+    0. Errors of read_func are raised in the calling thread.
+
+    h5py serializes the calls to the HDF5 library with a global lock,
+    so the reads and decompression overlap with the processing by numpy
+    of the earlier windows, not with each other.
+    """
+    if depth < 1:
+        for window in windows:
+            yield window, read_func(window, 0)
+        return
+
+    nslots = depth + 2
+    queue = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    def put(item):
+        # the consumer drains the queue only once when it stops, so wait
+        # on a full queue in short steps and give up once stopped.
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for k, window in enumerate(windows):
+                if stop.is_set() or not put((window, read_func(window, k % nslots), None)):
+                    return
+        except Exception:
+            put((None, None, sys.exc_info()))
+            return
+        put(None)
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            window, result, exc_info = item
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield window, result
+    finally:
+        # let a reader waiting on a full queue see the stop.
+        stop.set()
+        while not queue.empty():
+            queue.get_nowait()
+        thread.join()
+
+class WindowMask(object):
+    """
+    Mask of the pixels to process from a dataset on the same grid as
+    the data, e.g. a land/water layer. Pixels whose mask values are in
+    the given list are kept, or if no list is given, pixels whose mask
+    values are nonzero and not fill values.
+    """
+    def __init__(self, sds, values=None, band=1):
+        self.sds = sds
+        self.values = values
+        self.band = band
+        self.fillv = getFillValue(sds)
+
+    def window(self, rows, cols):
+        """
+        Read the mask of a window and shrink the window to the bounding
+        box of the kept pixels, so that only this hyperslab of the data
+        needs reading. Return (row slice, column slice, boolean array of
+        the kept pixels in the shrunk window), or None if no pixel of
+        the window is kept.
+        """
+        mask = readWindow(self.sds, rows, cols, self.band)
+        if self.values is None:
+            keep = mask != 0
+            if self.fillv is not None:
+                keep = np.logical_and(keep, mask != self.fillv)
+        else:
+            keep = np.in1d(mask, self.values).reshape(mask.shape)
+        kr = np.nonzero(np.any(keep, axis=1))[0]
+        if kr.size == 0:
+            return None
+        kc = np.nonzero(np.any(keep, axis=0))[0]
+        return slice(rows.start+kr[0], rows.start+kr[-1]+1), slice(cols.start+kc[0], cols.start+kc[-1]+1), \
+            keep[kr[0]:kr[-1]+1, kc[0]:kc[-1]+1]
+
+# Minimum number of sampled units. The cluster bootstrap over fewer
+# units gives intervals of much lower coverage than their level, e.g.
+# about 50% for "95%" intervals from 2 units and 89% from 9.
+MIN_SAMPLE_UNITS = 20
+
+def sampleUnit(sds):
+    """
+    Sampling unit of a dataset for approximate statistics: its native
+    chunk, so that a sampled unit is decompressed exactly once, or a
+    row if it is not chunked. Return (rows, cols).
+    """
+    if sds.chunks is not None:
+        return tuple(sds.chunks[0:2])
+    return (1, sds.shape[1])
+
+def sampleWindows(shape, unit, fraction=None, size=None, seed=0, roi=None):
+    """
+    Spatially stratified random sample of the units of a 2D grid. The
+    units in row-major order are split into as many strata of
+    consecutive units as units to sample, and one unit is drawn at
+    random from each stratum. The number of units is either the given
+    fraction of all units, or enough units to cover the given number
+    of pixels, and at least MIN_SAMPLE_UNITS units, or all units of a
+    smaller grid, so that confidence intervals can be estimated.
+
+    If a region of interest (row0, row1, col0, col1) is given, only the
+    units overlapping it are sampled, clipped to it.
+
+    Return the list of sampled windows in the same form as yielded by
+    iterWindows, i.e. (k, 0, n, 1, row slice, column slice) for the
+    k-th of n sampled units, and the total number of units.
+    """
+    roi = checkRoi(roi, shape)
+    uy0, ux0 = roi[0]//unit[0], roi[2]//unit[1]
+    nuy = int(np.ceil(roi[1]/float(unit[0]))) - uy0
+    nux = int(np.ceil(roi[3]/float(unit[1]))) - ux0
+    total = nuy*nux
+    if fraction is not None:
+        n = int(np.ceil(fraction*total))
+    else:
+        n = int(np.ceil(size/float(unit[0]*unit[1])))
+    n = min(max(n, MIN_SAMPLE_UNITS), total)
+
+    rng = np.random.RandomState(seed)
+    bounds = np.arange(n+1, dtype=np.int64)*total//n
+    picks = bounds[:-1] + (rng.random_sample(n)*(bounds[1:]-bounds[:-1])).astype(np.int64)
+    windows = []
+    for k, u in enumerate(picks):
+        uy, ux = divmod(int(u), nux)
+        uy, ux = uy+uy0, ux+ux0
+        rows = slice(max(uy*unit[0], roi[0]), min((uy+1)*unit[0], roi[1]))
+        cols = slice(max(ux*unit[1], roi[2]), min((ux+1)*unit[1], roi[3]))
+        windows.append((k, 0, n, 1, rows, cols))
+    return windows, total
+
+def weightedStats(values, weights, pct_list):
+    """
+    Mean, standard deviation, root mean square and percentiles of
+    sorted values with weights. A percentile is the first value at
+    which the cumulative weight reaches it, the same as the histogram
+    percentiles of the full scans.
+    """
+    wsum = np.sum(weights)
+    mean = np.dot(weights, values)/wsum
+    ms = np.dot(weights, values*values)/wsum
+    idx = np.searchsorted(np.cumsum(weights)/wsum*100, pct_list)
+    pos = np.nonzero(weights)[0]
+    idx[0], idx[-1] = pos[0], pos[-1]
+    idx = np.minimum(idx, len(values)-1)
+    return np.concatenate([[mean, np.sqrt(max(ms-mean*mean, 0)), np.sqrt(ms)], values[idx]])
+
+def sampleStats(values_list, pct_list, nboot=200, seed=0, exact=False, level=95.):
+    """
+    Estimate statistics from the valid values of sampled windows, with
+    percentile bootstrap confidence intervals at the given level. The
+    bootstrap resamples whole windows with replacement, which keeps the
+    spatial correlation of pixels within a window in the intervals. If
+    exact, i.e. every unit of the grid was sampled, the intervals
+    collapse to the estimates. With less than MIN_SAMPLE_UNITS sampled
+    windows of valid values, e.g. most windows outside a mask, the
+    intervals are unknown, i.e. NaN, rather than too narrow.
+
+    Return (estimates, lower bounds, upper bounds) of mean, standard
+    deviation, root mean square and the percentiles, all NaN if there
+    is no valid value.
+    """
+    values_list = [v for v in values_list if v.size > 0]
+    nstats = 3 + len(pct_list)
+    if len(values_list) == 0:
+        nan = np.full(nstats, np.nan)
+        return nan, nan.copy(), nan.copy()
+    n = len(values_list)
+    values = np.concatenate(values_list)
+    groups = np.repeat(np.arange(n), [v.size for v in values_list])
+    order = np.argsort(values, kind="mergesort")
+    values, groups = values[order], groups[order]
+
+    est = weightedStats(values, np.ones(values.size), pct_list)
+    if exact:
+        return est, est.copy(), est.copy()
+    if n < MIN_SAMPLE_UNITS:
+        warnings.warn("Only {0:d} sampled chunks or rows have valid values, fewer than {1:d} for bootstrap confidence intervals. The intervals are NaN.".format(n, MIN_SAMPLE_UNITS), RuntimeWarning)
+        return est, np.full(nstats, np.nan), np.full(nstats, np.nan)
+    rng = np.random.RandomState(seed)
+    boot = np.zeros((nboot, nstats))
+    for b in range(nboot):
+        w = np.bincount(rng.randint(0, n, n), minlength=n).astype(np.double)
+        boot[b, :] = weightedStats(values, w[groups], pct_list)
+    lo, hi = np.percentile(boot, [(100-level)*0.5, 100-(100-level)*0.5], axis=0)
+    return est, lo, hi
@@ -0,0 +1,174 @@
+# Virtual mosaic of sinusoidal tiles of MCD43A/VNP43IA/VNP43MA
+# granules, presenting a dataset of a list of tile files as one large
+# grid to the window reading of the preview and comparison tools, e.g.
+# to compare products over a continent in one pass, with one set of
+# histograms and percentiles. The mosaic is an in-process index of the
+# tiles by their positions in the global sinusoidal grid. A window
+# reads only the tiles it overlaps, and tiles missing from the list are
+# fill values without any reading.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import re
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+from mvp_h5_utils import findDataset, getFillValue, maxValue
+from mvp_grid import gridGeometry, sinTileOf, sinTilesGeometry
+
+TILE_RE = re.compile(r"\.h(?P<h>\d{2})v(?P<v>\d{2})\.")
+
+def readTileList(fname):
+    """
+    Read a list of tile files, one per line, skipping blank lines and
+    comments starting with #. Relative paths are relative to the
+    directory of the list file.
+    """
+    tile_files = []
+    with open(fname, "r") as fobj:
+        for line in fobj:
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            if not os.path.isabs(line):
+                line = os.path.join(os.path.dirname(fname), line)
+            tile_files.append(line)
+    if len(tile_files) == 0:
+        raise RuntimeError("No tile files listed in {0:s}".format(fname))
+    return tile_files
+
+def datasetInfo(fobj, full_dsname):
+    """
+    Name, shape, data type, chunks, attributes and the radius of the
+    grid of a dataset, to check the tiles against and to set up a
+    mosaic without opening the tiles again.
+    """
+    sds = fobj[full_dsname]
+    return dict(name=full_dsname, shape=sds.shape, dtype=sds.dtype, chunks=sds.chunks,
+                attrs=dict(sds.attrs.items()), radius=gridGeometry(fobj, full_dsname).get("radius"))
+
+def tileIndex(tile_files, dsname_list):
+    """
+    Index the tile files by their tiles (h, v), from the grid geometry
+    of the first dataset of a list in their StructMetadata.0, checked
+    against the tile IDs in the file names if any. Every tile must have
+    all the datasets, each of the same shape and data type as in the
+    first file. Return the OrderedDict of the index, and the list of
+    datasetInfo of the datasets in the first file.
+    """
+    tiles = OrderedDict()
+    info_list = None
+    for fname in tile_files:
+        with h5py.File(fname, "r") as fobj:
+            full_dsname_list = [findDataset(fobj, dsname) for dsname in dsname_list]
+            for dsname, tmp in zip(dsname_list, full_dsname_list):
+                if tmp is None:
+                    raise RuntimeError("Dataset name {0:s} NOT found in {1:s}".format(dsname, fname))
+            if info_list is None:
+                info_list = [datasetInfo(fobj, tmp) for tmp in full_dsname_list]
+            for info, tmp in zip(info_list, full_dsname_list):
+                if fobj[tmp].shape != info["shape"] or fobj[tmp].dtype != info["dtype"]:
+                    raise RuntimeError("Dataset {0:s} of {1:s} is of another shape or data type than in {2:s}".format(tmp, fname, tile_files[0]))
+            try:
+                hv = sinTileOf(gridGeometry(fobj, full_dsname_list[0]))
+            except RuntimeError as exc:
+                raise RuntimeError("{0:s}: {1:s}".format(fname, str(exc)))
+        m = TILE_RE.search(os.path.basename(fname))
+        if m is not None and (int(m.group("h")), int(m.group("v"))) != hv:
+            raise RuntimeError("Tile ID in the file name of {0:s} does not match its grid of tile h{1:02d}v{2:02d}".format(fname, hv[0], hv[1]))
+        if hv in tiles:
+            raise RuntimeError("Tile h{0:02d}v{1:02d} is listed twice, by {2:s} and {3:s}".format(hv[0], hv[1], tiles[hv], fname))
+        tiles[hv] = fname
+    return tiles, info_list
+
+def tileExtent(tiles_list):
+    """
+    Smallest block of tiles (h0, h1, v0, v1), inclusive, covering the
+    tiles of a list of tile indexes, so that the mosaics of several
+    inputs share the same grid.
+    """
+    hs = [h for tiles in tiles_list for h, v in tiles.keys()]
+    vs = [v for tiles in tiles_list for h, v in tiles.keys()]
+    return min(hs), max(hs), min(vs), max(vs)
+
+class TileMosaic(object):
+    """
+    Dataset of a block of sinusoidal tiles, with the attributes of
+    h5py datasets used by the window reading, i.e. shape, ndim, dtype,
+    chunks, attrs, name, file.filename, slicing by rows, columns and a
+    band, and read_direct. The tile files are opened once and kept open
+    until close().
+    """
+    def __init__(self, tiles, info, extent, filename=""):
+        """
+        tiles and info are from tileIndex, the index of the tiles and
+        the datasetInfo of the dataset already checked in every tile.
+        """
+        self.tiles = tiles
+        self.extent = extent
+        self.filename = filename
+        # as for h5py datasets, sds.file.filename
+        self.file = self
+
+        self.name = info["name"]
+        self.tile_shape = info["shape"]
+        self.dtype = info["dtype"]
+        self.chunks = info["chunks"]
+        self.attrs = info["attrs"]
+        self.radius = info["radius"]
+        self.fobjs = OrderedDict()
+        self.tile_sds = OrderedDict()
+        for hv, fname in tiles.items():
+            self.fobjs[hv] = h5py.File(fname, "r")
+            self.tile_sds[hv] = self.fobjs[hv][self.name]
+
+        self.fillv = getFillValue(self)
+        if self.fillv is None:
+            # the same as the fill values of the window reading
+            self.fillv = maxValue(self.dtype)
+        h0, h1, v0, v1 = extent
+        self.ndim = len(self.tile_shape)
+        self.shape = ((v1-v0+1)*self.tile_shape[0], (h1-h0+1)*self.tile_shape[1]) + tuple(self.tile_shape[2:])
+
+    def geometry(self):
+        """
+        Grid geometry of the mosaic, as from gridGeometry.
+        """
+        h0, h1, v0, v1 = self.extent
+        return sinTilesGeometry(h0, h1, v0, v1, self.radius)
+
+    def _read(self, sel, out):
+        rows, cols = sel[0], sel[1]
+        trows, tcols = self.tile_shape[0], self.tile_shape[1]
+        h0, h1, v0, v1 = self.extent
+        out[...] = self.fillv
+        for tv in range(rows.start//trows, (rows.stop-1)//trows+1):
+            for th in range(cols.start//tcols, (cols.stop-1)//tcols+1):
+                sds = self.tile_sds.get((h0+th, v0+tv))
+                if sds is None:
+                    continue
+                r0, r1 = max(rows.start, tv*trows), min(rows.stop, (tv+1)*trows)
+                c0, c1 = max(cols.start, th*tcols), min(cols.stop, (th+1)*tcols)
+                tsel = (slice(r0-tv*trows, r1-tv*trows), slice(c0-th*tcols, c1-th*tcols)) + tuple(sel[2:])
+                out[r0-rows.start:r1-rows.start, c0-cols.start:c1-cols.start] = sds[tsel]
+        return out
+
+    def __getitem__(self, sel):
+        rows, cols = sel[0], sel[1]
+        shape = (rows.stop-rows.start, cols.stop-cols.start) + tuple(self.shape[2:])[len(sel)-2:]
+        return self._read(sel, np.empty(shape, dtype=self.dtype))
+
+    def read_direct(self, dest, source_sel):
+        self._read(source_sel, dest)
+
+    def close(self):
+        """
+        Close the tile files.
+        """
+        for fobj in self.fobjs.values():
+            fobj.close()
+        self.fobjs.clear()
+        self.tile_sds.clear()
@@ -0,0 +1,175 @@
+# Content-addressed cache of the outputs of the preview and comparison
+# tools, so that reruns on unchanged granules with unchanged options
+# skip the data scan.
+#
+# A cache key is the SHA1 digest of the identities of the input files
+# (path, size, modification time and optionally a checksum of the file
+# content) and every option that affects the outputs. Each cache entry
+# is a directory under the cache directory holding the output files and
+# a few text outputs of a run, e.g. the CSV text and the rows of stats,
+# all that a cache hit needs to restore. The least recently used
+# entries are evicted when the total size of the cache goes beyond a
+# given limit.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+# Bump when the content or layout of cache entries changes so that
+# stale entries are never hit.
+CACHE_VERSION = 3
+ENTRY_META = "entry.json"
+
+def fileIdentity(fname, checksum=False, blocksize=2**22):
+    """
+    Identity of a file for a cache key: the path as given, the real
+    path, the size, the modification time and, if checksum is True, the
+    SHA1 digest of the file content.
+    """
+    st = os.stat(fname)
+    ident = dict(path=fname, realpath=os.path.realpath(fname),
+                 size=st.st_size, mtime=st.st_mtime)
+    if checksum:
+        h = hashlib.sha1()
+        with open(fname, "rb") as fobj:
+            for blk in iter(lambda: fobj.read(blocksize), b""):
+                h.update(blk)
+        ident["sha1"] = h.hexdigest()
+    return ident
+
+def dirSize(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+class ResultCache(object):
+    def __init__(self, cache_dir, max_bytes=1e9, checksum=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.checksum = checksum
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # another process may have just created it.
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+    def makeKey(self, tool, infiles, opts):
+        """
+        Key of a run of a tool on a list of input files with a
+        dictionary of the options that affect the outputs.
+        """
+        key_dict = dict(version=CACHE_VERSION, tool=tool,
+                        inputs=[fileIdentity(fname, checksum=self.checksum) for fname in infiles],
+                        opts=opts)
+        key_str = json.dumps(key_dict, sort_keys=True, default=str)
+        return hashlib.sha1(key_str.encode("utf-8")).hexdigest()
+
+    def _entryDir(self, key):
+        return os.path.join(self.cache_dir, key[0:2], key)
+
+    def get(self, key):
+        """
+        Return the metadata of a cache entry as a dictionary, with the
+        paths to the cached files under "files" and the cached texts
+        under "texts", or None if the key is not in the cache.
+        """
+        edir = self._entryDir(key)
+        meta_file = os.path.join(edir, ENTRY_META)
+        try:
+            with open(meta_file, "r") as fobj:
+                meta = json.load(fobj)
+        except (IOError, OSError, ValueError):
+            return None
+        # touch the entry as the most recently used.
+        try:
+            os.utime(meta_file, None)
+        except OSError:
+            pass
+        meta["files"] = dict([(name, os.path.join(edir, "files", fname)) for name, fname in meta["files"].items()])
+        return meta
+
+    def put(self, key, files=None, texts=None):
+        """
+        Store the outputs of a run under a key.
+
+        files: dictionary of a logical name to the path of an output
+        file to be copied into the cache.
+
+        texts: dictionary of a logical name to a string.
+        """
+        files = {} if files is None else files
+        texts = {} if texts is None else texts
+
+        edir = self._entryDir(key)
+        if os.path.isdir(edir):
+            return
+        # Write to a temporary directory first and then rename it, so
+        # concurrent readers never see a partial entry.
+        tmpdir = tempfile.mkdtemp(prefix=".tmp_{0:s}_".format(key), dir=self.cache_dir)
+        try:
+            os.makedirs(os.path.join(tmpdir, "files"))
+            meta_files = {}
+            for i, (name, src) in enumerate(sorted(files.items())):
+                fname = "{0:03d}_{1:s}".format(i, os.path.basename(src))
+                shutil.copyfile(src, os.path.join(tmpdir, "files", fname))
+                meta_files[name] = fname
+            meta = dict(key=key, created=time.time(), files=meta_files, texts=texts)
+            with open(os.path.join(tmpdir, ENTRY_META), "w") as fobj:
+                json.dump(meta, fobj)
+
+            if not os.path.isdir(os.path.dirname(edir)):
+                try:
+                    os.makedirs(os.path.dirname(edir))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(edir)):
+                        raise
+            try:
+                os.rename(tmpdir, edir)
+            except OSError:
+                # another process has stored the same entry.
+                pass
+        finally:
+            if os.path.isdir(tmpdir):
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        self.evict()
+
+    def restoreFile(self, entry, name, dst):
+        shutil.copyfile(entry["files"][name], dst)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the total size of
+        the cache is within the limit.
+        """
+        entries = []
+        for sub in os.listdir(self.cache_dir):
+            subdir = os.path.join(self.cache_dir, sub)
+            if sub.startswith(".") or not os.path.isdir(subdir):
+                continue
+            for key in os.listdir(subdir):
+                edir = os.path.join(subdir, key)
+                try:
+                    atime = os.path.getmtime(os.path.join(edir, ENTRY_META))
+                except OSError:
+                    continue
+                entries.append((atime, dirSize(edir), edir))
+
+        total = sum([e[1] for e in entries])
+        for atime, size, edir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(edir, ignore_errors=True)
+            total -= size
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+# Append-only columnar store of the stats rows of the preview and
+# comparison tools across runs, and query of the store.
+#
+# The store is one HDF5 file with a group per tool, i.e. a table, and
+# in each table one resizable 1D dataset per column, so that a query
+# reads only the columns it filters on and outputs. Columns are typed:
+# 64-bit integers, 64-bit floats or variable-length strings, and hold
+# the values as computed by the tools, not as formatted in their CSV
+# outputs. Missing values, e.g. for rows of runs without a column, are
+# INT_MISSING, the smallest 64-bit integer, outside the range of any
+# date, collection or count, NaN and empty strings. The number of
+# committed rows is an attribute of the table updated after all its
+# columns are written, so a run interrupted in the middle of an append
+# leaves no partial rows. Writers and readers of a store take an
+# exclusive or shared lock on a lock file next to it, so that
+# concurrent runs can append safely.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import re
+import sys
+import csv
+import json
+import time
+import fcntl
+import fnmatch
+import argparse
+from collections import OrderedDict
+from StringIO import StringIO
+
+import h5py
+import numpy as np
+
+import colorama
+colorama.init(autoreset=True)
+# define some color schemes for message output control
+colorWarnStr = lambda msg: colorama.Fore.YELLOW + str(msg) + colorama.Style.RESET_ALL
+colorErrorStr = lambda msg: colorama.Fore.RED + str(msg) + colorama.Style.RESET_ALL
+colorInfoStr = lambda msg: colorama.Fore.GREEN + str(msg) + colorama.Style.RESET_ALL
+colorDimStr = lambda msg: colorama.Style.DIM + str(msg) + colorama.Style.RESET_ALL
+colorLogStr = lambda msg: str(msg)
+colorResetStr = lambda msg: colorama.Style.RESET_ALL + str(msg)
+
+from mvp_h5_utils import parseGranuleName
+
+# Bump when the layout of the store changes.
+STORE_VERSION = 2
+CHUNK_ROWS = 4096
+
+STR_DTYPE = h5py.special_dtype(vlen=str)
+INT_MISSING = np.iinfo(np.int64).min
+
+def granuleColumns(fname, suffix=""):
+    """
+    Columns of the product ID, date as YYYYDDD, tile and collection
+    version parsed from a granule file name, with missing values if the
+    name does not follow the naming of MCD43/VNP43 granules.
+    """
+    gd = parseGranuleName(fname)
+    if gd is None:
+        gd = dict(pid="", date=INT_MISSING, tile="", num=INT_MISSING)
+    return OrderedDict([("product"+suffix, gd["pid"]), ("date"+suffix, int(gd["date"])),
+                        ("tile"+suffix, gd["tile"] or ""), ("collection"+suffix, int(gd["num"]))])
+
+def statsRow(header, values):
+    """
+    A row of stats as an OrderedDict of column names and the values of
+    a tool, with numpy scalars converted to Python numbers.
+    """
+    return OrderedDict([(k, v.item() if isinstance(v, np.generic) else v) for k, v in zip(header, values)])
+
+def rowsToJson(rows):
+    return json.dumps(rows)
+
+def rowsFromJson(rows_str):
+    return json.loads(rows_str, object_pairs_hook=OrderedDict)
+
+def columnDtype(val):
+    if isinstance(val, (bool, int, long, np.integer, np.bool_)):
+        return np.dtype(np.int64)
+    if isinstance(val, (float, np.floating)):
+        return np.dtype(np.float64)
+    return STR_DTYPE
+
+def missingValue(dtype):
+    if dtype == np.int64:
+        return INT_MISSING
+    if dtype == np.float64:
+        return np.nan
+    return ""
+
+def isMissing(val):
+    if isinstance(val, (int, long, np.integer)):
+        return val == INT_MISSING
+    if isinstance(val, (float, np.floating)):
+        return np.isnan(val)
+    return False
+
+class ResultsStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + ".lock"
+
+    def _lock(self, exclusive):
+        lock_fobj = open(self.lock_path, "a")
+        fcntl.flock(lock_fobj, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return lock_fobj
+
+    def append(self, table, rows):
+        """
+        Append rows, a list of dicts of column names and values, to a
+        table. New columns are added with missing values for the earlier
+        rows, and the columns missing in the rows get missing values.
+        """
+        if len(rows) == 0:
+            return
+        lock_fobj = self._lock(True)
+        try:
+            with h5py.File(self.path, "a") as fobj:
+                version = int(fobj.attrs.get("store_version", STORE_VERSION))
+                if version != STORE_VERSION:
+                    raise RuntimeError(colorErrorStr("Results store {0:s} is of version {1:d}, not the current version {2:d}".format(self.path, version, STORE_VERSION)))
+                fobj.attrs["store_version"] = STORE_VERSION
+                grp = fobj.require_group(table)
+                nrows = int(grp.attrs.get("nrows", 0))
+                nnew = len(rows)
+                names = list(grp.attrs.get("columns", []))
+                for row in rows:
+                    names = names + [k for k in row.keys() if k not in names]
+                for name in names:
+                    if name not in grp:
+                        val = [row[name] for row in rows if name in row][0]
+                        dtype = columnDtype(val)
+                        grp.create_dataset(name, shape=(nrows,), maxshape=(None,), dtype=dtype,
+                                           chunks=(CHUNK_ROWS,), compression="gzip",
+                                           fillvalue=missingValue(dtype) if dtype != STR_DTYPE else None)
+                        if nrows > 0 and dtype == STR_DTYPE:
+                            grp[name][:] = np.array([""]*nrows, dtype=object)
+                    dset = grp[name]
+                    dtype = np.dtype(np.int64) if dset.dtype == np.int64 else (np.dtype(np.float64) if dset.dtype == np.float64 else STR_DTYPE)
+                    vals = [row.get(name, missingValue(dtype)) for row in rows]
+                    try:
+                        if dtype == STR_DTYPE:
+                            vals = np.array([str(v) for v in vals], dtype=object)
+                        else:
+                            vals = np.array(vals, dtype=dtype)
+                    except (TypeError, ValueError):
+                        raise RuntimeError(colorErrorStr("Values of column {0:s} of table {1:s} do not match its type {2:s}".format(name, table, str(dset.dtype))))
+                    # also drop the rows of an interrupted append past
+                    # the committed rows.
+                    dset.resize((nrows+nnew,))
+                    dset[nrows:] = vals
+                grp.attrs["columns"] = np.array(names, dtype=STR_DTYPE)
+                # commit the rows.
+                grp.attrs["nrows"] = nrows + nnew
+        finally:
+            lock_fobj.close()
+
+    def tables(self):
+        """
+        Return a list of (table, number of rows, column names).
+        """
+        lock_fobj = self._lock(False)
+        try:
+            with h5py.File(self.path, "r") as fobj:
+                return [(table, int(fobj[table].attrs.get("nrows", 0)), list(fobj[table].attrs.get("columns", []))) 
+                        for table in fobj.keys()]
+        finally:
+            lock_fobj.close()
+
+    def query(self, table, columns=None, eq=None, ranges=None):
+        """
+        Query the rows of a table whose columns equal given values, with
+        shell-style wildcards for strings, e.g. {"dataset": "*BSA*"},
+        and are within given inclusive ranges, e.g. {"date": (2018001,
+        2018365)}. Only the filtered columns and the output columns, all
+        columns if None, are read. Return an OrderedDict of column names
+        and arrays.
+        """
+        eq = {} if eq is None else eq
+        ranges = {} if ranges is None else ranges
+        lock_fobj = self._lock(False)
+        try:
+            with h5py.File(self.path, "r") as fobj:
+                if table not in fobj:
+                    raise RuntimeError(colorErrorStr("Table {0:s} NOT found in {1:s}".format(table, self.path)))
+                grp = fobj[table]
+                nrows = int(grp.attrs.get("nrows", 0))
+                names = list(grp.attrs.get("columns", []))
+                columns = names if columns is None else columns
+                for name in list(columns) + list(eq.keys()) + list(ranges.keys()):
+                    if name not in names:
+                        raise RuntimeError(colorErrorStr("Column {0:s} NOT found in table {1:s}".format(name, table)))
+
+                keep = np.ones(nrows, dtype=np.bool_)
+                for name, val in eq.items():
+                    col = grp[name][0:nrows]
+                    if grp[name].dtype.kind == "O":
+                        pat = re.compile(fnmatch.translate(str(val)))
+                        keep = np.logical_and(keep, np.array([pat.match(v) is not None for v in col], dtype=np.bool_))
+                    else:
+                        keep = np.logical_and(keep, col == grp[name].dtype.type(val))
+                for name, (lo, hi) in ranges.items():
+                    col = grp[name][0:nrows]
+                    keep = np.logical_and(keep, np.logical_and(col >= lo, col <= hi))
+
+                out = OrderedDict()
+                for name in columns:
+                    out[name] = grp[name][0:nrows][keep]
+                return out
+        finally:
+            lock_fobj.close()
+
+def appendStatsRows(store_path, table, stats_rows, row_cols_list, opts):
+    """
+    Append the rows of stats of a run of a tool, as from statsRow, to a
+    store, each with the given extra columns, e.g. bands and granule
+    columns, the run time and the run options as JSON.
+    """
+    rows = []
+    run_time = time.time()
+    opts_str = json.dumps(opts, sort_keys=True, default=str)
+    for stats_row, row_cols in zip(stats_rows, row_cols_list):
+        row = OrderedDict(stats_row)
+        row.update(row_cols)
+        row["run_time"] = run_time
+        row["options"] = opts_str
+        rows.append(row)
+    print colorLogStr("Append {0:d} rows of stats to ".format(len(rows))) + colorDimStr("{0:s}:{1:s}".format(store_path, table))
+    ResultsStore(store_path).append(table, rows)
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Query the columnar store of the stats of the preview and comparison tools across runs.")
+
+    p.add_argument("--store", dest="store", required=True, default=None, help="HDF5 file of the results store.")
+    p.add_argument("--table", dest="table", required=False, default=None, help="Table to query, i.e. the tool name, plot_hdf5_preview or compare_mv_datasets. Default: list the tables and their columns.")
+    p.add_argument("--columns", dest="columns", nargs="+", required=False, default=None, help="Columns to output. Default: all columns.")
+    p.add_argument("--eq", dest="eq", nargs=2, action="append", required=False, default=None, metavar=("COLUMN", "VALUE"), help="Keep rows whose column equals the value, with shell-style wildcards for string columns, e.g. --eq product_left MCD43A3 --eq dataset_left '*BSA*'. Can be repeated.")
+    p.add_argument("--range", dest="range", nargs=3, action="append", required=False, default=None, metavar=("COLUMN", "MIN", "MAX"), help="Keep rows whose numeric column is within [MIN, MAX], e.g. --range date_left 2018001 2018365. Can be repeated.")
+    p.add_argument("--ocsv", dest="ocsv", required=False, default=None, help="Name of a CSV file to output the query results. Default: output to stdout.")
+
+    cmdargs = p.parse_args()
+
+    if (cmdargs.table is None) and ((cmdargs.eq is not None) or (cmdargs.range is not None) or (cmdargs.columns is not None)):
+        raise RuntimeError(colorErrorStr("--columns, --eq and --range need --table."))
+
+    return cmdargs
+
+def main(cmdargs):
+    store = ResultsStore(cmdargs.store)
+    if not os.path.isfile(cmdargs.store):
+        raise RuntimeError(colorErrorStr("Results store {0:s} NOT found".format(cmdargs.store)))
+
+    if cmdargs.table is None:
+        for table, nrows, names in store.tables():
+            print colorInfoStr("{0:s}, {1:d} rows: ".format(table, nrows)) + ",".join(names)
+        print colorResetStr("")
+        return
+
+    eq = dict([(k, v) for k, v in cmdargs.eq]) if cmdargs.eq is not None else None
+    ranges = dict([(k, (float(lo), float(hi))) for k, lo, hi in cmdargs.range]) if cmdargs.range is not None else None
+    out = store.query(cmdargs.table, columns=cmdargs.columns, eq=eq, ranges=ranges)
+
+    out_buf = StringIO()
+    writer = csv.writer(out_buf, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(out.keys())
+    cols = out.values()
+    for i in range(len(cols[0]) if len(cols) > 0 else 0):
+        # missing values as empty fields
+        writer.writerow([col[i] if not isMissing(col[i]) else "" for col in cols])
+    out_str = out_buf.getvalue()
+
+    if cmdargs.ocsv is not None:
+        print colorLogStr("Write query results to ") + colorDimStr("{0:s}".format(cmdargs.ocsv))
+        with open(cmdargs.ocsv, "w") as fobj:
+            fobj.write(out_str)
+    else:
+        sys.stdout.write(out_str)
+    print colorResetStr("")
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
@@ -8,7 +8,6 @@ import sys
 import os
 import argparse
 import itertools
-import warnings
 
 import h5py
 import numpy as np
@@ -30,6 +29,11 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 mpl.rc(("xtick", "ytick"), labelsize=8)
 
+from mvp_result_cache import ResultCache
+from mvp_results_store import appendStatsRows, granuleColumns, statsRow, rowsToJson, rowsFromJson
+from mvp_h5_utils import findDataset, getFillValues, windowSize, iterWindows, readWindow, prefetchWindows, BufferRing, sampleUnit, sampleWindows, sampleStats, MIN_SAMPLE_UNITS, checkRoi, WindowMask
+from mvp_grid import gridGeometry, bboxToRoi
+
 def getCmdArgs():
     p = argparse.ArgumentParser(description="Plot a preview image of a dataset from an HDF-EOS5 file.")
     
@@ -42,6 +46,17 @@ def getCmdArgs():
     p.add_argument("--attr_keys", dest="attr_keys", required=False, nargs="+", default=None, help="List of attribute names to be searched in each dataset. If an attribute is found, its value is output to the CSV file given by --ocsv, otherwise to stdout. If an attribute is not found, its value will be labeld with N/A in the output.")
     p.add_argument("--ocsv", dest="ocsv", required=False, default=None, help="Name of a CSV file to output the list of metadata attributes for each dataset, and if given --stats, the statistics for each dataset.")
 
+    p.add_argument("--roi", dest="roi", nargs=4, type=int, required=False, default=None, metavar=("ROW0", "ROW1", "COL0", "COL1"), help="If given, process only this region of interest of rows ROW0 to ROW1-1 and columns COL0 to COL1-1, starting from 0. The preview image covers only the region. Default: the whole grid.")
+    p.add_argument("--bbox", dest="bbox", nargs=4, type=float, required=False, default=None, metavar=("MIN_LAT", "MAX_LAT", "MIN_LON", "MAX_LON"), help="Same as --roi but giving a bounding box of latitudes and longitudes in degrees, mapped to rows and columns by the grid geometry in StructMetadata.0 of the first input file.")
+    p.add_argument("--mask_h5f", dest="mask_h5f", required=False, default=None, help="If given with --mask_dataset, HDF5 file of a mask dataset on the same grid, e.g. a land/water layer, to process only the pixels it keeps. Masked-out pixels are taken as fill values.")
+    p.add_argument("--mask_dataset", dest="mask_dataset", required=False, default=None, help="Name of the mask dataset in --mask_h5f.")
+    p.add_argument("--mask_values", dest="mask_values", nargs="+", type=int, required=False, default=None, help="Values of the mask dataset for the pixels to keep. Default: nonzero values that are not fill values.")
+
+    p.add_argument("--sample_fraction", dest="sample_fraction", type=float, required=False, default=None, help="If given, read only this fraction, 0-1, of the native chunks of each dataset, or of its rows if not chunked, drawn at random stratified over the grid, for fast approximate stats with 95%% bootstrap confidence intervals in extra CSV columns. The preview image shows only the sampled chunks. Default: read all data.")
+    p.add_argument("--sample_size", dest="sample_size", type=int, required=False, default=None, help="Same as --sample_fraction but giving the number of pixels to sample, rounded up to whole chunks or rows. At least {0:d} chunks or rows are sampled for the confidence intervals.".format(MIN_SAMPLE_UNITS))
+    p.add_argument("--sample_seed", dest="sample_seed", type=int, required=False, default=0, help="Seed of the random sampling and the bootstrap. Default: 0.")
+    p.add_argument("--bootstrap", dest="bootstrap", type=int, required=False, default=200, help="Number of bootstrap replicates of the sampled chunks for the confidence intervals. Default: 200.")
+
     p.add_argument("--downsample_size", dest="downsample_size", required=False, type=int, default=10, help="Window size to resample input raster for downsampling and preview. Default: 10.")
 
     p.add_argument("--transform_func", dest="transfunc", required=False, default=None, choices=["popcount"], help="Name of a function to transform pixel values. Choices: ['popcount']. Default: no transformation.")
@@ -55,6 +70,14 @@ def getCmdArgs():
     
     p.add_argument("--img_width", dest="img_width", type=float, required=False, default=5, help="Width of output preview image, in inches, the height of an output figure will be automatically adjusted. Default: 5 inches.")
 
+    p.add_argument("--prefetch", dest="prefetch", type=int, required=False, default=0, help="Number of windows to read ahead in a background thread while the current window is processed, so that reading and decompression overlap with the computation. The windows are shrunk so that the buffers of all the windows in flight stay within the memory limit of a window without read-ahead. Default: 0, no read-ahead.")
+
+    p.add_argument("--cache_dir", dest="cache_dir", required=False, default=None, help="Directory of a result cache. If given, the preview image and the stats or attribute values are reused from the cache when the input files and all the options affecting the outputs are unchanged since an earlier run, skipping the data scan. Default: no cache.")
+    p.add_argument("--cache_size", dest="cache_size", type=float, required=False, default=1024, help="Maximum size of the result cache in MB. The least recently used results are evicted beyond this size. Default: 1024 MB.")
+    p.add_argument("--cache_checksum", dest="cache_checksum", required=False, action="store_true", help="If set, also identify input files in the result cache by a checksum of their content, in addition to their sizes and modification times.")
+
+    p.add_argument("--results_store", dest="results_store", required=False, default=None, help="HDF5 file of a columnar store of stats across runs. If given, also append the output rows of stats or attribute values to the table plot_hdf5_preview of the store, with the bands, the product IDs, dates, tiles and collections parsed from the file names, the run time and the run options as extra columns. Created if not existing. Query it with mvp_results_store.py.")
+
     cmdargs = p.parse_args()
 
     if len(cmdargs.infile) !=1 and len(cmdargs.infile) != 3:
@@ -75,8 +98,26 @@ def getCmdArgs():
     if len(cmdargs.band) != len(cmdargs.infile):
         raise RuntimeError(colorErrorStr("Numbers of input files and band indexes must be equaland one to one."))
 
+    if (cmdargs.results_store is not None) and (not cmdargs.stats) and (cmdargs.attr_keys is None):
+        raise RuntimeError(colorErrorStr("Option stats or attr_keys is not turned on for appending to the given results store."))
     if (cmdargs.ocsv is not None) and (not cmdargs.stats) and (cmdargs.attr_keys is None):
         raise RuntimeError(colorErrorStr("Neither data stats nor attribute keys are given for writing to the given CSV file."))
+
+    if (cmdargs.sample_fraction is not None) and (cmdargs.sample_size is not None):
+        raise RuntimeError(colorErrorStr("Only one of --sample_fraction and --sample_size can be given."))
+    if (cmdargs.sample_fraction is not None) and (cmdargs.sample_fraction <= 0 or cmdargs.sample_fraction > 1):
+        raise RuntimeError(colorErrorStr("Sample fraction must be in (0, 1]."))
+    if (cmdargs.sample_size is not None) and (cmdargs.sample_size <= 0):
+        raise RuntimeError(colorErrorStr("Sample size must be positive."))
+    if cmdargs.bootstrap < 1:
+        raise RuntimeError(colorErrorStr("Number of bootstrap replicates must be positive."))
+    if cmdargs.prefetch < 0:
+        raise RuntimeError(colorErrorStr("Number of windows to read ahead must not be negative."))
+
+    if (cmdargs.roi is not None) and (cmdargs.bbox is not None):
+        raise RuntimeError(colorErrorStr("Only one of --roi and --bbox can be given."))
+    if (cmdargs.mask_h5f is None) != (cmdargs.mask_dataset is None):
+        raise RuntimeError(colorErrorStr("--mask_h5f and --mask_dataset must be given together."))
     
     return cmdargs
 
@@ -99,11 +140,40 @@ def main(cmdargs):
     do_stats = cmdargs.stats
     outattrkeys = cmdargs.attr_keys
     outcsvfile = cmdargs.ocsv
+    do_sample = (cmdargs.sample_fraction is not None) or (cmdargs.sample_size is not None)
+    do_mask = cmdargs.mask_h5f is not None
+    do_roi = (cmdargs.roi is not None) or (cmdargs.bbox is not None)
+
+    cache = None
+    if cmdargs.cache_dir is not None:
+        cache = ResultCache(cmdargs.cache_dir, max_bytes=cmdargs.cache_size*1e6, checksum=cmdargs.cache_checksum)
+        cache_opts = dict(dataset=inds, band=inband, downsample_size=dsamp_size, 
+                          transform_func=transfunc, stretch_min=stretch_min, stretch_max=stretch_max, 
+                          background=bg_color, colormap=cmap_name, colorbar=add_colorbar, 
+                          img_width=img_width, dpi=dpi, stats=do_stats, attr_keys=outattrkeys, 
+                          img_format=os.path.splitext(outfile)[1].lower())
+        if do_sample:
+            cache_opts.update(sample_fraction=cmdargs.sample_fraction, sample_size=cmdargs.sample_size, 
+                              sample_seed=cmdargs.sample_seed, bootstrap=cmdargs.bootstrap)
+        if do_roi or do_mask:
+            cache_opts.update(roi=cmdargs.roi, bbox=cmdargs.bbox, mask_dataset=cmdargs.mask_dataset, mask_values=cmdargs.mask_values)
+        cache_key = cache.makeKey("plot_hdf5_preview", infiles + ([cmdargs.mask_h5f] if do_mask else []), cache_opts)
+        cache_entry = cache.get(cache_key)
+        if cache_entry is not None:
+            print colorInfoStr("Found results in the cache ") + colorDimStr("{0:s}".format(cmdargs.cache_dir))
+            print "Write preview image ..."
+            cache.restoreFile(cache_entry, "preview", outfile)
+            if "outstats" in cache_entry["texts"]:
+                writeStatsStr(cache_entry["texts"]["outstats"], outcsvfile)
+                if cmdargs.results_store is not None:
+                    storeStatsRows(rowsFromJson(cache_entry["texts"]["outstats_rows"]), cmdargs)
+            sys.stdout.write(colorResetStr("\n"))
+            return
 
     nfiles = len(infiles)
     fobj_list = [h5py.File(fname, "r") for fname in infiles]
 
-    dsname_list = [fobj['/'].visit(lambda name: name if ids in name else None) for fobj, ids in itertools.izip(fobj_list, inds)]
+    dsname_list = [findDataset(fobj, ids) for fobj, ids in itertools.izip(fobj_list, inds)]
     dsname_found = True
     for i, dsname in enumerate(dsname_list):
         if dsname is None:
@@ -122,22 +192,7 @@ def main(cmdargs):
 
     sds_list = [fobj[dsname] for fobj, dsname in itertools.izip(fobj_list, dsname_list)]
     # find fill value
-    fillvalue_list = []
-    for i, (fobj, dsname) in enumerate(itertools.izip(fobj_list, dsname_list)):
-        fill_found = False
-        for tmp in fobj[dsname].attrs.keys():
-            if 'FILL' in tmp.upper():
-                fillvalue_list.append(fobj[dsname].attrs[tmp])
-                fill_found = True
-                break
-        if not fill_found:
-            fillvalue_list.append(None)
-            print "{0:s}:{1:s}, no fill value!".format(os.path.basename(infiles[i]), dsname)
-    fillvalue_list = [fv if (np.isscalar(fv) or fv is None) else fv[0] for fv in fillvalue_list]
-    if np.sum([fv is None for fv in fillvalue_list]) > 0:
-        fillvalue_list = [np.iinfo(sds.dtype).max if fv is None else fv for sds, fv in itertools.izip(sds_list, fillvalue_list)]
-        warnings.warn(colorWarnStr("Some input datasets miss fill value. Use the maximum values of their data types."), RuntimeWarning)
-        print fillvalue_list
+    fillvalue_list = getFillValues(sds_list, warn_func=colorWarnStr)
 
     for sds in sds_list:
         if sds.ndim != sds_list[0].ndim:
@@ -152,21 +207,59 @@ def main(cmdargs):
         if sds.ndim > 2 and ib > sds.ndim:
             raise RuntimeError(colorErrorStr("Input band index {2:d} is valid for the dataset {0:s}, in the file {1:s}".format(sds.name, sds.file.filename, ib)))
 
+    # Region of interest and mask to limit the reading of data.
+    roi = None
+    if cmdargs.roi is not None:
+        roi = checkRoi(cmdargs.roi, sds_list[0].shape)
+    elif cmdargs.bbox is not None:
+        roi = bboxToRoi(gridGeometry(fobj_list[0], dsname_list[0]), sds_list[0].shape, cmdargs.bbox)
+    if roi is not None:
+        print colorInfoStr("Process rows {0:d}-{1:d}, columns {2:d}-{3:d}".format(roi[0], roi[1]-1, roi[2], roi[3]-1))
+    mask = None
+    if do_mask:
+        mask_fobj = h5py.File(cmdargs.mask_h5f, "r")
+        mask_dsname = findDataset(mask_fobj, cmdargs.mask_dataset)
+        if mask_dsname is None:
+            raise RuntimeError(colorErrorStr("Dataset name {0:s} NOT found in {1:s}".format(cmdargs.mask_dataset, cmdargs.mask_h5f)))
+        if mask_fobj[mask_dsname].shape[0:2] != sds_list[0].shape[0:2]:
+            raise RuntimeError(colorErrorStr("Mask dataset must have the same grid as the input datasets!"))
+        mask = WindowMask(mask_fobj[mask_dsname], cmdargs.mask_values)
+    # extent of the preview image
+    ext = checkRoi(roi, sds_list[0].shape)
+    ext_nrows, ext_ncols = ext[1]-ext[0], ext[3]-ext[2]
+
     # Large amount of pixels to compare for generating scatter density
     # plot. First build a scatter density array by going through the
     # data chunk by chunk.
     # 
-    chunk_dsamp_npix_list = [int(np.sqrt(mem_size/sds.dtype.itemsize)/dsamp_size) for sds in sds_list]
-    chunk_xsize_list = [dsamp_size*cdn for cdn in chunk_dsamp_npix_list]
-    chunk_ysize_list = chunk_xsize_list
-    nchunk_x_list = [np.ceil(sds.shape[1]/cx).astype(int) for sds, cx in itertools.izip(sds_list, chunk_xsize_list)]
-    nchunk_y_list = [np.ceil(sds.shape[0]/cy).astype(int) for sds, cy in itertools.izip(sds_list, chunk_ysize_list)]
-    nchunk_x_list = [ncx if ncx>0 else 1 for ncx in nchunk_x_list]
-    nchunk_y_list = [ncy if ncy>0 else 1 for ncy in nchunk_y_list]
+    # With read-ahead, the windows in flight share the memory limit.
+    nslots = cmdargs.prefetch+2 if cmdargs.prefetch > 0 else 1
+    chunk_size_list = [windowSize(sds.dtype.itemsize*nslots, mem_size, multiple=dsamp_size) for sds in sds_list]
+    chunk_dsamp_npix_list = [cy/dsamp_size for cy, cx in chunk_size_list]
 
     dsamp_xsize_list = [int(np.ceil(sds.shape[1]/dsamp_size)) for sds in sds_list]
     dsamp_ysize_list = [int(np.ceil(sds.shape[0]/dsamp_size)) for sds in sds_list]
     dsamp_img_list = [np.zeros((dy, dx), dtype=sds.dtype) for sds, dx, dy in itertools.izip(sds_list, dsamp_xsize_list, dsamp_ysize_list)]
+    # Windows clipped to the region of interest, shrunk by the mask or
+    # sampled do not align with the downsampling grid of the full
+    # grid. Their pixels on the downsampling grid of the region are
+    # placed one by one, and the rest of the image is left as fill
+    # values.
+    do_subset = do_sample or do_roi or do_mask
+    if do_subset:
+        dsamp_img_list = [np.full((-(-ext_nrows//dsamp_size), -(-ext_ncols//dsamp_size)), fv, dtype=sds.dtype) 
+                          for sds, fv in itertools.izip(sds_list, fillvalue_list)]
+
+    # In the sampling mode, read only a stratified random sample of the
+    # native chunks of each dataset, and leave the rest of the preview
+    # image as fill values.
+    sample_list = None
+    if do_sample:
+        sample_list = [sampleWindows(sds.shape, sampleUnit(sds), fraction=cmdargs.sample_fraction, 
+                                     size=cmdargs.sample_size, seed=cmdargs.sample_seed, roi=roi) for sds in sds_list]
+        sample_values_list = [[] for sds in sds_list]
+        for sds, (windows, nunits) in itertools.izip(sds_list, sample_list):
+            print colorInfoStr("Sample {0:d} of {1:d} {3:s} of {2:s}".format(len(windows), nunits, sds.name, "rows" if sds.chunks is None else "chunks"))
 
     if do_stats:
         tmp_x_cnt = np.zeros(len(sds_list))
@@ -174,56 +267,95 @@ def main(cmdargs):
         tmp_x2_sum = np.zeros(len(sds_list))
         hist_list = [np.zeros(2, dtype=np.int) for sds in sds_list]
         binrange_list = [np.array([0,1], dtype=np.int) for sds in sds_list]
-    for i, (sds, cx, ncx, cy, ncy) in enumerate(itertools.izip(sds_list, chunk_xsize_list, nchunk_x_list, chunk_ysize_list, nchunk_y_list)):
-        for ix in range(ncx):
-            for iy in range(ncy):
-                sys.stdout.write("Reading chunk row, col of file {4:d}/{5:d}: {0:d}/{1:d}, {2:d}/{3:d} ... ".format(iy+1, ncy, ix+1, ncx, i+1, nfiles))
-                sys.stdout.flush()
-                tmpxidx = sds.shape[1] if ix==ncx-1 else (ix+1)*cx
-                tmpyidx = sds.shape[0] if iy==ncy-1 else (iy+1)*cy
-                if sds.ndim == 2:
-                    tmpdata = sds[iy*cy:tmpyidx, ix*cx:tmpxidx]
-                elif sds.ndim == 3:
-                    tmpdata = sds[iy*cy:tmpyidx, ix*cx:tmpxidx, inband[i]-1]
-                else:
-                    raise RuntimeError(colorErrorStr("Unexpected number of dimensions of input dataset!"))
-
-                cdn = chunk_dsamp_npix_list[i]
-                tmpxidx = dsamp_img_list[i].shape[1] if ix==ncx-1 else (ix+1)*cdn
-                tmpyidx = dsamp_img_list[i].shape[0] if iy==ncy-1 else (iy+1)*cdn
-                dsamp_img_list[i][iy*cdn:tmpyidx, ix*cdn:tmpxidx] = tmpdata[::dsamp_size, ::dsamp_size]
-
-                if do_stats:
-                    sys.stdout.write("Digesting data to estimate data stats ... ")
-                    sys.stdout.flush()
-
-                    if transfunc == "popcount":
-                        tmpdata = popcount_func(tmpdata, fillvalue_list[i])
-
-                    tmpflag = tmpdata != fillvalue_list[i]
-                    tmpdatadbl = tmpdata[tmpflag].astype(np.double)
-                    if tmpdatadbl.size==0:
-                        sys.stdout.write("\r")
-                        continue
-                    tmp_x_cnt[i] = tmp_x_cnt[i] + np.sum(tmpflag)
-                    tmp_x_sum[i] = tmp_x_sum[i] + np.sum(tmpdatadbl)
-                    tmp_x2_sum[i] = tmp_x2_sum[i] + np.sum(tmpdatadbl*tmpdatadbl)
-
-                    tmpmax = np.max(tmpdatadbl)
-                    tmpmin = np.min(tmpdatadbl)
-                    if tmpmax > binrange_list[i][1]:
-                        hist_list[i] = np.append(hist_list[i], np.zeros(int(tmpmax-binrange_list[i][1])))
-                        binrange_list[i][1] = tmpmax
-                    if tmpmin < binrange_list[i][0]:
-                        hist_list[i] = np.append(np.zeros(int(binrange_list[i][0]-tmpmin)), hist_list[i])
-                        binrange_list[i][0] = tmpmin
-                    tmpbins = np.arange(binrange_list[i][0]-0.5, binrange_list[i][1]+1.5)
-                    hist1d_arr, _ = np.histogram(tmpdatadbl, bins=tmpbins)
-                    hist_list[i] = hist_list[i] + hist1d_arr
+    # The windows of all the input files in one stream, so that the
+    # reading ahead goes on from one file to the next.
+    windows_list = [list(iterWindows(sds.shape, cy, cx, roi=roi)) if sample_list is None else sample_list[i][0] 
+                    for i, (sds, (cy, cx)) in enumerate(itertools.izip(sds_list, chunk_size_list))]
+    items = [(i, window) for i, windows in enumerate(windows_list) for window in windows]
+    ring = None
+    if cmdargs.prefetch > 0:
+        ring = BufferRing(nslots, [np.max([(rows.stop-rows.start)*(cols.stop-cols.start)*sds_list[i].dtype.itemsize 
+                                           for i, (_, _, _, _, rows, cols) in items])])
+
+    def fetchWindow(item, slot):
+        i, (iy, ix, ncy, ncx, rows, cols) = item
+        if mask is not None:
+            tmpmask = mask.window(rows, cols)
+            if tmpmask is None:
+                return None
+            rows, cols, tmpkeep = tmpmask
+        out = None if ring is None else ring.view(slot, 0, (rows.stop-rows.start, cols.stop-cols.start), sds_list[i].dtype)
+        tmpdata = readWindow(sds_list[i], rows, cols, inband[i], out=out)
+        if mask is not None:
+            tmpdata[np.logical_not(tmpkeep)] = fillvalue_list[i]
+        return rows, cols, tmpdata
+
+    for (i, (iy, ix, ncy, ncx, rows, cols)), fetched in prefetchWindows(items, fetchWindow, cmdargs.prefetch):
+        sys.stdout.write("Reading chunk row, col of file {4:d}/{5:d}: {0:d}/{1:d}, {2:d}/{3:d} ... ".format(iy+1, ncy, ix+1, ncx, i+1, nfiles))
+        sys.stdout.flush()
+        if fetched is None:
+            sys.stdout.write("\r")
+            continue
+        rows, cols, tmpdata = fetched
+
+        if not do_subset:
+            cdn = chunk_dsamp_npix_list[i]
+            tmpxidx = dsamp_img_list[i].shape[1] if ix==ncx-1 else (ix+1)*cdn
+            tmpyidx = dsamp_img_list[i].shape[0] if iy==ncy-1 else (iy+1)*cdn
+            dsamp_img_list[i][iy*cdn:tmpyidx, ix*cdn:tmpxidx] = tmpdata[::dsamp_size, ::dsamp_size]
+        else:
+            dy0, dx0 = -(-(rows.start-ext[0])//dsamp_size), -(-(cols.start-ext[2])//dsamp_size)
+            tmpsub = tmpdata[ext[0]+dy0*dsamp_size-rows.start::dsamp_size, ext[2]+dx0*dsamp_size-cols.start::dsamp_size]
+            dsamp_img_list[i][dy0:dy0+tmpsub.shape[0], dx0:dx0+tmpsub.shape[1]] = tmpsub
 
-                sys.stdout.write("\r")
+        if do_stats:
+            sys.stdout.write("Digesting data to estimate data stats ... ")
+            sys.stdout.flush()
 
-    if do_stats:
+            if transfunc == "popcount":
+                tmpdata = popcount_func(tmpdata, fillvalue_list[i])
+
+            tmpflag = tmpdata != fillvalue_list[i]
+            tmpdatadbl = tmpdata[tmpflag].astype(np.double)
+            if tmpdatadbl.size==0:
+                sys.stdout.write("\r")
+                continue
+            if sample_list is not None:
+                sample_values_list[i].append(tmpdatadbl)
+                sys.stdout.write("\r")
+                continue
+            tmp_x_cnt[i] = tmp_x_cnt[i] + np.sum(tmpflag)
+            tmp_x_sum[i] = tmp_x_sum[i] + np.sum(tmpdatadbl)
+            tmp_x2_sum[i] = tmp_x2_sum[i] + np.sum(tmpdatadbl*tmpdatadbl)
+
+            tmpmax = np.max(tmpdatadbl)
+            tmpmin = np.min(tmpdatadbl)
+            if tmpmax > binrange_list[i][1]:
+                hist_list[i] = np.append(hist_list[i], np.zeros(int(tmpmax-binrange_list[i][1])))
+                binrange_list[i][1] = tmpmax
+            if tmpmin < binrange_list[i][0]:
+                hist_list[i] = np.append(np.zeros(int(binrange_list[i][0]-tmpmin)), hist_list[i])
+                binrange_list[i][0] = tmpmin
+            tmpbins = np.arange(binrange_list[i][0]-0.5, binrange_list[i][1]+1.5)
+            hist1d_arr, _ = np.histogram(tmpdatadbl, bins=tmpbins)
+            hist_list[i] = hist_list[i] + hist1d_arr
+
+        sys.stdout.write("\r")
+
+    if do_stats and do_sample:
+        # mean, std, min, 5%, 25%, median, 75%, 95%, max, and their
+        # lower and upper confidence bounds, dropping the rms.
+        pct_list = [0, 5, 25, 50, 75, 95, 100]
+        stats_list, ci_list = [], []
+        for i, (sds, (windows, nunits)) in enumerate(itertools.izip(sds_list, sample_list)):
+            est, lo, hi = sampleStats(sample_values_list[i], pct_list, nboot=cmdargs.bootstrap, 
+                                      seed=cmdargs.sample_seed, exact=len(windows)==nunits)
+            stats_list.append(np.delete(est, 2))
+            nsampled = np.sum([(rows.stop-rows.start)*(cols.stop-cols.start) for _, _, _, _, rows, cols in windows])
+            ci_list.append(np.concatenate([np.delete(lo, 2), np.delete(hi, 2), 
+                                           [np.sum([v.size for v in sample_values_list[i]]), 
+                                            nsampled/float(ext_nrows*ext_ncols)]]))
+    elif do_stats:
         # mean, std, min, 5%, 25%, median, 75%, 95%, max
         stats_list = [np.zeros(9) for sds in sds_list]
         pct_list = [0, 5, 25, 50, 75, 95, 100]
@@ -258,7 +390,7 @@ def main(cmdargs):
 
     if len(dsamp_img_list) == 1:
         # single band image to preview in the given colormap.
-        fig, ax = plt.subplots(figsize=(img_width, float(img_width)/sds_list[0].shape[1]*sds_list[0].shape[0]))
+        fig, ax = plt.subplots(figsize=(img_width, float(img_width)/ext_ncols*ext_nrows))
         # choose color map
         cmap = plt.get_cmap(cmap_name, int(stretch_max[0]-stretch_min[0])+1)
         cmap.set_bad(color=np.array(bg_color)/255., alpha=1)
@@ -284,7 +416,7 @@ def main(cmdargs):
             tmp[img==fillvalue_list[i]] = fillvalue_rgb[i] # fillvalue_list[i]
             dsamp_img_list[i] = tmp
         out_img = np.dstack(dsamp_img_list)
-        fig, ax = plt.subplots(figsize=(img_width, float(img_width)/sds_list[0].shape[1]*sds_list[0].shape[0]))
+        fig, ax = plt.subplots(figsize=(img_width, float(img_width)/ext_ncols*ext_nrows))
         ax.imshow(out_img)
         plt.setp(ax, xticks=[], yticks=[])
         ax.set_title(outlabel, fontsize=fontsize)
@@ -292,14 +424,9 @@ def main(cmdargs):
     else:
         raise RuntimeError(colorErrorStr("Number images from input files can only be 1 for single-band image preview or 3 for RGB composite."))
 
+    outstats_str = None
+    outstats_rows = None
     if do_stats or outattrkeys is not None:
-        if outcsvfile is not None:
-            print colorLogStr("Write data stats or attribute values to ") + colorDimStr("{0:s}".format(outcsvfile))
-            output_obj = open(outcsvfile, "w")
-        else:
-            print colorInfoStr("Data stats or attribute values: ")
-            output_obj = sys.stdout
-
         headerstr = "file,dataset"
         fmtstr = "{0:s},{1:s}"
         noutvars = 2
@@ -311,26 +438,63 @@ def main(cmdargs):
             headerstr = headerstr + ",{0:s}".format(",".join(outattrkeys))
             fmtstr = fmtstr + "," + ",".join(["\"{{{1:d}[{0:d}]:s}}\"".format(i, noutvars) for i in range(len(outattrkeys))])
             noutvars = noutvars + 1
+        if do_stats and do_sample:
+            # confidence bounds go after all the columns of a full run
+            # so that readers by column position are not affected.
+            tmpnames = ["mean", "std", "min", "5pct", "25pct", "median", "75pct", "95pct", "max"]
+            headerstr = headerstr + "," + ",".join([n+"_ci95_low" for n in tmpnames]) \
+                        + "," + ",".join([n+"_ci95_high" for n in tmpnames]) + ",sampled_valid_pixels,sample_fraction"
+            fmtstr = fmtstr + "," + ",".join(["{{{1:d}[{0:d}]:.3f}}".format(i, noutvars) for i in range(2*len(tmpnames))]) \
+                     + ",{{{1:d}[{0:d}]:.0f}},{{{1:d}[{2:d}]:.4g}}".format(2*len(tmpnames), noutvars, 2*len(tmpnames)+1)
+            noutvars = noutvars + 1
 
         headerstr = headerstr + "\n"
         fmtstr = fmtstr + "\n"
 
-        output_obj.write(headerstr)
+        outstats_str = headerstr
+        # the same rows with the values as computed, for the results store
+        outstats_rows = []
         for i, (fname, dsname) in enumerate(itertools.izip(infiles, dsname_list)):
             outvars = [fname, dsname]
+            rowvals = [fname, dsname]
             if do_stats:
                 outvars.append(stats_list[i])
+                rowvals = rowvals + list(stats_list[i])
             if outattrkeys is not None:
                 outvars.append([repr(str(oav)) for oav in outattrvalues_list[i]])
-            output_obj.write(fmtstr.format(*outvars))
+                rowvals = rowvals + [str(oav) for oav in outattrvalues_list[i]]
+            if do_stats and do_sample:
+                outvars.append(ci_list[i])
+                rowvals = rowvals + list(ci_list[i][:-2]) + [int(ci_list[i][-2]), ci_list[i][-1]]
+            outstats_str = outstats_str + fmtstr.format(*outvars)
+            outstats_rows.append(statsRow(headerstr.strip().split(","), rowvals))
+
+        writeStatsStr(outstats_str, outcsvfile)
+        if cmdargs.results_store is not None:
+            storeStatsRows(outstats_rows, cmdargs)
 
-        if outcsvfile is not None:
-            output_obj.close()
+    if cache is not None:
+        cache.put(cache_key, files=dict(preview=outfile), 
+                  texts=dict() if outstats_str is None else dict(outstats=outstats_str, outstats_rows=rowsToJson(outstats_rows)))
 
     sys.stdout.write(colorResetStr("\n"))
 
     return
 
+def writeStatsStr(outstats_str, outcsvfile):
+    if outcsvfile is not None:
+        print colorLogStr("Write data stats or attribute values to ") + colorDimStr("{0:s}".format(outcsvfile))
+        with open(outcsvfile, "w") as output_obj:
+            output_obj.write(outstats_str)
+    else:
+        print colorInfoStr("Data stats or attribute values: ")
+        sys.stdout.write(outstats_str)
+
+def storeStatsRows(outstats_rows, cmdargs):
+    # one row per input file
+    row_cols_list = [[("band", ib)] + granuleColumns(fname).items() for fname, ib in itertools.izip(cmdargs.infile, cmdargs.band)]
+    appendStatsRows(cmdargs.results_store, "plot_hdf5_preview", outstats_rows, row_cols_list, vars(cmdargs))
+
 def popcount_func(data, fillv):
     tmpflag = data!=fillv
     data[tmpflag] = [bin(x).count("1") for x in data[tmpflag]]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# Tests of the steps of watch_mvp_pipeline.py. Run from common-utils,
+#     python -m unittest discover -s tests
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import Queue
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from watch_mvp_pipeline import runStep
+
+class RunStepTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makeStep(self, cmds, **kwargs):
+        step = dict(kind="test", key="test:step", inputs=[], cmds=cmds,
+                    log=os.path.join(self.tmpdir, "step.log"))
+        step.update(kwargs)
+        return step
+
+    def testCommandNotFound(self):
+        step = runStep(self.makeStep([[os.path.join(self.tmpdir, "no_such_command")]]))
+        self.assertEqual(step["status"], "failed")
+        self.assertTrue(len(step["error"]) > 0)
+        self.assertIn("elapsed", step)
+
+    def testCommandNotFoundInPool(self):
+        # the step must come back through the callback, or the pipeline
+        # waits for it forever.
+        results = Queue.Queue()
+        pool = ThreadPool(1)
+        try:
+            pool.apply_async(runStep, (self.makeStep([[os.path.join(self.tmpdir, "no_such_command")]]),), callback=results.put)
+            step = results.get(timeout=30)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(step["status"], "failed")
+
+    def testRenameFailure(self):
+        step = runStep(self.makeStep([["true"]], rename=(os.path.join(self.tmpdir, "missing.part"), os.path.join(self.tmpdir, "missing"))))
+        self.assertEqual(step["status"], "failed")
+
+    def testCommandExitCode(self):
+        step = runStep(self.makeStep([["true"], ["false"]]))
+        self.assertEqual(step["status"], "failed")
+        self.assertIn("exit code 1", step["error"])
+
+    def testDone(self):
+        step = runStep(self.makeStep([["true"]]))
+        self.assertEqual(step["status"], "done")
+        self.assertIsNone(step["error"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,512 @@
+#!/usr/bin/env python
+
+# Watch download directories for newly completed MCD43/VNP43 granules
+# and process them as they arrive: convert HDF4 to HDF5, make preview
+# images and stats of each granule, and compare each granule with its
+# partner product of the same date and tile once both are there.
+#
+# This chains the steps of preview_mv_products.sh and
+# compare_mv_products.sh into one long-running process that overlaps
+# with the downloading. A manifest of the finished steps makes
+# restarts skip the work already done on unchanged inputs.
+#
+# Zhan Li, zhan.li@umb.edu
+
+import os
+import sys
+import re
+import json
+import time
+import fnmatch
+import argparse
+import threading
+import subprocess
+import Queue
+from multiprocessing.pool import ThreadPool
+
+import h5py
+
+import colorama
+colorama.init(autoreset=True)
+# define some color schemes for message output control
+colorWarnStr = lambda msg: colorama.Fore.YELLOW + str(msg) + colorama.Style.RESET_ALL
+colorErrorStr = lambda msg: colorama.Fore.RED + str(msg) + colorama.Style.RESET_ALL
+colorInfoStr = lambda msg: colorama.Fore.GREEN + str(msg) + colorama.Style.RESET_ALL
+colorDimStr = lambda msg: colorama.Style.DIM + str(msg) + colorama.Style.RESET_ALL
+colorLogStr = lambda msg: str(msg)
+colorResetStr = lambda msg: colorama.Style.RESET_ALL + str(msg)
+
+from mvp_h5_utils import parseGranuleName
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+PREVIEW_SCRIPT = os.path.join(SRC_DIR, "plot_hdf5_preview.py")
+COMPARE_SCRIPT = os.path.join(SRC_DIR, "compare_mv_datasets.py")
+
+ATTR_KEYS = ["long_name", "_FillValue", "units", "valid_range", "scale_factor", "Description"]
+
+MODIS_BANDS = ["Band1", "Band2", "Band3", "Band4", "Band5", "Band6", "Band7", "vis", "nir", "shortwave"]
+VIIRS_M_BANDS = ["M1", "M2", "M3", "M4", "M5", "M7", "M8", "M10", "M11", "vis", "nir", "shortwave"]
+# corresponding bands between the product families, as getBandNames()
+# of compare_mv_products.sh.
+PAIR_BANDS = {("MCD43A", "VNP43IA"):(["Band1", "Band2", "Band6"], ["I1", "I2", "I3"]),
+              ("MCD43A", "VNP43MA"):(MODIS_BANDS, ["M5", "M7", "M3", "M4", "M8", "M10", "M11", "vis", "nir", "shortwave"]),
+              ("MCD43C", "VNP43C"):(MODIS_BANDS, ["M5", "M7", "M3", "M4", "M8", "M10", "M11", "vis", "nir", "shortwave"]),
+              ("MCD43D", "VNP43D"):(MODIS_BANDS, ["M5", "M7", "M3", "M4", "M8", "M10", "M11", "vis", "nir", "shortwave"]),
+              ("MCD43A", "MCD43A"):(MODIS_BANDS, MODIS_BANDS),
+              ("MCD43C", "MCD43C"):(MODIS_BANDS, MODIS_BANDS),
+              ("MCD43D", "MCD43D"):(MODIS_BANDS, MODIS_BANDS),
+              ("VNP43IA", "VNP43IA"):(["I1", "I2", "I3"], ["I1", "I2", "I3"]),
+              ("VNP43MA", "VNP43MA"):(VIIRS_M_BANDS, VIIRS_M_BANDS),
+              ("VNP43C", "VNP43C"):(VIIRS_M_BANDS, VIIRS_M_BANDS),
+              ("VNP43D", "VNP43D"):(VIIRS_M_BANDS, VIIRS_M_BANDS)}
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Watch download directories and preview, compute stats of and compare MCD43/VNP43 granules as they arrive.")
+
+    p.add_argument("--watch", dest="watch_dirs", nargs="+", required=True, default=None, help="Directories to watch for granules, recursively.")
+    p.add_argument("--outdir", dest="outdir", required=True, default=None, help="Directory of output preview images, comparison figures, stats and the manifest of processed granules.")
+    p.add_argument("--pairs", dest="pairs", nargs="+", required=False, default=None, help="Pairs of product IDs to compare, as PID1:PID2, e.g. MCD43A1:VNP43IA1. Granules of the two products of the same date and tile are compared. Default: no comparison.")
+    p.add_argument("--no_preview", dest="no_preview", required=False, action="store_true", help="If set, do not make preview images and stats of each granule.")
+    p.add_argument("--datasets", dest="datasets", nargs="+", required=False, default=["*"], help="Patterns of data field names to preview and compare, with wildcards. Default: all data fields.")
+
+    p.add_argument("--h4toh5", dest="h4toh5", required=False, default="h4toh5", help="Path to the h4toh5 program to convert HDF4 granules. Default: h4toh5 on PATH.")
+    p.add_argument("--h5dir", dest="h5dir", required=False, default=None, help="Directory of HDF5 files converted from HDF4 granules. Default: next to the HDF4 granules.")
+    p.add_argument("--python", dest="python", required=False, default=sys.executable, help="Python interpreter to run the preview and comparison tools. Default: this interpreter.")
+    p.add_argument("--cache_dir", dest="cache_dir", required=False, default=None, help="Directory of a result cache passed to the preview and comparison tools. Default: no cache.")
+
+    p.add_argument("--nproc", dest="nproc", type=int, required=False, default=2, help="Number of processing steps to run at the same time. Default: 2.")
+    p.add_argument("--interval", dest="interval", type=float, required=False, default=30, help="Seconds between two scans of the watched directories. Default: 30.")
+    p.add_argument("--settle", dest="settle", type=float, required=False, default=10, help="Seconds a granule must stay unchanged in size and modification time to be taken as completely downloaded. Default: 10.")
+    p.add_argument("--once", dest="once", required=False, action="store_true", help="If set, process the granules found and exit when no step is left, instead of watching forever.")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.nproc < 1:
+        raise RuntimeError(colorErrorStr("Number of processing steps must be at least 1."))
+    pairs = []
+    for pr in ([] if cmdargs.pairs is None else cmdargs.pairs):
+        tmp = pr.split(":")
+        if len(tmp) != 2:
+            raise RuntimeError(colorErrorStr("A pair of product IDs must be given as PID1:PID2, got {0:s}".format(pr)))
+        if getBandNames(tmp[0], tmp[1])[0] is None:
+            raise RuntimeError(colorErrorStr("Cannot compare the two product IDs: {0:s}, {1:s}".format(tmp[0], tmp[1])))
+        pairs.append((tmp[0].upper(), tmp[1].upper()))
+    cmdargs.pairs = pairs
+
+    return cmdargs
+
+def productFamily(pid):
+    return re.sub(r"[0-9]*$", "", pid.upper())
+
+def getBandNames(pid1, pid2):
+    fam1, fam2 = productFamily(pid1), productFamily(pid2)
+    if (fam1, fam2) in PAIR_BANDS:
+        return PAIR_BANDS[(fam1, fam2)]
+    if (fam2, fam1) in PAIR_BANDS:
+        bands2, bands1 = PAIR_BANDS[(fam2, fam1)]
+        return bands1, bands2
+    return None, None
+
+def listDataFields(h5fname):
+    """
+    Names of the datasets in the Data Fields groups of an HDF-EOS5
+    file.
+    """
+    names = []
+    def visitor(name, obj):
+        if isinstance(obj, h5py.Dataset) and name.split("/")[-2:-1] == ["Data Fields"]:
+            names.append(name.split("/")[-1])
+    with h5py.File(h5fname, "r") as fobj:
+        fobj.visititems(visitor)
+    return names
+
+def customPrvOpts(pid, ds):
+    """
+    Preview options of a data field, as customPrvOpts() of
+    preview_mv_products.sh.
+    """
+    fam = productFamily(pid)
+    opts = ["--downsample_size", "10" if fam.endswith("D") else "1"]
+    if re.search("Mandatory_Quality", ds, re.I):
+        return opts + ["--stretch_min", "0", "--stretch_max", "1", "--colormap", "Paired"]
+    if re.search("Band_Quality", ds, re.I):
+        return opts + ["--stretch_min", "0", "--stretch_max", "3", "--colormap", "Paired"]
+    if re.search("BRDF_Quality", ds, re.I):
+        return opts + ["--stretch_min", "0", "--stretch_max", "1" if fam.endswith("D") else "5", "--colormap", "Paired"]
+    if re.search("Snow", ds, re.I) and not re.search("Percent", ds, re.I):
+        return opts + ["--stretch_min", "0", "--stretch_max", "1", "--colormap", "Paired"]
+    if re.search("Platform", ds, re.I):
+        return opts + ["--stretch_min", "0", "--stretch_max", "2", "--colormap", "Paired"]
+    if re.search("land.*water.*type", ds, re.I):
+        return opts + ["--stretch_min", "0", "--stretch_max", "7", "--colormap", "Paired"]
+    if re.search("local.*solar.*noon", ds, re.I):
+        return opts + ["--stretch_min", "0", "--stretch_max", "90", "--colormap", "jet"]
+    if re.search("ValidObs", ds, re.I):
+        return opts + ["--stretch_min", "0", "--stretch_max", "16", "--colormap", "Paired", "--transform_func", "popcount"]
+    if re.search("Percent", ds, re.I):
+        return opts + ["--stretch_min", "0", "--stretch_max", "100", "--colormap", "jet"]
+    if re.search("(Nadir|NBAR)", ds, re.I):
+        return opts + ["--stretch_min", "0", "--stretch_max", "1000" if fam == "MCD43D" else "10000", "--colormap", "jet"]
+    # Parameters, BSA, WSA, Uncertainty
+    return opts + ["--stretch_min", "0", "--stretch_max", "1000", "--colormap", "jet"]
+
+def customCmpOpts(pid1, ds1, pid2, ds2):
+    """
+    Comparison options of a pair of data fields, as customCmpOpts() of
+    compare_mv_products.sh.
+    """
+    fam1, fam2 = productFamily(pid1), productFamily(pid2)
+    both = lambda pat: re.search(pat, ds1, re.I) is not None and re.search(pat, ds2, re.I) is not None
+    if both("Mandatory_Quality"):
+        return ["--stretch_min", "0", "0", "--stretch_max", "1", "1", "--bin_size", "1", "1"]
+    if both("Band_Quality"):
+        return ["--stretch_min", "0", "0", "--stretch_max", "3", "3", "--bin_size", "1", "1"]
+    if both("BRDF_Quality"):
+        return ["--stretch_min", "0", "0", "--stretch_max", "1" if fam1.endswith("D") else "5", "1" if fam2.endswith("D") else "5", "--bin_size", "1", "1"]
+    if both("Snow") and not re.search("Percent", ds1, re.I) and not re.search("Percent", ds2, re.I):
+        return ["--stretch_min", "0", "0", "--stretch_max", "1", "1", "--bin_size", "1", "1"]
+    if both("Platform"):
+        return ["--stretch_min", "0", "0", "--stretch_max", "2", "2", "--bin_size", "1", "1"]
+    if both("land.*water.*type"):
+        return ["--stretch_min", "0", "0", "--stretch_max", "7", "7", "--bin_size", "1", "1"]
+    if both("local.*solar.*noon"):
+        return ["--stretch_min", "0", "0", "--stretch_max", "90", "90", "--bin_size", "1", "1"]
+    if both("ValidObs"):
+        return ["--stretch_min", "0", "0", "--stretch_max", "16", "16", "--bin_size", "1", "1", "--transform_func", "popcount"]
+    if both("Percent"):
+        return ["--stretch_min", "0", "0", "--stretch_max", "100", "100", "--bin_size", "1", "1"]
+    if both("(Nadir|NBAR)"):
+        return ["--stretch_min", "0", "0", "--stretch_max", "1", "1", "--bin_size", "1e-3", "1e-3",
+                "--scale_factor", "1e-3" if fam1 == "MCD43D" else "1e-4", "1e-3" if fam2 == "MCD43D" else "1e-4"]
+    # Parameters, BSA, WSA, Uncertainty
+    return ["--stretch_min", "0", "0", "--stretch_max", "1", "1", "--bin_size", "1e-3", "1e-3", "--scale_factor", "1e-3", "1e-3"]
+
+def matchDataFields(dsnames1, dsnames2, bands1, bands2):
+    """
+    Pairs of corresponding data fields of two products, matching the
+    band names of the second product to those of the first one, and
+    ignoring case, ' ' vs '_' and a leading 'Global_' of CMG products.
+    """
+    norm = lambda name: re.sub("^GLOBAL_", "", name.upper().replace(" ", "_"))
+    lookup = dict([(norm(ds), ds) for ds in dsnames1])
+    pairs = []
+    for ds2 in dsnames2:
+        wanted = ds2
+        for b1, b2 in zip(bands1, bands2):
+            if ds2.endswith("_" + b2):
+                wanted = ds2[0:len(ds2)-len(b2)] + b1
+                break
+        ds1 = lookup.get(norm(wanted), None)
+        if ds1 is None:
+            print colorWarnStr("Failed to find the corresponding dataset for {0:s}".format(ds2))
+            continue
+        pairs.append((ds1, ds2))
+    return pairs
+
+def selectDataFields(dsnames, patterns):
+    return [ds for ds in dsnames if any([fnmatch.fnmatch(ds, pat) for pat in patterns])]
+
+def fileIdentity(fname):
+    st = os.stat(fname)
+    return [os.path.abspath(fname), st.st_size, st.st_mtime]
+
+def mergeCsvs(srcs, dst):
+    """
+    Concatenate CSV files with the header of the first one only, as
+    copyCsv() of the shell scripts.
+    """
+    header = False
+    with open(dst, "w") as ofobj:
+        for src in srcs:
+            if not os.path.isfile(src):
+                continue
+            with open(src, "r") as fobj:
+                lines = fobj.readlines()
+            ofobj.writelines(lines if not header else lines[1:])
+            header = True
+            os.remove(src)
+
+class Manifest(object):
+    """
+    Append-only JSON-lines file of the processing steps run. A step is
+    done if its last record succeeded on inputs of the same sizes and
+    modification times as now.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.records = {}
+        if os.path.isfile(fname):
+            with open(fname, "r") as fobj:
+                for line in fobj:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # a line cut by an interrupted run
+                        continue
+                    self.records[rec["key"]] = rec
+
+    def isDone(self, key, inputs):
+        rec = self.records.get(key, None)
+        if rec is None or rec["status"] != "done":
+            return False
+        try:
+            return rec["inputs"] == [fileIdentity(f) for f in inputs]
+        except OSError:
+            return False
+
+    def add(self, rec):
+        with self.lock:
+            self.records[rec["key"]] = rec
+            with open(self.fname, "a") as fobj:
+                fobj.write(json.dumps(rec, sort_keys=True) + "\n")
+                fobj.flush()
+                os.fsync(fobj.fileno())
+
+def runStep(step):
+    """
+    Run the commands of a step in order, stop at the first failure,
+    and merge the CSV outputs of the commands. Return the step with its
+    status, also when the step raises, e.g. a command not found, since
+    the callback of the pool is the only way a step gets back to the
+    pipeline.
+    """
+    t0 = time.time()
+    step["status"] = "done"
+    step["error"] = None
+    try:
+        with open(step["log"], "a") as logobj:
+            for cmd in step["cmds"]:
+                logobj.write(" ".join(['"{0:s}"'.format(c) if " " in c else c for c in cmd]) + "\n")
+                logobj.flush()
+                ret = subprocess.call(cmd, stdout=logobj, stderr=subprocess.STDOUT)
+                if ret != 0:
+                    step["status"] = "failed"
+                    step["error"] = "exit code {0:d} of {1:s}, see {2:s}".format(ret, os.path.basename(cmd[1] if len(cmd) > 1 else cmd[0]), step["log"])
+                    break
+        if step["status"] == "done" and len(step.get("csvs", [])) > 0:
+            mergeCsvs(step["csvs"], step["ocsv"])
+        if step["status"] == "done" and step.get("rename", None) is not None:
+            os.rename(*step["rename"])
+    except Exception as e:
+        step["status"] = "failed"
+        step["error"] = str(e)
+    step["elapsed"] = time.time() - t0
+    return step
+
+class Pipeline(object):
+    def __init__(self, cmdargs):
+        self.cmdargs = cmdargs
+        self.outdir = cmdargs.outdir
+        self.logdir = os.path.join(self.outdir, "logs")
+        for d in [self.outdir, self.logdir]:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        self.manifest = Manifest(os.path.join(self.outdir, "pipeline_manifest.jsonl"))
+        self.pool = ThreadPool(cmdargs.nproc)
+        self.results = Queue.Queue()
+        self.npending = 0
+        # path -> [size, mtime, time first seen with this size and mtime]
+        self.candidates = {}
+        # base names of granules taken, without extension
+        self.granules = {}
+        # (date, tile) -> {pid: h5 file}
+        self.ready = {}
+        self.nfailed = 0
+
+    def scan(self):
+        """
+        Find the granules that have stayed unchanged for the settle
+        time since the last scans.
+        """
+        now = time.time()
+        settled = []
+        for wdir in self.cmdargs.watch_dirs:
+            for root, subdirs, files in os.walk(wdir):
+                subdirs.sort()
+                for f in sorted(files):
+                    g = parseGranuleName(f)
+                    if g is None:
+                        continue
+                    base = os.path.splitext(f)[0]
+                    if base in self.granules:
+                        continue
+                    path = os.path.join(root, f)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    prev = self.candidates.get(path, None)
+                    if prev is None or prev[0:2] != [st.st_size, st.st_mtime]:
+                        self.candidates[path] = [st.st_size, st.st_mtime, now]
+                        prev = self.candidates[path]
+                    if now - max(prev[2], st.st_mtime) >= self.cmdargs.settle:
+                        g["path"] = path
+                        g["base"] = base
+                        g["found"] = now
+                        settled.append(g)
+        for g in settled:
+            del self.candidates[g["path"]]
+            # an HDF5 granule converted from an HDF4 one in the
+            # watched directories is taken with the HDF4 one.
+            if g["base"] in self.granules:
+                continue
+            self.granules[g["base"]] = g
+            print colorLogStr("New granule ") + colorDimStr(g["path"])
+            self.onGranule(g)
+
+    def submit(self, step):
+        if self.manifest.isDone(step["key"], step["inputs"]):
+            print colorDimStr("Skip {0:s}, done before".format(step["key"]))
+            self.afterStep(step)
+            return
+        self.npending += 1
+        self.pool.apply_async(runStep, (step,), callback=self.results.put)
+
+    def onGranule(self, g):
+        if g["ext"] == "hdf":
+            h5dir = os.path.dirname(g["path"]) if self.cmdargs.h5dir is None else self.cmdargs.h5dir
+            h5file = os.path.join(h5dir, g["base"] + ".h5")
+            # convert to a temporary name so that the watcher never takes
+            # a half-written HDF5 file.
+            tmpfile = h5file + ".part"
+            step = dict(kind="convert", key="convert:" + g["base"], granule=g, h5file=h5file,
+                        inputs=[g["path"]], log=os.path.join(self.logdir, g["base"] + ".convert.log"),
+                        cmds=[[self.cmdargs.h4toh5, "-eos", g["path"], tmpfile]], rename=(tmpfile, h5file))
+            if os.path.isfile(h5file) and self.manifest.isDone(step["key"], step["inputs"]):
+                print colorDimStr("Skip {0:s}, done before".format(step["key"]))
+                self.afterStep(step)
+            else:
+                self.npending += 1
+                self.pool.apply_async(runStep, (step,), callback=self.results.put)
+        else:
+            g["h5file"] = g["path"]
+            self.onH5Ready(g)
+
+    def onH5Ready(self, g):
+        try:
+            g["dsnames"] = selectDataFields(listDataFields(g["h5file"]), self.cmdargs.datasets)
+        except (IOError, OSError) as e:
+            self.nfailed += 1
+            print colorErrorStr("Failed to read {0:s}: {1:s}".format(g["h5file"], str(e)))
+            return
+
+        if not self.cmdargs.no_preview:
+            self.submit(self.previewStep(g))
+
+        pid = g["pid"].upper()
+        slot = self.ready.setdefault((g["date"], g["tile"]), {})
+        slot[pid] = g
+        for pid1, pid2 in self.cmdargs.pairs:
+            if pid == pid1 and pid2 in slot:
+                self.submit(self.compareStep(g, slot[pid2]))
+            elif pid == pid2 and pid1 in slot:
+                self.submit(self.compareStep(slot[pid1], g))
+
+    def previewStep(self, g):
+        gdir = os.path.join(self.outdir, g["base"])
+        if not os.path.isdir(gdir):
+            os.makedirs(gdir)
+        cmds, csvs = [], []
+        for i, ds in enumerate(g["dsnames"]):
+            outprefix = "{0:s}_{1:s}".format(g["pid"].lower(), ds.lower()).replace(" ", "_")
+            tmpcsv = os.path.join(gdir, ".tmp_preview_{0:03d}.csv".format(i))
+            cmd = [self.cmdargs.python, PREVIEW_SCRIPT, "--h5f", g["h5file"], "--dataset", ds,
+                   "--background", "255", "255", "255", "--colorbar",
+                   "--of", os.path.join(gdir, "{0:s}_{1:s}.png".format(outprefix, g["date"]))] \
+                  + customPrvOpts(g["pid"], ds) + ["--stats", "--attr_keys"] + ATTR_KEYS + ["--ocsv", tmpcsv]
+            if self.cmdargs.cache_dir is not None:
+                cmd = cmd + ["--cache_dir", self.cmdargs.cache_dir]
+            cmds.append(cmd)
+            csvs.append(tmpcsv)
+        return dict(kind="preview", key="preview:" + g["base"], granule=g, inputs=[g["h5file"]],
+                    log=os.path.join(self.logdir, g["base"] + ".preview.log"), cmds=cmds, csvs=csvs,
+                    ocsv=os.path.join(gdir, "metadata_{0:s}.csv".format(g["base"])))
+
+    def compareStep(self, g1, g2):
+        bands1, bands2 = getBandNames(g1["pid"], g2["pid"])
+        cdir = os.path.join(self.outdir, "{0:s}_vs_{1:s}".format(g1["base"], g2["base"]))
+        if not os.path.isdir(cdir):
+            os.makedirs(cdir)
+        oflabel = g1["date"] if g1["tile"] is None else "{0:s}_{1:s}".format(g1["date"], g1["tile"])
+        cmds, csvs = [], []
+        for i, (ds1, ds2) in enumerate(matchDataFields(g1["dsnames"], g2["dsnames"], bands1, bands2)):
+            label1 = "{0:s}_{1:s}_{2:s}".format(g1["pid"].lower(), ds1.lower(), oflabel).replace(" ", "_")
+            label2 = "{0:s}_{1:s}_{2:s}".format(g2["pid"].lower(), ds2.lower(), oflabel).replace(" ", "_")
+            tmpcsv = os.path.join(cdir, ".tmp_compare_{0:03d}.csv".format(i))
+            cmd = [self.cmdargs.python, COMPARE_SCRIPT, "--stats", "--ocsv", tmpcsv,
+                   "--files", g1["h5file"], g2["h5file"], "--datasets", ds1, ds2,
+                   "--outdir", cdir, "--labels", label1, label2] + customCmpOpts(g1["pid"], ds1, g2["pid"], ds2)
+            if self.cmdargs.cache_dir is not None:
+                cmd = cmd + ["--cache_dir", self.cmdargs.cache_dir]
+            cmds.append(cmd)
+            csvs.append(tmpcsv)
+        key = "compare:{0:s}:{1:s}".format(g1["base"], g2["base"])
+        return dict(kind="compare", key=key, granule=g2, inputs=[g1["h5file"], g2["h5file"]],
+                    log=os.path.join(self.logdir, "{0:s}_vs_{1:s}.compare.log".format(g1["base"], g2["base"])),
+                    cmds=cmds, csvs=csvs,
+                    ocsv=os.path.join(cdir, "diff_stats_{0:s}_vs_{1:s}.csv".format(g1["base"], g2["base"])))
+
+    def afterStep(self, step):
+        if step["kind"] == "convert":
+            g = step["granule"]
+            g["h5file"] = step["h5file"]
+            # the converted file is taken with the HDF4 granule.
+            self.granules[os.path.splitext(os.path.basename(step["h5file"]))[0]] = g
+            self.onH5Ready(g)
+
+    def drain(self, timeout=None):
+        """
+        Record the steps finished, and start the steps depending on
+        them.
+        """
+        while self.npending > 0:
+            try:
+                step = self.results.get(timeout=timeout) if timeout is not None else self.results.get_nowait()
+            except Queue.Empty:
+                return
+            self.npending -= 1
+            g = step["granule"]
+            rec = dict(key=step["key"], kind=step["kind"], status=step["status"], error=step["error"],
+                       inputs=[fileIdentity(f) for f in step["inputs"]] if step["status"] == "done" else None,
+                       elapsed=step["elapsed"], latency=time.time()-g["found"], time=time.time())
+            self.manifest.add(rec)
+            if step["status"] == "done":
+                print colorInfoStr("{0:s}, SUCCESS in {1:.1f} s, {2:.1f} s after the granule arrived".format(step["key"], rec["elapsed"], rec["latency"]))
+                self.afterStep(step)
+            else:
+                self.nfailed += 1
+                print colorErrorStr("{0:s}, FAILED, {1:s}".format(step["key"], step["error"]))
+            timeout = None
+
+    def run(self):
+        print colorLogStr("Watch ") + colorDimStr(" ".join(self.cmdargs.watch_dirs))
+        try:
+            while True:
+                self.scan()
+                self.drain()
+                if self.cmdargs.once and self.npending == 0 and len(self.candidates) == 0:
+                    break
+                # wake up early to chain the steps depending on a
+                # finished one.
+                self.drain(timeout=self.cmdargs.interval if self.npending > 0 else None)
+                if self.npending == 0:
+                    time.sleep(min(self.cmdargs.interval, self.cmdargs.settle) if (self.cmdargs.once and len(self.candidates) > 0) else self.cmdargs.interval)
+        except KeyboardInterrupt:
+            print colorWarnStr("Interrupted, the steps not finished will run again at the next start.")
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+        return self.nfailed
+
+def main(cmdargs):
+    pipeline = Pipeline(cmdargs)
+    nfailed = pipeline.run()
+    print colorInfoStr("Finished watching, {0:d} granules, {1:d} failed steps. Manifest: ".format(len(set([id(g) for g in pipeline.granules.values()])), nfailed)) + colorDimStr(pipeline.manifest.fname)
+    print colorResetStr("")
+    if nfailed > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
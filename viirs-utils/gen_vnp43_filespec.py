@@ -1,25 +1,41 @@
 #!/usr/bin/env python
 
+import os
+import sys
 import argparse
+import fnmatch
 import datetime
 import warnings
+import multiprocessing
+from collections import OrderedDict
 
 import h5py
 import numpy as np
 
-import pandas as pd
-
 
 def getCmdArgs():
     p = argparse.ArgumentParser(description="Generate a file specification file for a VNP43 product according to a predefined filespec template.")
     
-    p.add_argument("-t", "--template", dest="filespec_template", required=True, default=None, metavar="FILESPEC_TEMPLATE", help="A predefined template file of file specification.")
-    p.add_argument("-f", "--h5f", dest="h5fname", required=True, default=None, metavar="FILE_NAME_OF_SAMPLE_H5_PRODUCT", help="A sample VNP43 H5 product file.")
+    p.add_argument("-t", "--template", dest="filespec_template", required=False, default=None, metavar="FILESPEC_TEMPLATE", help="A predefined template file of file specification.")
+    p.add_argument("-f", "--h5f", dest="h5fname", required=False, default=None, metavar="FILE_NAME_OF_SAMPLE_H5_PRODUCT", help="A sample VNP43 H5 product file.")
+
+    p.add_argument("-o", "--output", dest="output", required=False, default=None, metavar="OUTPUT_FILESPEC_FILE", help="File name of the generated file specification.")
+
+    p.add_argument("-m", "--manifest", dest="manifest", required=False, default=None, metavar="MANIFEST_FILE", help="Batch mode. A manifest file of one entry per line, 'FILESPEC_TEMPLATE FILE_NAME_OF_SAMPLE_H5_PRODUCT OUTPUT_FILESPEC_FILE', separated by white spaces or commas. Lines starting with # are comments. Relative paths are relative to the directory of the manifest. Each sample file is opened once for all of its entries.")
+    p.add_argument("-n", "--nproc", dest="nproc", type=int, required=False, default=multiprocessing.cpu_count(), help="Number of worker processes in batch mode. Default: number of CPUs.")
 
-    p.add_argument("-o", "--output", dest="output", required=True, default=None, metavar="OUTPUT_FILESPEC_FILE", help="File name of the generated file specification.")
+    p.add_argument("-c", "--check_const", dest="check_const", nargs="+", required=False, default=None, metavar="FILE_OR_DIRECTORY", help="Validation mode. Check whether the global attributes assumed constant in filespecs, i.e. {0:s}, are actually constant across the given product files and the product files found under the given directories. Only metadata is read. Report the attributes that vary with the number of files of each distinct value and example files.".format(", ".join(CONST_ATTR_NAMES)))
+    p.add_argument("--pattern", dest="pattern", nargs="+", required=False, default=["*.h5"], help="File name patterns of product files to search in directories given by --check_const. Default: *.h5.")
+    p.add_argument("--ocsv", dest="ocsv", required=False, default=None, help="Name of a CSV file to output the report of --check_const. Default: only output to stdout.")
 
     cmdargs = p.parse_args()
 
+    if cmdargs.manifest is None and cmdargs.check_const is None:
+        if cmdargs.filespec_template is None or cmdargs.h5fname is None or cmdargs.output is None:
+            raise RuntimeError("Either a manifest file, product files to check, or a template file, a sample product file and an output file must be given.")
+    if cmdargs.nproc < 1:
+        raise RuntimeError("Number of worker processes must be at least 1.")
+
     return cmdargs
 
 def interpLine(line, lterm='[', rterm=']'):
@@ -111,27 +127,188 @@ def fmtH5TypeValue(val):
         raise RuntimeError("Unrecognized data type {0:s}".format(str(type(val))))
 
 
-def getDimList(struct_meta_str, df_name):
-    i = struct_meta_str.find(df_name)
-    if i > -1:
-        j = struct_meta_str[i:].find("DimList")
-        k = struct_meta_str[i:][j:].find(")")
-        return struct_meta_str[i:][j:][:k].split("=")[1].lstrip("(").split(",")
-    else:
+def parseODLValue(val_str):
+# Convert the value string of an ODL statement to a Python value:
+# quoted strings to strings without quotes, tuples in parentheses to
+# lists, and numbers to int or float. Other values, e.g. enumerations
+# like HE5_GCTP_SNSOID, stay as strings.
+    val_str = val_str.strip()
+    if val_str.startswith("(") and val_str.endswith(")"):
+        items = []
+        item, in_quote = "", False
+        for ch in val_str[1:-1]:
+            if ch == '"':
+                in_quote = not in_quote
+            if ch == "," and not in_quote:
+                items.append(item)
+                item = ""
+            else:
+                item = item + ch
+        if len(item.strip()) > 0 or len(items) > 0:
+            items.append(item)
+        return [parseODLValue(v) for v in items]
+    if len(val_str) >= 2 and val_str.startswith('"') and val_str.endswith('"'):
+        return val_str[1:-1]
+    for conv in (int, float):
+        try:
+            return conv(val_str)
+        except ValueError:
+            pass
+    return val_str
+
+
+def parseODL(odl_str):
+# Parse an ODL string, e.g. StructMetadata.0 of an HDF-EOS5 file, into
+# a tree of nested OrderedDict. Each GROUP or OBJECT becomes a child
+# OrderedDict under its name, and each statement "key=value" becomes
+# an item of the value converted by parseODLValue.
+    root = OrderedDict()
+    stack = [("", root)]
+
+    # StructMetadata.0 is often padded with null characters.
+    lines = odl_str.replace("\x00", "").splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
+        i += 1
+        if len(line) == 0 or line == "END":
+            continue
+        if line.find("=") < 0:
+            raise RuntimeError("Syntax error in ODL, missing '=' in the following line:\n{0:s}".format(line))
+        key, val_str = [v.strip() for v in line.split("=", 1)]
+        # a tuple value may continue over several lines.
+        while val_str.count("(") > val_str.count(")") and i < len(lines):
+            val_str = val_str + lines[i].strip()
+            i += 1
+
+        if key in ("GROUP", "OBJECT"):
+            node = OrderedDict()
+            stack[-1][1][val_str] = node
+            stack.append((val_str, node))
+        elif key in ("END_GROUP", "END_OBJECT"):
+            if len(stack) < 2 or stack[-1][0] != val_str:
+                raise RuntimeError("Syntax error in ODL, unmatched {0:s}={1:s}".format(key, val_str))
+            stack.pop()
+        else:
+            stack[-1][1][key] = parseODLValue(val_str)
+
+    if len(stack) > 1:
+        raise RuntimeError("Syntax error in ODL, GROUP or OBJECT {0:s} not closed".format(stack[-1][0]))
+    return root
+
+
+def indexStructMetadata(odl_tree):
+# Index the grids in the ODL tree of StructMetadata.0 by grid names,
+# and their dimensions and data fields by names. Return a dictionary
+# with
+#   "tree": the ODL tree,
+#   "grids": OrderedDict of grid name -> dict of "attrs" (e.g. XDim,
+#     UpperLeftPointMtrs, Projection), "dimensions" (OrderedDict of
+#     dimension name -> size) and "datafields" (OrderedDict of data
+#     field name -> ODL node of the field),
+#   "fields": dict of data field name -> list of names of the grids
+#     having the field.
+    grids = OrderedDict()
+    fields = {}
+    for gnode in odl_tree.get("GridStructure", {}).values():
+        if not isinstance(gnode, dict):
+            continue
+        grid_name = gnode["GridName"]
+        attrs = OrderedDict([(k, v) for k, v in gnode.items() if not isinstance(v, dict)])
+        dims = OrderedDict()
+        for dnode in gnode.get("Dimension", {}).values():
+            dims[dnode["DimensionName"]] = dnode["Size"]
+        datafields = OrderedDict()
+        for fnode in gnode.get("DataField", {}).values():
+            datafields[fnode["DataFieldName"]] = fnode
+            fields.setdefault(fnode["DataFieldName"], []).append(grid_name)
+        grids[grid_name] = dict(attrs=attrs, dimensions=dims, datafields=datafields)
+    return dict(tree=odl_tree, grids=grids, fields=fields)
+
+
+def fileKey(fname):
+# Identity of a file by its (real path, size, modification time), so
+# that a file regenerated under the same name is not mistaken for the
+# old one.
+    st = os.stat(fname)
+    return (os.path.realpath(fname), st.st_size, st.st_mtime)
+
+
+# Parsed StructMetadata.0 of opened files, by file identities.
+_struct_meta_cache = {}
+
+def getStructMetadata(h5fobj):
+# Parse StructMetadata.0 of an opened HDF-EOS5 file into an indexed
+# ODL tree, once per file.
+    key = fileKey(h5fobj.filename)
+    if key not in _struct_meta_cache:
+        struct_meta_str = h5fobj['HDFEOS INFORMATION']['StructMetadata.0'][()]
+        _struct_meta_cache[key] = indexStructMetadata(parseODL(struct_meta_str))
+    return _struct_meta_cache[key]
+
+
+def getDimList(struct_meta, df_name, grid_name=None):
+# Return the list of dimension names of a data field from an indexed
+# StructMetadata.0. The names are quoted as they are in the ODL.
+    if df_name not in struct_meta["fields"]:
         raise RuntimeError("Given Data Field {0:s} not found in the StructMetadata.0".format(df_name))
-
-
-def attrDictToDataFrame(gattr_dict, const_only=False):
-    # These attributes have constant values across product files and
-    # their values will be output to the data frame. Otherwise,
-    # "Variable" will appear as the value column in the data frame.
-    const_attr_names = ["AlgorithmType", "AlgorithmVersion", 
-                        "LongName", "PGEVersion", "PGE_Name", 
-                        "PlatformShortName", "ProcessingCenter", 
-                        "SatelliteInstrument", 
-                        "SensorShortname", "ShortName", 
-                        "identifier_product_doi_authority"]
-
+    if grid_name is None:
+        grid_name = struct_meta["fields"][df_name][0]
+    elif grid_name not in struct_meta["fields"][df_name]:
+        raise RuntimeError("Given Data Field {0:s} not found in the grid {1:s} of the StructMetadata.0".format(df_name, grid_name))
+    dim_list = struct_meta["grids"][grid_name]["datafields"][df_name]["DimList"]
+    return ["\"{0:s}\"".format(d) for d in dim_list]
+
+
+# Formats of date and time strings in attributes to be recognized as
+# DATETIME values.
+DATETIME_FORMATS = ["%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f", 
+                    "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f", 
+                    "%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S.%fZ"]
+TIME_FORMATS = ["%H:%M:%S", "%H:%M:%S.%f"]
+
+def parseDateTimeStr(val):
+# Convert a date and/or time string to a datetime object. Raise
+# ValueError if the string is not in any of the recognized formats.
+# A time-only string is put on the date of today.
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(val, fmt)
+        except ValueError:
+            pass
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.datetime.combine(datetime.date.today(), datetime.datetime.strptime(val, fmt).time())
+        except ValueError:
+            pass
+    raise ValueError("Not a date or time string: {0:s}".format(val))
+
+
+ATTR_TABLE_COLUMNS = ["Name", "Type", "Num_Val", "Source", "Value"]
+
+# Global attributes assumed to have constant values across the product
+# files of a production run. Check the assumption with --check_const.
+CONST_ATTR_NAMES = ["AlgorithmType", "AlgorithmVersion", 
+                    "LongName", "PGEVersion", "PGE_Name", 
+                    "PlatformShortName", "ProcessingCenter", 
+                    "SatelliteInstrument", 
+                    "SensorShortname", "ShortName", 
+                    "identifier_product_doi_authority"]
+
+def getGridNames(h5fobj):
+# Names of the grids in a file, in the order of StructMetadata.0,
+# e.g. VIIRS_Grid_BRDF for VNP43IA1.
+    return [grid_name for grid_name in getStructMetadata(h5fobj)["grids"].keys() 
+            if grid_name in h5fobj['HDFEOS']['GRIDS']]
+
+
+def attrDictToTable(gattr_dict, const_only=False):
+# Tabulate attributes into a dictionary of the columns in
+# ATTR_TABLE_COLUMNS, one row per attribute sorted by names.
+    # Attributes in CONST_ATTR_NAMES have constant values across
+    # product files and their values will be output to the table.
+    # Otherwise, "Variable" will appear as the value column in the
+    # table.
     tattr_dict = {}
     for k, val in gattr_dict.iteritems():
         try:
@@ -146,12 +323,12 @@ def attrDictToDataFrame(gattr_dict, const_only=False):
 
     for k, val in tattr_dict.iteritems():
         try:
-            tval = [pd.to_datetime(v).to_pydatetime() if str(type(v)).find("str")>-1 else v for v in val]
+            tval = [parseDateTimeStr(v) if str(type(v)).find("str")>-1 else v for v in val]
         except ValueError:
             tval = val
         tattr_dict[k] = tval
 
-    out_dict = dict(Name=[], Type=[], Num_Val=[], Source=[], Value=[])
+    out_dict = dict([(col, []) for col in ATTR_TABLE_COLUMNS])
     source_stig = ["AlgorithmType", "AlgorithmVersion", 
                    "EastBoundingCoord", "WestBoundingCoord", 
                    "NorthBoundingCoord", "SouthBoundingCoord"]
@@ -163,7 +340,7 @@ def attrDictToDataFrame(gattr_dict, const_only=False):
         val_str = ",".join([fmtH5TypeValue(v)[1] for v in val])
         if len(val) > 1:
             val_str = "[" + val_str + "]"
-        if (not const_only) or (k in const_attr_names):
+        if (not const_only) or (k in CONST_ATTR_NAMES):
             out_dict["Value"].append(val_str)
         else:
             out_dict["Value"].append("Variable")
@@ -173,8 +350,22 @@ def attrDictToDataFrame(gattr_dict, const_only=False):
             out_dict["Source"].append("STIG")
         else:
             out_dict["Source"].append("PGE")
-    out_df = pd.DataFrame(out_dict)[["Name", "Type", "Num_Val", "Source", "Value"]]
-    return out_df
+    return out_dict
+
+def fmtTable(table, columns=ATTR_TABLE_COLUMNS):
+# Format a table of columns into right-justified text in the same
+# layout as pandas DataFrame.to_string(index=False) prints, without
+# truncating long values. Every value gets a leading space, and so
+# does the header of a numeric column.
+    col_strs = []
+    for col in columns:
+        vals = table[col]
+        is_num = len(vals) > 0 and all([isinstance(v, (int, long, float, np.number)) for v in vals])
+        strs = [" " + str(v) for v in vals]
+        header = " " + col if is_num else col
+        width = max([len(header)] + [len(v) for v in strs])
+        col_strs.append([header.rjust(width)] + [v.rjust(width) for v in strs])
+    return "\n".join([" ".join(row) for row in zip(*col_strs)])
 
 def getKeyword(h5fobj, kw):
     if kw == "AlgorithmVersion":
@@ -212,7 +403,8 @@ def getKeyword(h5fobj, kw):
         return h5fobj.attrs[attr_key].split()[0]
 
     elif kw == "DataFields":
-        df_list = h5fobj['HDFEOS']['GRIDS']['VIIRS_Grid_BRDF']['Data Fields'].keys()
+        df_list = [ds_name for grid_name in getGridNames(h5fobj) 
+                   for ds_name in h5fobj['HDFEOS']['GRIDS'][grid_name]['Data Fields'].keys()]
         return "\n".join(df_list)
 
     elif kw == "GlobalAttributes":
@@ -220,36 +412,27 @@ def getKeyword(h5fobj, kw):
         if "InputPointer" in gattr_dict.keys():
             del gattr_dict["InputPointer"]
             
-        out_df = attrDictToDataFrame(gattr_dict, const_only=True)
-        
-        old_colw = pd.options.display.max_colwidth
-        if len(out_df) > 0:
-            max_strlen = max([len(row[1].loc["Value"]) for row in out_df.iterrows()]) + 1
-            pd.options.display.max_colwidth = max_strlen if max_strlen > old_colw else old_colw
-
-        out_str = out_df.to_string(header=True, index=False, index_names=False, justify="justify")
-
-        pd.options.display.max_colwidth = old_colw
-
-        return out_str
+        return fmtTable(attrDictToTable(gattr_dict, const_only=True))
 
     elif kw == "StructMetadata.0":
-        return h5fobj['HDFEOS INFORMATION']['StructMetadata.0'].value
+        return h5fobj['HDFEOS INFORMATION']['StructMetadata.0'][()]
 
     elif kw == "DataFieldDefinitions":
         out_str_list = []
 
-        for ds_name in h5fobj['HDFEOS']['GRIDS']['VIIRS_Grid_BRDF']['Data Fields'].keys():
+        for grid_name, ds_name in [(grid_name, ds_name) for grid_name in getGridNames(h5fobj) 
+                                   for ds_name in h5fobj['HDFEOS']['GRIDS'][grid_name]['Data Fields'].keys()]:
             out_str = "\n"
 
-            ds = h5fobj['HDFEOS']['GRIDS']['VIIRS_Grid_BRDF']['Data Fields'][ds_name]
+            ds = h5fobj['HDFEOS']['GRIDS'][grid_name]['Data Fields'][ds_name]
 
-            tmp_df = attrDictToDataFrame(dict(ds.attrs.items()))
+            attr_table = attrDictToTable(dict(ds.attrs.items()))
             desc_str = ""
-            if "Description" in tmp_df["Name"].values:
-                row_idx = tmp_df["Name"].values.tolist().index("Description")
-                desc_str = tmp_df.loc[row_idx, "Value"]
-                tmp_df = tmp_df.drop([0])
+            if "Description" in attr_table["Name"]:
+                row_idx = attr_table["Name"].index("Description")
+                desc_str = attr_table["Value"][row_idx]
+                for col in ATTR_TABLE_COLUMNS:
+                    del attr_table[col][row_idx]
 
             out_str += "SDS Name:\t\t{0:s}\n\n".format(ds_name)
             if "long_name" in ds.attrs.keys():
@@ -261,17 +444,12 @@ def getKeyword(h5fobj, kw):
             out_str += "Rank:\t\t\t{0:d}\n".format(len(ds.shape))
             out_str += "Dimension Sizes:\t" + ", ".join([str(v) for v in ds.shape]) + "\n"
 
-            dim_list = getDimList(h5fobj['HDFEOS INFORMATION']['StructMetadata.0'].value, ds_name)
+            dim_list = getDimList(getStructMetadata(h5fobj), ds_name, grid_name=grid_name)
             out_str += "Dimension Names:\n" + "\n".join(["\tDimension{0:d}: {1:s}".format(i, v) for i, v in enumerate(dim_list)]) + "\n\n"
             
             out_str += "SDS Attributes:\n"
 
-            old_colw = pd.options.display.max_colwidth
-            if len(tmp_df) > 0:
-                max_strlen = max([len(row[1].loc["Value"]) for row in tmp_df.iterrows()]) + 1
-                pd.options.display.max_colwidth = max_strlen if max_strlen > old_colw else old_colw
-            out_str += tmp_df.to_string(header=True, index=False, index_names=False, justify="justify")
-            pd.options.display.max_colwidth = old_colw
+            out_str += fmtTable(attr_table)
 
             out_str += "\n\n"
             out_str_list.append(out_str)
@@ -282,28 +460,237 @@ def getKeyword(h5fobj, kw):
         raise RuntimeError("Unrecognized keyword {0:s} in the file specification template".format(kw))
 
 
-def main(cmdargs):
-    fs_template = cmdargs.filespec_template
-    fs_output = cmdargs.output
-    h5fname = cmdargs.h5fname
+# Values of keywords already evaluated, by (file identity, keyword).
+_keyword_cache = {}
+
+def getKeywordCached(h5fobj, kw):
+# Evaluate a keyword once per file and reuse its value wherever the
+# keyword appears again.
+    key = (fileKey(h5fobj.filename), kw)
+    if key not in _keyword_cache:
+        _keyword_cache[key] = getKeyword(h5fobj, kw)
+    return _keyword_cache[key]
+
 
-    h5fobj = h5py.File(h5fname, "r")
-    with open(fs_template, "r") as fstp_fobj, open(fs_output, "w") as fsout_fobj:
+# Compiled templates, by file identities of template files.
+_template_cache = {}
+
+def compileTemplate(fs_template):
+# Compile a filespec template into a list of segments, each either a
+# literal string, or a tuple of a format string and the list of
+# keywords whose values fill the format string. Consecutive literal
+# lines are merged into one segment. A template is compiled once and
+# cached until the template file changes.
+    key = fileKey(fs_template)
+    if key in _template_cache:
+        return _template_cache[key]
+
+    segments = []
+    literal = ""
+    with open(fs_template, "r") as fstp_fobj:
         for line in fstp_fobj:
             keywords, fmtstr = interpLine(line)
             if len(keywords) == 0:
                 # No keywords to retrieve value and print
-                outstr = line
+                literal = literal + line
             else:
-                # Retrieve values of keywords and print them in
-                # the format string.
-                kw_values = []
-                for kw in keywords:
-                    kw_values.append(getKeyword(h5fobj,  kw))
-                outstr = fmtstr.format(*kw_values)
-            fsout_fobj.write(outstr)
-
-    h5fobj.close()
+                if len(literal) > 0:
+                    segments.append(literal)
+                    literal = ""
+                segments.append((fmtstr, keywords))
+    if len(literal) > 0:
+        segments.append(literal)
+
+    _template_cache[key] = segments
+    return segments
+
+
+def renderTemplate(segments, h5fobj):
+# Fill a compiled template with the values of keywords from a sample
+# product file. Keywords are evaluated only when used and once per file.
+    out_list = []
+    for seg in segments:
+        if isinstance(seg, tuple):
+            fmtstr, keywords = seg
+            out_list.append(fmtstr.format(*[getKeywordCached(h5fobj, kw) for kw in keywords]))
+        else:
+            out_list.append(seg)
+    return "".join(out_list)
+
+
+def readManifest(manifest):
+# Read the entries of (template, sample file, output) in a manifest.
+    entries = []
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, "r") as fobj:
+        for i, line in enumerate(fobj):
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            fields = line.replace(",", " ").split()
+            if len(fields) != 3:
+                raise RuntimeError("Line {0:d} of the manifest {1:s} does not have 3 fields of template, sample file and output:\n{2:s}".format(i+1, manifest, line))
+            entries.append(tuple([os.path.join(base_dir, v) for v in fields]))
+    return entries
+
+
+def genFilespecs(h5fname, entries):
+# Generate the filespecs of a list of (template, output) from one
+# sample file opened once. Return a list of (output, error message or
+# None).
+    # A sample file is used by one manifest group only, so the cached
+    # values of earlier groups are not used again. Clear them, to keep
+    # long-running workers from growing without bound.
+    _struct_meta_cache.clear()
+    _keyword_cache.clear()
+    results = []
+    try:
+        h5fobj = h5py.File(h5fname, "r")
+    except IOError as e:
+        return [(fs_output, "Failed to open {0:s}: {1:s}".format(h5fname, str(e))) for _, fs_output in entries]
+    with h5fobj:
+        for fs_template, fs_output in entries:
+            try:
+                out_str = renderTemplate(compileTemplate(fs_template), h5fobj)
+                with open(fs_output, "w") as fsout_fobj:
+                    fsout_fobj.write(out_str)
+                results.append((fs_output, None))
+            except Exception as e:
+                results.append((fs_output, "{0:s}: {1:s}".format(type(e).__name__, str(e))))
+    return results
+
+
+def _genFilespecsStar(args):
+    return genFilespecs(*args)
+
+
+def runManifest(manifest, nproc):
+    entries = readManifest(manifest)
+    # group the entries by sample files so that each file is opened once.
+    groups = OrderedDict()
+    for fs_template, h5fname, fs_output in entries:
+        groups.setdefault(h5fname, []).append((fs_template, fs_output))
+    print "Generate {0:d} filespecs from {1:d} sample files with {2:d} processes".format(len(entries), len(groups), min(nproc, len(groups)))
+
+    nerr = 0
+    if len(groups) > 0:
+        pool = multiprocessing.Pool(min(nproc, len(groups)))
+        try:
+            for results in pool.imap_unordered(_genFilespecsStar, groups.items()):
+                for fs_output, errmsg in results:
+                    if errmsg is None:
+                        print "Generated {0:s}".format(fs_output)
+                    else:
+                        nerr += 1
+                        print "FAILED {0:s}, {1:s}".format(fs_output, errmsg)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    if nerr > 0:
+        raise RuntimeError("Failed to generate {0:d} of {1:d} filespecs in the manifest {2:s}".format(nerr, len(entries), manifest))
+
+
+def readConstAttrs(h5fname):
+# Read the values of the global attributes in CONST_ATTR_NAMES from a
+# product file, formatted as in the filespec. Missing attributes get
+# the value MISSING. Return (file name, dict of values, error message
+# or None).
+    try:
+        with h5py.File(h5fname, "r") as h5fobj:
+            gattr_dict = dict([(k, h5fobj.attrs[k]) for k in CONST_ATTR_NAMES if k in h5fobj.attrs])
+    except IOError as e:
+        return h5fname, {}, str(e)
+    attr_table = attrDictToTable(gattr_dict)
+    out_dict = dict([(k, "MISSING") for k in CONST_ATTR_NAMES])
+    out_dict.update(dict(zip(attr_table["Name"], attr_table["Value"])))
+    return h5fname, out_dict, None
+
+
+def findProductFiles(paths, patterns):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, subdirs, files in os.walk(path):
+                subdirs.sort()
+                for f in sorted(files):
+                    if any([fnmatch.fnmatch(f, pat) for pat in patterns]):
+                        yield os.path.join(root, f)
+        else:
+            yield path
+
+
+def checkConstAttrs(paths, patterns, nproc, outcsvfile=None, nexamples=3):
+# Stream the constant global attributes of product files through a
+# process pool, count the files of each distinct value of each
+# attribute, and report the attributes that vary.
+    h5fnames = list(findProductFiles(paths, patterns))
+    if len(h5fnames) == 0:
+        raise RuntimeError("No product files found to check.")
+    print "Check constant global attributes of {0:d} files with {1:d} processes".format(len(h5fnames), min(nproc, len(h5fnames)))
+
+    value_counts = dict([(k, OrderedDict()) for k in CONST_ATTR_NAMES])
+    value_examples = dict([(k, {}) for k in CONST_ATTR_NAMES])
+    errors = []
+    pool = multiprocessing.Pool(min(nproc, len(h5fnames)))
+    try:
+        for i, (h5fname, attr_values, errmsg) in enumerate(pool.imap_unordered(readConstAttrs, h5fnames, chunksize=16)):
+            if errmsg is not None:
+                errors.append((h5fname, errmsg))
+                continue
+            for k, v in attr_values.iteritems():
+                value_counts[k][v] = value_counts[k].get(v, 0) + 1
+                if len(value_examples[k].setdefault(v, [])) < nexamples:
+                    value_examples[k][v].append(h5fname)
+            sys.stdout.write("Checked {0:d}/{1:d} files\r".format(i+1, len(h5fnames)))
+            sys.stdout.flush()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    sys.stdout.write("\n")
+
+    for h5fname, errmsg in errors:
+        print "FAILED to read {0:s}, {1:s}".format(h5fname, errmsg)
+
+    varying = [k for k in CONST_ATTR_NAMES if len(value_counts[k]) > 1]
+    csv_str = "name,status,value,num_files,example_files\n"
+    for k in CONST_ATTR_NAMES:
+        status = "VARYING" if k in varying else "CONSTANT"
+        print "{0:s}: {1:s}".format(k, status)
+        for v, cnt in sorted(value_counts[k].items(), key=lambda item: -item[1]):
+            print "\t{0:d} files: {1:s}".format(cnt, v)
+            if k in varying:
+                print "\t\te.g. {0:s}".format(", ".join(value_examples[k][v]))
+            csv_str += "\"{0:s}\",{1:s},\"{2:s}\",{3:d},\"{4:s}\"\n".format(k, status, v.replace('"', '""'), cnt, ";".join(value_examples[k][v]))
+
+    if outcsvfile is not None:
+        print "Write the report to {0:s}".format(outcsvfile)
+        with open(outcsvfile, "w") as fobj:
+            fobj.write(csv_str)
+
+    if len(varying) > 0 or len(errors) > 0:
+        raise RuntimeError("{0:d} attributes assumed constant vary, {1:s}; {2:d} files failed to read.".format(len(varying), ", ".join(varying), len(errors)))
+    print "All the {0:d} attributes assumed constant are constant across {1:d} files.".format(len(CONST_ATTR_NAMES), len(h5fnames))
+
+
+def main(cmdargs):
+    if cmdargs.check_const is not None:
+        checkConstAttrs(cmdargs.check_const, cmdargs.pattern, cmdargs.nproc, outcsvfile=cmdargs.ocsv)
+        return
+
+    if cmdargs.manifest is not None:
+        runManifest(cmdargs.manifest, cmdargs.nproc)
+        return
+
+    fs_template = cmdargs.filespec_template
+    fs_output = cmdargs.output
+    h5fname = cmdargs.h5fname
+
+    segments = compileTemplate(fs_template)
+    with h5py.File(h5fname, "r") as h5fobj:
+        out_str = renderTemplate(segments, h5fobj)
+    with open(fs_output, "w") as fsout_fobj:
+        fsout_fobj.write(out_str)
 
 if __name__ == "__main__":
     cmdargs = getCmdArgs()